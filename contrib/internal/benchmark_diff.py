@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Compares the speed of RBTools' builtin unified diff engine with running
+# GNU diff for each file, and checks that their output matches.
+#
+# Usage: benchmark_diff.py [num_files] [lines_per_file] [changes_per_file]
+#
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from rbtools.utils.unified_diff import diff_files
+
+
+def make_files(dirname, num_files, num_lines, num_changes):
+    """Create pairs of files which differ by a few changes each."""
+    rand = random.Random(0)
+    pairs = []
+
+    for i in xrange(num_files):
+        lines = ['line %d of file %d\n' % (j, i) for j in xrange(num_lines)]
+        new_lines = list(lines)
+
+        for j in xrange(num_changes):
+            pos = rand.randint(0, len(new_lines))
+
+            if rand.random() < 0.5 and new_lines:
+                del new_lines[pos:pos + rand.randint(1, 3)]
+            else:
+                new_lines.insert(pos, 'new line %d\n' % j)
+
+        old_filename = os.path.join(dirname, '%d.old' % i)
+        new_filename = os.path.join(dirname, '%d.new' % i)
+        write_file(old_filename, ''.join(lines))
+        write_file(new_filename, ''.join(new_lines))
+        pairs.append((old_filename, new_filename))
+
+    return pairs
+
+
+def write_file(filename, data):
+    f = open(filename, 'wb')
+
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def run_gnu_diff(old_filename, new_filename):
+    p = subprocess.Popen(['diff', '-upN', '--label', 'a', '--label', 'b',
+                          old_filename, new_filename],
+                         stdout=subprocess.PIPE)
+    return p.communicate()[0]
+
+
+def run_builtin_diff(old_filename, new_filename):
+    return ''.join(diff_files(old_filename, new_filename, show_function=True,
+                              old_label='a', new_label='b'))
+
+
+def benchmark(name, func, pairs):
+    start = time.time()
+    results = [func(old_filename, new_filename)
+               for old_filename, new_filename in pairs]
+    elapsed = time.time() - start
+
+    print '%-10s %8.3fs  %8.3fms per file' % (name, elapsed,
+                                              elapsed * 1000 / len(pairs))
+
+    return results
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    num_files, num_lines, num_changes = (args + [1000, 500, 5][len(args):])
+
+    dirname = tempfile.mkdtemp(prefix='rbtools-diff-benchmark.')
+
+    try:
+        pairs = make_files(dirname, num_files, num_lines, num_changes)
+
+        print 'Diffing %d files of %d lines, with %d changes each' % (
+            num_files, num_lines, num_changes)
+
+        gnu_results = benchmark('GNU diff', run_gnu_diff, pairs)
+        builtin_results = benchmark('builtin', run_builtin_diff, pairs)
+
+        mismatches = [
+            pair
+            for pair, gnu_result, builtin_result in zip(pairs, gnu_results,
+                                                        builtin_results)
+            if gnu_result != builtin_result
+        ]
+
+        if mismatches:
+            print '%d diffs did not match, including %s and %s' % (
+                (len(mismatches),) + mismatches[0])
+            sys.exit(1)
+        else:
+            print 'All diffs matched.'
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    main()
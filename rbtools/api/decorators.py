@@ -12,11 +12,19 @@ def request_method_decorator(f):
     the method itself will be executed and the value returned as-is.
     Thus, any method calls embedded inside the code for another method
     should use the ``internal`` argument to access the expected value.
+
+    Requests made through a resource share the deadline of the request
+    which fetched the resource, unless a ``deadline`` argument is given.
     """
     def request_method(self, *args, **kwargs):
         if kwargs.pop('internal', False):
             return f(self, *args, **kwargs)
         else:
+            deadline = getattr(self, '_deadline', None)
+
+            if deadline is not None:
+                kwargs.setdefault('deadline', deadline)
+
             def method_wrapper(*args, **kwargs):
                 return f(self, *args, **kwargs)
 
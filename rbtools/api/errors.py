@@ -43,6 +43,11 @@ class ServerInterfaceError(Exception):
         return self.msg
 
 
+class ServerTimeoutError(ServerInterfaceError):
+    """The server didn't respond within the allowed time."""
+    pass
+
+
 API_ERROR_TYPE = {
     400: BadRequestError,
     401: AuthorizationError,
@@ -7,7 +7,7 @@ SPECIAL_KEYS = set(('links', 'total_results', 'stat', 'count'))
 
 
 def create_resource(transport, payload, url, mime_type=None,
-                    item_mime_type=None, guess_token=True):
+                    item_mime_type=None, guess_token=True, deadline=None):
     """Construct and return a resource object.
 
     The mime type will be used to find a resource specific base class.
@@ -21,6 +21,9 @@ def create_resource(transport, payload, url, mime_type=None,
     resources body lives under. If False, we assume that the resource
     body is the body of the payload itself. This is important for
     constructing Item resources from a resource list.
+
+    The 'deadline' will be used for any requests made through the
+    resource, such as fetching the next page of a list.
     """
 
     # Determine the key for the resources data.
@@ -42,4 +45,4 @@ def create_resource(transport, payload, url, mime_type=None,
         resource_class = ItemResource
 
     return resource_class(transport, payload, url, token=token,
-                          item_mime_type=item_mime_type)
+                          item_mime_type=item_mime_type, deadline=deadline)
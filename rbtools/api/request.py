@@ -6,6 +6,9 @@ import mimetools
 import mimetypes
 import os
 import shutil
+import socket
+import threading
+import time
 import urllib
 import urllib2
 from StringIO import StringIO
@@ -32,8 +35,11 @@ except ImportError:
 
 
 from rbtools import get_package_version
-from rbtools.api.errors import APIError, create_api_error, ServerInterfaceError
-from rbtools.utils.filesystem import get_home_path
+from rbtools.api.errors import (APIError, create_api_error,
+                                ServerInterfaceError, ServerTimeoutError)
+from rbtools.utils.filesystem import (SpooledBuffer, get_file_lock,
+                                      get_file_stamp, get_home_path,
+                                      make_atomic_tempfile, replace_file)
 
 
 RBTOOLS_COOKIE_FILE = '.rbtools-cookies'
@@ -88,12 +94,27 @@ class HttpRequest(object):
             files  - the files to be encoded.  This should be a dict in a
                      key:dict, filename:value and content:value format
         """
-        if not (self._fields or self._files):
+        content = StringIO()
+        content_type = self.write_multipart_formdata(content)
+
+        if content_type is None:
             return None, None
 
+        return content_type, content.getvalue()
+
+    def write_multipart_formdata(self, content):
+        """Writes the encoded data for an HTTP request to a file-like object.
+
+        This works like encode_multipart_formdata, but returns only the
+        content type, or None if there's no data to write. File contents
+        may be strings, file-like objects or anything with a write_to
+        method (such as a DiffSet).
+        """
+        if not (self._fields or self._files):
+            return None
+
         NEWLINE = '\r\n'
         BOUNDARY = mimetools.choose_boundary()
-        content = StringIO()
 
         for key in self._fields:
             content.write('--' + BOUNDARY + NEWLINE)
@@ -111,13 +132,24 @@ class HttpRequest(object):
             content.write('filename="%s"' % filename + NEWLINE)
             content.write('Content-Type: %s' % mime_type + NEWLINE)
             content.write(NEWLINE)
-            content.write(value)
+
+            if hasattr(value, 'write_to'):
+                # Diffs built up as a DiffSet are written out piece by
+                # piece, rather than being joined into a string first.
+                value.write_to(content)
+            elif hasattr(value, 'read'):
+                if hasattr(value, 'seek'):
+                    value.seek(0)
+
+                shutil.copyfileobj(value, content)
+            else:
+                content.write(value)
+
             content.write(NEWLINE)
 
         content.write('--' + BOUNDARY + '--' + NEWLINE + NEWLINE)
-        content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
 
-        return content_type, content.getvalue()
+        return 'multipart/form-data; boundary=%s' % BOUNDARY
 
 
 class Request(urllib2.Request):
@@ -129,23 +161,334 @@ class Request(urllib2.Request):
     def get_method(self):
         return self.method
 
+    def get_data(self):
+        # A body spooled to a file must be read from the start each time
+        # the request is sent, such as when retrying with authentication.
+        if hasattr(self.data, 'seek'):
+            self.data.seek(0)
+
+        return self.data
+
+
+class Deadline(object):
+    """A limit on the total time allowed for an API operation.
+
+    A deadline is shared by all the requests made for an operation,
+    including authentication retries and requests for further pages of
+    a list. It also records how far the operation got, so that running
+    out of time can be reported usefully.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.time() + timeout
+        self.requests_completed = 0
+        self.last_url = None
+        self._lock = threading.Lock()
+
+    def get_remaining(self):
+        """Return the number of seconds left before the deadline."""
+        return max(self.expires - time.time(), 0)
+
+    def has_expired(self):
+        return time.time() >= self.expires
+
+    def request_completed(self, url):
+        """Record that a request for the operation has completed."""
+        self._lock.acquire()
+
+        try:
+            self.requests_completed += 1
+            self.last_url = url
+        finally:
+            self._lock.release()
+
+    def get_progress(self):
+        """Return a description of how far the operation got."""
+        if self.requests_completed == 0:
+            return 'no requests had completed'
+
+        return '%d request(s) had completed, the last one for %s' % (
+            self.requests_completed, self.last_url)
+
+
+def is_timeout_error(e):
+    """Return whether a socket error was caused by a timeout."""
+    return (isinstance(e, socket.timeout) or
+            (isinstance(e, socket.error) and 'timed out' in str(e)))
+
+
+def create_timeout_error(url, deadline=None):
+    """Return a ServerTimeoutError for a request to url."""
+    if deadline is not None and deadline.has_expired():
+        msg = ('The %s second deadline expired while waiting for %s'
+               % (deadline.timeout, url))
+    else:
+        msg = 'Timed out waiting for %s' % url
+
+    if deadline is not None:
+        msg += ' (%s)' % deadline.get_progress()
+
+    return ServerTimeoutError(msg)
+
+
+def _limit_timeout(timeout, deadline):
+    """Return the timeout to use given a deadline.
+
+    None is returned if there's no limit.
+    """
+    if deadline is None:
+        return timeout
+
+    # A timeout of 0 would make the socket non-blocking, rather than
+    # failing straight away.
+    remaining = max(deadline.get_remaining(), 0.001)
+
+    if timeout is None:
+        return remaining
+    else:
+        return min(timeout, remaining)
+
+
+class DeadlineSocket(object):
+    """A socket whose timeout is limited by a deadline on every use.
+
+    Before each send or receive, the socket's timeout is set to the read
+    timeout or the time left before the deadline, whichever is shorter,
+    so a response that keeps trickling in can't run past the deadline.
+    Once the deadline has expired, socket.timeout is raised.
+    """
+    def __init__(self, sock, read_timeout, deadline):
+        self._sock = sock
+        self._read_timeout = read_timeout
+        self._deadline = deadline
+
+    def _limit(self):
+        if self._deadline.has_expired():
+            raise socket.timeout('timed out')
+
+        self._sock.settimeout(_limit_timeout(self._read_timeout,
+                                             self._deadline))
+
+    def recv(self, *args):
+        self._limit()
+        return self._sock.recv(*args)
+
+    def recv_into(self, *args):
+        self._limit()
+        return self._sock.recv_into(*args)
+
+    def send(self, *args):
+        self._limit()
+        return self._sock.send(*args)
+
+    def sendall(self, *args):
+        self._limit()
+        return self._sock.sendall(*args)
+
+    def makefile(self, mode='r', bufsize=-1):
+        # The file outlives the connection's socket object (httplib
+        # closes that once the response headers are read), so it keeps
+        # the socket it was made with, which is wrapped in turn for the
+        # deadline to apply to reads from it.
+        f = self._sock.makefile(mode, bufsize)
+        f._sock = DeadlineSocket(f._sock, self._read_timeout, self._deadline)
+
+        return f
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def _set_read_timeout(connection):
+    """Apply a connection's read timeout and deadline to its socket."""
+    if connection.deadline is not None:
+        read_timeout = connection.read_timeout
+
+        if read_timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            read_timeout = None
+
+        connection.sock = DeadlineSocket(connection.sock, read_timeout,
+                                         connection.deadline)
+    elif connection.read_timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+        connection.sock.settimeout(connection.read_timeout)
+
+
+class TimeoutHTTPConnection(httplib.HTTPConnection):
+    """An HTTP connection with separate connect and read timeouts.
+
+    The connection's ``timeout`` applies while connecting, after which
+    the socket's timeout is set to ``read_timeout``. If there's a
+    ``deadline``, the timeout is limited by it before each read.
+    """
+    read_timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+    deadline = None
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        _set_read_timeout(self)
+
+
+def _make_connection_factory(connection_class, request, connect_timeout,
+                             read_timeout):
+    """Return a function creating connections for a request.
+
+    The connections use the given timeouts, limited by the time left
+    before the request's deadline.
+    """
+    deadline = getattr(request, 'deadline', None)
+
+    def make_connection(host, **kwargs):
+        connect = _limit_timeout(connect_timeout, deadline)
+
+        if connect is not None:
+            kwargs['timeout'] = connect
+
+        connection = connection_class(host, **kwargs)
+
+        if connect is not None or read_timeout is not None:
+            connection.read_timeout = read_timeout
+
+        connection.deadline = deadline
+
+        return connection
+
+    return make_connection
+
+
+class TimeoutHTTPHandler(urllib2.HTTPHandler):
+    """Opens HTTP connections with connect and read timeouts."""
+    def __init__(self, connect_timeout=None, read_timeout=None):
+        urllib2.HTTPHandler.__init__(self)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def http_open(self, request):
+        return self.do_open(
+            _make_connection_factory(TimeoutHTTPConnection, request,
+                                     self.connect_timeout, self.read_timeout),
+            request)
+
+
+if hasattr(httplib, 'HTTPSConnection'):
+    class TimeoutHTTPSConnection(httplib.HTTPSConnection):
+        """An HTTPS connection with separate connect and read timeouts.
+
+        See TimeoutHTTPConnection.
+        """
+        read_timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        deadline = None
+
+        def connect(self):
+            httplib.HTTPSConnection.connect(self)
+            _set_read_timeout(self)
+
+    class TimeoutHTTPSHandler(urllib2.HTTPSHandler):
+        """Opens HTTPS connections with connect and read timeouts."""
+        def __init__(self, connect_timeout=None, read_timeout=None):
+            urllib2.HTTPSHandler.__init__(self)
+            self.connect_timeout = connect_timeout
+            self.read_timeout = read_timeout
+
+        def https_open(self, request):
+            kwargs = {}
+
+            # Newer versions of Python verify certificates using an SSL
+            # context set on the handler.
+            if getattr(self, '_context', None) is not None:
+                kwargs['context'] = self._context
+
+            return self.do_open(
+                _make_connection_factory(TimeoutHTTPSConnection, request,
+                                         self.connect_timeout,
+                                         self.read_timeout),
+                request, **kwargs)
+else:
+    TimeoutHTTPSHandler = None
+
+
+def _get_session_cookie(cookie_jar, request):
+    """Return the Review Board session the cookie jar has for a request.
+
+    None is returned if there's no session cookie for the request's URL.
+    """
+    host = cookielib.eff_request_host(request)[1]
+    path = urlparse(request.get_full_url())[2] or '/'
+
+    for cookie in cookie_jar:
+        if cookie.domain.startswith('.'):
+            domain_ok = ('.' + host).endswith(cookie.domain)
+        else:
+            domain_ok = host == cookie.domain
+
+        if (cookie.name == RB_COOKIE_NAME and
+            domain_ok and
+            not cookie.is_expired() and
+            path.startswith(cookie.path)):
+            return cookie.value
+
+    return None
+
+
+def _get_request_session(request):
+    """Return the Review Board session a request was sent with, or None."""
+    for part in request.get_header('Cookie', '').split(';'):
+        name, sep, value = part.strip().partition('=')
+
+        if name == RB_COOKIE_NAME:
+            return value
+
+    return None
+
 
 class PresetHTTPAuthHandler(urllib2.BaseHandler):
-    """urllib2 handler that presets the use of HTTP Basic Auth."""
+    """urllib2 handler that presets the use of HTTP Basic Auth.
+
+    The credentials aren't preset if the cookie jar already has a session
+    for the server, unless they were given with ``reset``. With a
+    SharedCookieJar, the jar's login lock is held from a preset request
+    until ``end_login`` is called, once the new session has been saved.
+    Other processes about to log in wait for it, and then use the saved
+    session rather than logging in again.
+    """
     handler_order = 480  # After Basic auth
 
-    def __init__(self, url, password_mgr):
+    def __init__(self, url, password_mgr, cookie_jar=None):
         self.url = url
         self.password_mgr = password_mgr
+        self.cookie_jar = cookie_jar
         self.used = False
+        self.forced = False
+        self._lock = threading.Lock()
+        self._login_state = threading.local()
 
     def reset(self, username, password):
-        self.password_mgr.rb_user = username
-        self.password_mgr.rb_pass = password
-        self.used = False
+        self._lock.acquire()
+
+        try:
+            self.password_mgr.rb_user = username
+            self.password_mgr.rb_pass = password
+            self.used = False
+            self.forced = True
+        finally:
+            self._lock.release()
 
     def http_request(self, request):
-        if not self.used and self.password_mgr.rb_user:
+        # Only the first request made should preset the credentials, even
+        # when several requests are being made at once.
+        self._lock.acquire()
+
+        try:
+            use_preset = not self.used and self.password_mgr.rb_user
+            self.used = self.used or bool(use_preset)
+            forced = self.forced
+            self.forced = False
+        finally:
+            self._lock.release()
+
+        if use_preset and not forced and self.cookie_jar is not None:
+            use_preset = self._begin_login(request)
+
+        if use_preset:
             # Note that we call password_mgr.find_user_password to get the
             # username and password we're working with.
             username, password = \
@@ -154,12 +497,38 @@ class PresetHTTPAuthHandler(urllib2.BaseHandler):
             request.add_header(
                 urllib2.HTTPBasicAuthHandler.auth_header,
                 'Basic %s' % base64.b64encode(raw).strip())
-            self.used = True
 
         return request
 
     https_request = http_request
 
+    def end_login(self):
+        """Let other processes log in, if this thread was logging in."""
+        if getattr(self._login_state, 'locked', False):
+            self._login_state.locked = False
+            self.cookie_jar.login_lock.release()
+
+    def _begin_login(self, request):
+        """Return whether a request should log in with the preset
+        credentials.
+
+        The request doesn't need to if the cookie jar has a session for
+        it, which may have been saved by another process.
+        """
+        if not isinstance(self.cookie_jar, SharedCookieJar):
+            return _get_session_cookie(self.cookie_jar, request) is None
+
+        self.cookie_jar.login_lock.acquire()
+        self.cookie_jar.refresh()
+
+        if _get_session_cookie(self.cookie_jar, request) is not None:
+            self.cookie_jar.login_lock.release()
+            return False
+
+        self._login_state.locked = True
+
+        return True
+
 
 class ReviewBoardHTTPErrorProcessor(urllib2.HTTPErrorProcessor):
     """Processes HTTP error codes.
@@ -179,6 +548,19 @@ class ReviewBoardHTTPErrorProcessor(urllib2.HTTPErrorProcessor):
     https_response = http_response
 
 
+class _BasicAuthState(threading.local):
+    """The retry state of a ReviewBoardHTTPBasicAuthHandler.
+
+    Each thread gets its own copy, so that concurrent requests made
+    through the same handler don't interfere with each other's retries.
+    """
+    def __init__(self):
+        self.retried = False
+        self.lasturl = ""
+        self.needs_otp_token = False
+        self.otp_token_attempts = 0
+
+
 class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
     """Custom Basic Auth handler that doesn't retry excessively.
 
@@ -196,32 +578,104 @@ class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
     OTP_TOKEN_HEADER = 'X-ReviewBoard-OTP'
     MAX_OTP_TOKEN_ATTEMPTS = 5
 
-    def __init__(self, *args, **kwargs):
-        urllib2.HTTPBasicAuthHandler.__init__(self, *args, **kwargs)
-        self._retried = False
-        self._lasturl = ""
-        self._needs_otp_token = False
-        self._otp_token_attempts = 0
+    def __init__(self, password_mgr=None, cookie_jar=None):
+        urllib2.HTTPBasicAuthHandler.__init__(self, password_mgr)
+        self.cookie_jar = cookie_jar
+        self._state = _BasicAuthState()
 
     def retry_http_basic_auth(self, host, request, realm, *args, **kwargs):
-        if self._lasturl != host:
-            self._retried = False
+        state = self._state
+
+        if state.lasturl != host:
+            state.retried = False
 
-        self._lasturl = host
+        state.lasturl = host
 
-        if self._retried:
+        if state.retried:
             return None
 
-        self._retried = True
+        state.retried = True
+
+        response = self._retry_with_shared_session(request)
 
-        response = self._do_http_basic_auth(host, request, realm)
+        if response is None:
+            response = self._login(host, request, realm)
 
         if response and response.code != httplib.UNAUTHORIZED:
-            self._retried = False
+            state.retried = False
 
         return response
 
+    def _login(self, host, request, realm):
+        """Log in with Basic auth, and save the new session.
+
+        When the credentials were given up front, the cookie file's login
+        lock is held while logging in. Other processes and threads that
+        need to log in wait for it, and then retry with the saved session
+        instead. The lock isn't taken when the user has to be prompted for
+        credentials, so that others don't wait on the prompt.
+        """
+        lock = None
+
+        if (isinstance(self.cookie_jar, SharedCookieJar) and
+            getattr(self.passwd, 'rb_user', None) is not None and
+            getattr(self.passwd, 'rb_pass', None) is not None):
+            lock = self.cookie_jar.login_lock
+            lock.acquire()
+
+        try:
+            if lock is not None:
+                response = self._retry_with_shared_session(request)
+
+                if response is not None:
+                    return response
+
+            response = self._do_http_basic_auth(host, request, realm)
+
+            if (response and response.code != httplib.UNAUTHORIZED and
+                isinstance(self.cookie_jar, SharedCookieJar)):
+                # Share the new session with other processes right away.
+                try:
+                    self.cookie_jar.save()
+                except IOError:
+                    pass
+
+            return response
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _retry_with_shared_session(self, request):
+        """Retry a request using a session saved since it was sent.
+
+        If another process or thread has logged in since the request was
+        sent, the cookie jar has a different session, and the request is
+        retried with it before falling back to logging in.
+        """
+        if isinstance(self.cookie_jar, SharedCookieJar):
+            self.cookie_jar.refresh()
+
+        session = _get_session_cookie(self.cookie_jar, request)
+
+        if session is None or session == _get_request_session(request):
+            return None
+
+        logging.debug('Retrying %s with the session from %s',
+                      request.get_full_url(), self.cookie_jar.filename)
+
+        # Let the cookie processor add the new cookies.
+        request.unredirected_hdrs.pop('Cookie', None)
+
+        try:
+            return self.parent.open(request, timeout=request.timeout)
+        except urllib2.HTTPError, e:
+            if e.code == httplib.UNAUTHORIZED:
+                return None
+
+            raise
+
     def _do_http_basic_auth(self, host, request, realm):
+        state = self._state
         user, password = self.passwd.find_user_password(realm, host)
 
         if password is None:
@@ -231,8 +685,8 @@ class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
         auth = 'Basic %s' % base64.b64encode(raw).strip()
 
         if (request.headers.get(self.auth_header, None) == auth and
-            (not self._needs_otp_token or
-             self._otp_token_attempts > self.MAX_OTP_TOKEN_ATTEMPTS)):
+            (not state.needs_otp_token or
+             state.otp_token_attempts > self.MAX_OTP_TOKEN_ATTEMPTS)):
             # We've already tried with these credentials. No point
             # trying again.
             return None
@@ -248,7 +702,7 @@ class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
                 otp_header = headers.get(self.OTP_TOKEN_HEADER, '')
 
                 if otp_header.startswith('required'):
-                    self._needs_otp_token = True
+                    state.needs_otp_token = True
 
                     # The server has requested a one-time password token, sent
                     # through an external channel (cell phone or application).
@@ -263,7 +717,7 @@ class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
 
                     request.add_unredirected_header(self.OTP_TOKEN_HEADER,
                                                     token)
-                    self._otp_token_attempts += 1
+                    state.otp_token_attempts += 1
 
                     return self._do_http_basic_auth(host, request, realm)
 
@@ -291,16 +745,28 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
         self.auth_callback = auth_callback
         self.otp_token_callback = otp_token_callback
 
+        # Requests may be made concurrently, so the callback is only
+        # called by one of them at a time. The others wait, and then call
+        # it with the credentials the first one provided, so it doesn't
+        # need to prompt again.
+        self._auth_lock = threading.Lock()
+
     def find_user_password(self, realm, uri):
         if realm == 'Web API':
-            if self.auth_callback:
-                username, password = self.auth_callback(realm, uri,
-                                                        username=self.rb_user,
-                                                        password=self.rb_pass)
-                self.rb_user = username
-                self.rb_pass = password
-
-            return self.rb_user, self.rb_pass
+            self._auth_lock.acquire()
+
+            try:
+                if self.auth_callback:
+                    username, password = self.auth_callback(
+                        realm, uri,
+                        username=self.rb_user,
+                        password=self.rb_pass)
+                    self.rb_user = username
+                    self.rb_pass = password
+
+                return self.rb_user, self.rb_pass
+            finally:
+                self._auth_lock.release()
         else:
             # If this is an auth request for some other domain (since HTTP
             # handlers are global), fall back to standard password management.
@@ -311,6 +777,131 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
             return self.otp_token_callback(uri, method)
 
 
+class SharedCookieJar(cookielib.MozillaCookieJar):
+    """A cookie jar whose file can be shared between processes.
+
+    The cookie file is locked while it's loaded or saved, and saving
+    atomically replaces it, so concurrent RBTools processes never read a
+    partially written file.
+
+    Cookies saved by other processes since this jar last read the file
+    are merged in when saving, rather than being discarded. The file's
+    copy of a cookie wins, unless this jar has changed the cookie since
+    then, so a process can't overwrite a newer session with its own
+    stale one.
+    """
+    def __init__(self, filename, *args, **kwargs):
+        cookielib.MozillaCookieJar.__init__(self, filename, *args, **kwargs)
+        self.file_lock = get_file_lock(filename)
+
+        # Held while logging in, so that processes sharing the file log in
+        # one at a time, and can use each other's sessions.
+        self.login_lock = get_file_lock(filename + '.login')
+        self._stamp = None
+
+        # The cookies as they were when the file was last loaded or saved.
+        self._synced = {}
+
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+
+        self.file_lock.acquire()
+
+        try:
+            cookielib.MozillaCookieJar.load(self, filename, ignore_discard,
+                                            ignore_expires)
+            self._stamp = get_file_stamp(filename)
+            self._synced = self._get_cookie_values()
+        finally:
+            self.file_lock.release()
+
+    def save(self, filename=None, ignore_discard=False, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+
+        self.file_lock.acquire()
+
+        try:
+            if get_file_stamp(filename) != self._stamp:
+                self._merge_file(filename)
+
+            tmpfile = make_atomic_tempfile(filename)
+
+            try:
+                cookielib.MozillaCookieJar.save(self, tmpfile, ignore_discard,
+                                                ignore_expires)
+                os.chmod(tmpfile, 0600)
+                replace_file(tmpfile, filename)
+            except:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+
+                raise
+
+            self._stamp = get_file_stamp(filename)
+            self._synced = self._get_cookie_values()
+        finally:
+            self.file_lock.release()
+
+    def refresh(self):
+        """Load any cookies saved by other processes.
+
+        Cookies in the file replace those in the jar. Returns True if
+        the file had changed since it was last loaded or saved.
+        """
+        self.file_lock.acquire()
+
+        try:
+            if get_file_stamp(self.filename) == self._stamp:
+                return False
+
+            try:
+                self.load(ignore_expires=True)
+            except IOError:
+                return False
+
+            return True
+        finally:
+            self.file_lock.release()
+
+    def _get_cookie_values(self):
+        """Return the value and expiry of each cookie, by key."""
+        return dict(((cookie.domain, cookie.path, cookie.name),
+                     (cookie.value, cookie.expires))
+                    for cookie in self)
+
+    def _merge_file(self, filename):
+        """Merge in the cookies from the file.
+
+        A cookie this jar has set or removed since the file was last
+        synced is kept as it is. Otherwise, the file's version of the
+        cookie replaces the jar's, and cookies removed from the file are
+        removed from the jar.
+        """
+        file_jar = cookielib.MozillaCookieJar()
+
+        try:
+            file_jar.load(filename, ignore_expires=True)
+        except IOError:
+            return
+
+        current = self._get_cookie_values()
+        file_keys = set()
+
+        for cookie in file_jar:
+            key = (cookie.domain, cookie.path, cookie.name)
+            file_keys.add(key)
+
+            if current.get(key) == self._synced.get(key):
+                self.set_cookie(cookie)
+
+        for key, value in current.iteritems():
+            if (key not in file_keys and key in self._synced and
+                value == self._synced[key]):
+                self.clear(*key)
+
+
 def create_cookie_jar(cookie_file=None):
     """Return a cookie jar backed by cookie_file
 
@@ -323,29 +914,42 @@ def create_cookie_jar(cookie_file=None):
     """
     home_path = get_home_path()
 
+    post_review_cookies = None
+
     if not cookie_file:
         cookie_file = os.path.join(home_path, RBTOOLS_COOKIE_FILE)
         post_review_cookies = os.path.join(home_path,
                                            '.post-review-cookies.txt')
 
-        if (not os.path.isfile(cookie_file) and
+    # Other processes may be creating the file at the same time.
+    lock = get_file_lock(cookie_file)
+    lock.acquire()
+
+    try:
+        if (post_review_cookies and
+            not os.path.isfile(cookie_file) and
             os.path.isfile(post_review_cookies)):
                 try:
-                    shutil.copyfile(post_review_cookies, cookie_file)
-                    os.chmod(cookie_file, 0600)
-                except IOError, e:
+                    tmpfile = make_atomic_tempfile(cookie_file)
+                    shutil.copyfile(post_review_cookies, tmpfile)
+                    os.chmod(tmpfile, 0600)
+                    replace_file(tmpfile, cookie_file)
+                except (IOError, OSError), e:
                     logging.warning("There was an error while copying "
                                     "post-review's cookies: %s" % e)
 
-    if not os.path.isfile(cookie_file):
-        try:
-            open(cookie_file, 'w').close()
-            os.chmod(cookie_file, 0600)
-        except IOError, e:
-            logging.warning("There was an error while creating a "
-                            "cookie file: %s" % e)
+        if not os.path.isfile(cookie_file):
+            try:
+                os.close(os.open(cookie_file,
+                                 os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0600))
+            except (IOError, OSError), e:
+                logging.warning("There was an error while creating a "
+                                "cookie file: %s" % e)
+    finally:
+        lock.release()
 
-    return cookielib.MozillaCookieJar(cookie_file), cookie_file
+    return SharedCookieJar(cookie_file), cookie_file
 
 
 class ReviewBoardServer(object):
@@ -359,10 +963,15 @@ class ReviewBoardServer(object):
     be passed the realm, and url of the Review Board server and should
     return a 2-tuple of username, password. The user can be prompted
     for their credentials using this mechanism.
+
+    The ``connect_timeout`` and ``read_timeout`` parameters give the number
+    of seconds to wait for a connection to the server, and for data from
+    it. By default, requests will wait indefinitely.
     """
     def __init__(self, url, cookie_file=None, username=None, password=None,
                  agent=None, session=None, disable_proxy=False,
-                 auth_callback=None, otp_token_callback=None):
+                 auth_callback=None, otp_token_callback=None,
+                 connect_timeout=None, read_timeout=None):
         self.url = url
         if self.url[-1] != '/':
             self.url += '/'
@@ -412,16 +1021,22 @@ class ReviewBoardServer(object):
                                                   auth_callback,
                                                   otp_token_callback)
         self.preset_auth_handler = PresetHTTPAuthHandler(self.url,
-                                                         password_mgr)
+                                                         password_mgr,
+                                                         self.cookie_jar)
 
         handlers = []
 
         if disable_proxy:
             handlers.append(urllib2.ProxyHandler({}))
 
+        handlers.append(TimeoutHTTPHandler(connect_timeout, read_timeout))
+
+        if TimeoutHTTPSHandler:
+            handlers.append(TimeoutHTTPSHandler(connect_timeout, read_timeout))
+
         handlers += [
             urllib2.HTTPCookieProcessor(self.cookie_jar),
-            ReviewBoardHTTPBasicAuthHandler(password_mgr),
+            ReviewBoardHTTPBasicAuthHandler(password_mgr, self.cookie_jar),
             urllib2.HTTPDigestAuthHandler(password_mgr),
             self.preset_auth_handler,
             ReviewBoardHTTPErrorProcessor(),
@@ -432,11 +1047,13 @@ class ReviewBoardServer(object):
         else:
             self.agent = 'RBTools/' + get_package_version()
 
-        opener = urllib2.build_opener(*handlers)
-        opener.addheaders = [
+        # The opener is owned by this server, rather than installed
+        # globally, so that separate servers in the same process don't
+        # share cookies or credentials.
+        self._opener = urllib2.build_opener(*handlers)
+        self._opener.addheaders = [
             ('User-agent', self.agent),
         ]
-        urllib2.install_opener(opener)
 
     def login(self, username, password):
         """Reset the user information"""
@@ -459,31 +1076,68 @@ class ReviewBoardServer(object):
             logging.debug('Got HTTP error: %s: %s' % (http_status, data))
             raise APIError(http_status, None, None, data)
 
-    def make_request(self, request):
+    def make_request(self, request, deadline=None):
         """Perform an http request.
 
         The request argument should be an instance of
         'rbtools.api.request.HttpRequest'.
+
+        If a Deadline is provided, the request (including any retries for
+        authentication) must complete before it expires, or a
+        ServerTimeoutError will be raised.
         """
+        if deadline is not None and deadline.has_expired():
+            raise create_timeout_error(request.url, deadline)
+
+        try:
+            return self._send_request(request, deadline)
+        finally:
+            # If the request logged in, its session has been saved by now,
+            # so other processes waiting to log in can use it.
+            self.preset_auth_handler.end_login()
+
+    def _send_request(self, request, deadline):
+        """Send a request, and save any cookies set by the server."""
         try:
-            content_type, body = request.encode_multipart_formdata()
+            # The body is spooled to disk if it's large, such as when
+            # uploading a big diff.
+            body = SpooledBuffer()
+            content_type = request.write_multipart_formdata(body)
             headers = request.headers
 
-            if body:
+            if content_type:
                 headers.update({
                     'Content-Type': content_type,
                     'Content-Length': str(len(body)),
                 })
             else:
+                body = None
                 headers['Content-Length'] = "0"
 
             r = Request(request.url.encode('utf-8'), body, headers,
                         request.method)
-            rsp = urllib2.urlopen(r)
+            r.deadline = deadline
+            rsp = self._opener.open(r)
         except urllib2.HTTPError, e:
-            self.process_error(e.code, e.read())
+            try:
+                data = e.read()
+            except socket.error, read_error:
+                if is_timeout_error(read_error):
+                    raise create_timeout_error(request.url, deadline)
+
+                raise
+
+            self.process_error(e.code, data)
         except urllib2.URLError, e:
+            if is_timeout_error(e.reason):
+                raise create_timeout_error(request.url, deadline)
+
             raise ServerInterfaceError("%s" % e.reason)
+        except socket.error, e:
+            if is_timeout_error(e):
+                raise create_timeout_error(request.url, deadline)
+
+            raise ServerInterfaceError("%s" % e)
 
         try:
             self.cookie_jar.save()
@@ -12,7 +12,7 @@ _EXCLUDE_ATTRS = [LINKS_TOK, 'stat']
 
 
 @request_method_decorator
-def _create(resource, data={}, query_args={}, *args, **kwargs):
+def _create(resource, data=None, query_args={}, *args, **kwargs):
     """Generate a POST request on a resource.
 
     Unlike other methods, any additional query args must be passed in
@@ -22,6 +22,9 @@ def _create(resource, data={}, query_args={}, *args, **kwargs):
     request = HttpRequest(resource._links['create']['href'], method='POST',
                           query_args=query_args)
 
+    # Copy the fields, so that neither the caller's dictionary nor a
+    # shared default is modified.
+    data = dict(data or {})
     data.update(kwargs)
 
     for name, value in data.iteritems():
@@ -44,7 +47,7 @@ def _get_self(resource, *args, **kwargs):
 
 
 @request_method_decorator
-def _update(resource, data={}, query_args={}, *args, **kwargs):
+def _update(resource, data=None, query_args={}, *args, **kwargs):
     """Generate a PUT request on a resource.
 
     Unlike other methods, any additional query args must be passed in
@@ -54,6 +57,9 @@ def _update(resource, data={}, query_args={}, *args, **kwargs):
     request = HttpRequest(resource._links['update']['href'], method='PUT',
                           query_args=query_args)
 
+    # Copy the fields, so that neither the caller's dictionary nor a
+    # shared default is modified.
+    data = dict(data or {})
     data.update(kwargs)
 
     for name, value in data.iteritems():
@@ -95,10 +101,12 @@ class Resource(object):
     """
     _excluded_attrs = []
 
-    def __init__(self, transport, payload, url, token=None, **kwargs):
+    def __init__(self, transport, payload, url, token=None, deadline=None,
+                 **kwargs):
         self._url = url
         self._transport = transport
         self._token = token
+        self._deadline = deadline
         self._payload = payload
         self._excluded_attrs = self._excluded_attrs + _EXCLUDE_ATTRS
 
@@ -313,7 +321,8 @@ class CountResource(ItemResource):
     """
     def __init__(self, transport, payload, url, **kwargs):
         super(CountResource, self).__init__(transport, payload, url,
-                                            token=None)
+                                            token=None,
+                                            deadline=kwargs.get('deadline'))
 
     @request_method_decorator
     def get_self(self, **kwargs):
@@ -384,7 +393,8 @@ class ListResource(Resource):
                                payload,
                                url,
                                mime_type=self._item_mime_type,
-                               guess_token=False)
+                               guess_token=False,
+                               deadline=self._deadline)
 
     def __iter__(self):
         for i in xrange(self.num_items):
@@ -433,7 +443,8 @@ class RootResource(ItemResource):
     _TEMPLATE_PARAM_RE = re.compile('\{(?P<key>[A-Za-z_0-9]*)\}')
 
     def __init__(self, transport, payload, url, **kwargs):
-        super(RootResource, self).__init__(transport, payload, url, token=None)
+        super(RootResource, self).__init__(transport, payload, url, token=None,
+                                           deadline=kwargs.get('deadline'))
         # Generate methods for accessing resources directly using
         # the uri-templates.
         for name, url in payload['uri_templates'].iteritems():
@@ -479,8 +490,10 @@ class DiffListResource(ListResource):
                     base_commit_id=None, **kwargs):
         """Uploads a new diff.
 
-        The diff and parent_diff arguments should be strings containing
-        the diff output.
+        The diff and parent_diff arguments should be strings, DiffSets or
+        file-like objects containing the diff output. DiffSets and files
+        are written into the request body piece by piece, which is spooled
+        to disk when large.
         """
         request = HttpRequest(self._url, method='POST', query_args=kwargs)
         request.add_file('path', 'diff', diff)
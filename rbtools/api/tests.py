@@ -1,9 +1,22 @@
+import BaseHTTPServer
+import SocketServer
+import base64
+import cookielib
+import os
 import re
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+from StringIO import StringIO
 
 from rbtools.api.capabilities import Capabilities
 from rbtools.api.factory import create_resource
-from rbtools.api.request import HttpRequest
+from rbtools.api.errors import ServerTimeoutError
+from rbtools.api.request import (Deadline, HttpRequest, Request,
+                                 ReviewBoardServer, SharedCookieJar)
 from rbtools.api.resource import (CountResource,
                                   ItemResource,
                                   ListResource,
@@ -11,6 +24,9 @@ from rbtools.api.resource import (CountResource,
                                   ResourceLinkField,
                                   RootResource)
 from rbtools.api.transport import Transport
+from rbtools.api.transport.sync import SyncTransport
+from rbtools.utils.diffs import DiffSet
+from rbtools.utils.filesystem import SpooledBuffer
 
 
 class CapabilitiesTests(unittest.TestCase):
@@ -393,3 +409,439 @@ class HttpRequestTests(unittest.TestCase):
             d[m.group(1)] = v
 
         self.assertEquals(d, {'foo': 'bar', 'bar': '42', 'name': 'somestring'})
+
+    def test_post_form_data_diff_set(self):
+        """Testing the multipart form data generation with a DiffSet"""
+        diff = DiffSet()
+        diff.start_file('README')
+        diff.extend(['--- README\n', '+++ README\n'])
+
+        request = HttpRequest('/', 'POST')
+        request.add_file('path', 'diff', diff)
+
+        ctype, content = request.encode_multipart_formdata()
+        self.assertTrue('\r\n\r\n--- README\n+++ README\n\r\n--' in content)
+
+    def test_request_spooled_body(self):
+        """Testing that a spooled request body is re-read for each send"""
+        body = SpooledBuffer()
+        request = HttpRequest('/', 'POST')
+        request.add_file('path', 'diff', StringIO('--- README\n'))
+        request.write_multipart_formdata(body)
+
+        r = Request('http://localhost/', body, {}, 'POST')
+        data = r.get_data().read()
+        self.assertTrue('--- README\n' in data)
+        self.assertEqual(r.get_data().read(), data)
+
+
+class LoginCountingServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """An HTTP server which counts the logins made with Basic auth.
+
+    Requests need a session cookie from a login, or they fail with HTTP
+    401. Logging in is slow, so that concurrent clients overlap.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           LoginCountingHandler)
+        self.logins = 0
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class LoginCountingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    AUTH = 'Basic %s' % base64.b64encode('user:pass')
+
+    def do_GET(self):
+        server = self.server
+        cookie = self.headers.get('Cookie', '')
+        session = cookie.partition('rbsessionid=')[2].split(';')[0]
+        headers = []
+
+        if session not in server.sessions:
+            if self.headers.get('Authorization') != self.AUTH:
+                self.send_response(401)
+                self.send_header('WWW-Authenticate', 'Basic realm="Web API"')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            time.sleep(0.2)
+            server.lock.acquire()
+
+            try:
+                server.logins += 1
+                session = 'session%d' % server.logins
+                server.sessions.add(session)
+            finally:
+                server.lock.release()
+
+            expires = time.strftime('%a, %d-%b-%Y %H:%M:%S GMT',
+                                    time.gmtime(time.time() + 3600))
+            headers.append(('Set-Cookie', 'rbsessionid=%s; expires=%s; Path=/'
+                            % (session, expires)))
+
+        body = '{"stat": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+
+        for header in headers:
+            self.send_header(*header)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReviewBoardServerTests(unittest.TestCase):
+    """Tests for rbtools.api.request.ReviewBoardServer"""
+    def setUp(self):
+        fd, self.cookie_file = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        for path in (self.cookie_file, self.cookie_file + '.lock',
+                     self.cookie_file + '.login.lock'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_concurrent_logins(self):
+        """Testing ReviewBoardServer logging in once for concurrent clients
+        """
+        self.assertEqual(self._make_concurrent_requests(), 1)
+
+    def test_concurrent_logins_stale_session(self):
+        """Testing ReviewBoardServer logging in once for concurrent clients
+        with an expired session
+        """
+        jar = cookielib.MozillaCookieJar(self.cookie_file)
+        jar.set_cookie(cookielib.Cookie(
+            version=0, name='rbsessionid', value='stale', port=None,
+            port_specified=False, domain='127.0.0.1',
+            domain_specified=False, domain_initial_dot=False, path='/',
+            path_specified=True, secure=False,
+            expires=int(time.time()) + 3600, discard=False, comment=None,
+            comment_url=None, rest={}))
+        jar.save()
+
+        # The saved session isn't valid on the server, so the clients
+        # skip the preset credentials, get HTTP 401, and then log in.
+        self.assertEqual(self._make_concurrent_requests(), 1)
+
+    def _make_concurrent_requests(self, num_clients=5):
+        """Make a request from several clients at once.
+
+        Each client has its own cookie jar for the same file, as if it
+        were in its own process. The number of logins is returned.
+        """
+        http_server = LoginCountingServer()
+        server_thread = threading.Thread(target=http_server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        errors = []
+
+        def request():
+            try:
+                server = ReviewBoardServer(http_server.url,
+                                           cookie_file=self.cookie_file,
+                                           username='user', password='pass')
+                rsp = server.make_request(
+                    HttpRequest(http_server.url + 'api/'))
+                rsp.read()
+            except Exception, e:
+                errors.append(e)
+
+        try:
+            threads = [threading.Thread(target=request)
+                       for i in range(num_clients)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+        self.assertEqual(errors, [])
+
+        return http_server.logins
+
+    def test_per_instance_opener(self):
+        """Testing ReviewBoardServer keeps its opener to itself"""
+        class TestHandler(urllib2.BaseHandler):
+            def rbtest_open(self, request):
+                return 'installed'
+
+        urllib2.install_opener(urllib2.build_opener(TestHandler))
+
+        try:
+            server1 = ReviewBoardServer('http://rb1.example.com/',
+                                        cookie_file=self.cookie_file,
+                                        username='user1')
+            server2 = ReviewBoardServer('http://rb2.example.com/',
+                                        cookie_file=self.cookie_file,
+                                        username='user2')
+
+            # The globally installed opener is still the one used by
+            # urlopen.
+            self.assertEqual(urllib2.urlopen('rbtest://example.com/'),
+                             'installed')
+        finally:
+            urllib2.install_opener(None)
+
+        self.assertTrue(server1._opener is not server2._opener)
+        self.assertEqual(server1.preset_auth_handler.password_mgr.rb_user,
+                         'user1')
+        self.assertEqual(server2.preset_auth_handler.password_mgr.rb_user,
+                         'user2')
+
+
+class SharedCookieJarTests(unittest.TestCase):
+    """Tests for rbtools.api.request.SharedCookieJar"""
+    def setUp(self):
+        fd, self.cookie_file = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        for path in (self.cookie_file, self.cookie_file + '.lock'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _make_cookie(self, name, value):
+        return cookielib.Cookie(
+            version=0, name=name, value=value, port=None,
+            port_specified=False, domain='.example.com',
+            domain_specified=True, domain_initial_dot=True, path='/',
+            path_specified=True, secure=False,
+            expires=int(time.time()) + 3600, discard=False,
+            comment=None, comment_url=None, rest={})
+
+    def _get_values(self, jar):
+        return dict((cookie.name, cookie.value) for cookie in jar)
+
+    def test_save_merges_other_cookies(self):
+        """Testing SharedCookieJar.save keeps cookies saved by other jars"""
+        jar1 = SharedCookieJar(self.cookie_file)
+        jar2 = SharedCookieJar(self.cookie_file)
+
+        jar1.set_cookie(self._make_cookie('rbsessionid', 'abc'))
+        jar1.save()
+
+        jar2.set_cookie(self._make_cookie('other', '123'))
+        jar2.save()
+
+        jar3 = SharedCookieJar(self.cookie_file)
+        jar3.load()
+        self.assertEqual(self._get_values(jar3),
+                         {'rbsessionid': 'abc', 'other': '123'})
+
+    def test_save_keeps_newer_cookies(self):
+        """Testing SharedCookieJar.save doesn't overwrite newer cookies"""
+        jar1 = SharedCookieJar(self.cookie_file)
+        jar1.set_cookie(self._make_cookie('rbsessionid', 'old'))
+        jar1.save()
+
+        jar2 = SharedCookieJar(self.cookie_file)
+        jar2.load()
+
+        jar3 = SharedCookieJar(self.cookie_file)
+        jar3.set_cookie(self._make_cookie('rbsessionid', 'new'))
+        jar3.save()
+
+        # jar2 hasn't changed its session, so the newer one is kept.
+        jar2.save()
+        self.assertEqual(self._get_values(jar2), {'rbsessionid': 'new'})
+
+        jar4 = SharedCookieJar(self.cookie_file)
+        jar4.load()
+        self.assertEqual(self._get_values(jar4), {'rbsessionid': 'new'})
+
+        # A session jar2 sets itself replaces the one in the file.
+        jar2.set_cookie(self._make_cookie('rbsessionid', 'newest'))
+        jar3.save()
+        jar2.save()
+
+        jar4.load()
+        self.assertEqual(self._get_values(jar4), {'rbsessionid': 'newest'})
+
+    def test_refresh(self):
+        """Testing SharedCookieJar.refresh loads cookies from other jars"""
+        jar1 = SharedCookieJar(self.cookie_file)
+        jar2 = SharedCookieJar(self.cookie_file)
+        jar2.set_cookie(self._make_cookie('rbsessionid', 'old'))
+        jar2.save()
+        self.assertFalse(jar2.refresh())
+
+        jar1.set_cookie(self._make_cookie('rbsessionid', 'new'))
+        jar1.save()
+
+        self.assertTrue(jar2.refresh())
+        self.assertEqual(self._get_values(jar2), {'rbsessionid': 'new'})
+
+
+class MockResponse(object):
+    """A mock HTTP response for use in transport tests."""
+    def __init__(self, content):
+        self.content = content
+
+    def info(self):
+        return {'Content-Type': 'application/json'}
+
+    def read(self):
+        return self.content
+
+
+class MockServer(object):
+    """A mock ReviewBoardServer which blocks until told to respond."""
+    url = 'http://example.com/api/'
+
+    def __init__(self):
+        self.content = '{"stat": "ok", "foo": {"bar": 1}}'
+        self.requests = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def make_request(self, request, deadline=None):
+        self.requests.append((request, deadline))
+        self.started.set()
+        self.release.wait()
+
+        return MockResponse(self.content)
+
+
+class SyncTransportTests(unittest.TestCase):
+    """Tests for rbtools.api.transport.sync.SyncTransport"""
+    def setUp(self):
+        fd, self.cookie_file = tempfile.mkstemp()
+        os.close(fd)
+
+        self.transport = SyncTransport('http://example.com/',
+                                       cookie_file=self.cookie_file)
+        self.transport.server = MockServer()
+
+    def tearDown(self):
+        for path in (self.cookie_file, self.cookie_file + '.lock'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _get_url_in_thread(self, url, results):
+        thread = threading.Thread(
+            target=lambda: results.append(self.transport.get_url(url)))
+        thread.start()
+
+        return thread
+
+    def test_coalesce_get_requests(self):
+        """Testing SyncTransport coalesces identical concurrent GETs"""
+        server = self.transport.server
+        results = []
+
+        threads = [self._get_url_in_thread('http://example.com/api/foo/',
+                                           results)]
+        server.started.wait()
+        threads += [
+            self._get_url_in_thread('http://example.com/api/foo/', results)
+            for i in range(3)
+        ]
+
+        # Give the other threads time to find the request in flight.
+        time.sleep(0.2)
+        server.release.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(len(results), 4)
+
+        for resource in results:
+            self.assertEqual(resource.bar, 1)
+
+        # Once complete, the request isn't shared with later callers.
+        self.transport.get_url('http://example.com/api/foo/')
+        self.assertEqual(len(server.requests), 2)
+
+    def test_deadline_inherited(self):
+        """Testing SyncTransport passes a deadline on to later requests"""
+        server = self.transport.server
+        server.release.set()
+        server.content = ('{"stat": "ok", "total_results": 2, '
+                          '"links": {"next": '
+                          '{"href": "http://example.com/api/foo/?start=1"}}, '
+                          '"foo": [{"bar": 1}]}')
+
+        resource = self.transport.get_url('http://example.com/api/foo/',
+                                          deadline=30)
+        resource.get_next()
+
+        deadline = server.requests[0][1]
+        self.assertTrue(isinstance(deadline, Deadline))
+        self.assertTrue(server.requests[1][1] is deadline)
+        self.assertEqual(deadline.requests_completed, 2)
+        self.assertEqual(deadline.last_url,
+                         'http://example.com/api/foo/?start=1')
+
+    def test_expired_deadline(self):
+        """Testing ReviewBoardServer.make_request with an expired deadline"""
+        server = ReviewBoardServer('http://example.com/',
+                                   cookie_file=self.cookie_file)
+        deadline = Deadline(0)
+        deadline.request_completed('http://example.com/api/')
+
+        try:
+            server.make_request(HttpRequest('http://example.com/api/foo/'),
+                                deadline)
+            self.fail('ServerTimeoutError was not raised')
+        except ServerTimeoutError, e:
+            self.assertTrue('http://example.com/api/foo/' in str(e))
+            self.assertTrue('1 request(s) had completed' in str(e))
+
+    def test_deadline_while_reading(self):
+        """Testing ReviewBoardServer enforces the deadline while reading"""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        stop = threading.Event()
+
+        def serve():
+            conn = listener.accept()[0]
+
+            try:
+                conn.recv(4096)
+                conn.sendall('HTTP/1.0 200 OK\r\n'
+                             'Content-Type: application/json\r\n'
+                             'Content-Length: 1000\r\n\r\n')
+
+                # Each byte arrives well within the read timeout, but the
+                # whole response would take far longer than the deadline.
+                while not stop.wait(0.05):
+                    conn.sendall(' ')
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        try:
+            url = 'http://127.0.0.1:%d/' % listener.getsockname()[1]
+            server = ReviewBoardServer(url, cookie_file=self.cookie_file,
+                                       read_timeout=5)
+            start = time.time()
+            rsp = server.make_request(HttpRequest(url + 'api/'),
+                                      Deadline(0.5))
+
+            self.assertRaises(socket.timeout, rsp.read)
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            stop.set()
+            thread.join()
+            listener.close()
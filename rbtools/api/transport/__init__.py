@@ -38,5 +38,12 @@ class Transport(object):
         raise NotImplementedError
 
     def execute_request_method(self, method, *args, **kwargs):
-        """Execute a method and carry out the returned HttpRequest."""
+        """Execute a method and carry out the returned HttpRequest.
+
+        A ``deadline`` argument may be passed, giving the time allowed
+        for the request (and any requests made through the resulting
+        resource). Transports which don't support deadlines ignore it.
+        """
+        kwargs.pop('deadline', None)
+
         return method(*args, **kwargs)
@@ -1,11 +1,23 @@
 import logging
+import socket
+import sys
+import threading
 
 from rbtools.api.decode import decode_response
 from rbtools.api.factory import create_resource
-from rbtools.api.request import HttpRequest, ReviewBoardServer
+from rbtools.api.request import (create_timeout_error, Deadline, HttpRequest,
+                                 is_timeout_error, ReviewBoardServer)
 from rbtools.api.transport import Transport
 
 
+class _InFlightRequest(object):
+    """A GET request being made on behalf of one or more callers."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
 class SyncTransport(Transport):
     """A synchronous transport layer for the API client.
 
@@ -18,10 +30,25 @@ class SyncTransport(Transport):
 
     The optional session can be used to specify an 'rbsessionid'
     to use when authenticating with reviewboard.
+
+    The optional connect_timeout and read_timeout give the number of
+    seconds to wait for a connection to the server and for data from it.
+    The optional deadline gives the total number of seconds allowed for
+    all requests made through the transport. A deadline can also be
+    given for a single operation by passing a ``deadline`` argument (a
+    number of seconds or a Deadline) to any request method. It will also
+    apply to requests made through the resulting resource, such as for
+    further pages of a list.
+
+    The transport may be used from several threads at once. Identical
+    GET requests made at the same time are coalesced, so that only one
+    of them is sent to the server and all callers share its response.
     """
     def __init__(self, url, cookie_file=None, username=None, password=None,
                  agent=None, session=None, disable_proxy=False,
-                 auth_callback=None, otp_token_callback=None, *args, **kwargs):
+                 auth_callback=None, otp_token_callback=None,
+                 connect_timeout=None, read_timeout=None, deadline=None,
+                 *args, **kwargs):
         super(SyncTransport, self).__init__(url, *args, **kwargs)
         self.server = ReviewBoardServer(self.url,
                                         cookie_file=cookie_file,
@@ -30,12 +57,25 @@ class SyncTransport(Transport):
                                         session=session,
                                         disable_proxy=disable_proxy,
                                         auth_callback=auth_callback,
-                                        otp_token_callback=otp_token_callback)
+                                        otp_token_callback=otp_token_callback,
+                                        connect_timeout=connect_timeout,
+                                        read_timeout=read_timeout)
+
+        if deadline is not None:
+            self.deadline = Deadline(deadline)
+        else:
+            self.deadline = None
 
-    def get_root(self):
-        return self._execute_request(HttpRequest(self.server.url))
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def get_root(self, deadline=None):
+        return self._execute_request(HttpRequest(self.server.url),
+                                     self._get_deadline(deadline))
 
     def get_path(self, path, *args, **kwargs):
+        deadline = self._get_deadline(kwargs.pop('deadline', None))
+
         if not path.endswith('/'):
             path = path + '/'
 
@@ -43,39 +83,130 @@ class SyncTransport(Transport):
             path = path[1:]
 
         return self._execute_request(
-            HttpRequest(self.server.url + path, query_args=kwargs))
+            HttpRequest(self.server.url + path, query_args=kwargs),
+            deadline)
 
     def get_url(self, url, *args, **kwargs):
+        deadline = self._get_deadline(kwargs.pop('deadline', None))
+
         if not url.endswith('/'):
             url = url + '/'
 
-        return self._execute_request(HttpRequest(url, query_args=kwargs))
+        return self._execute_request(HttpRequest(url, query_args=kwargs),
+                                     deadline)
 
     def login(self, username, password):
         self.server.login(username, password)
 
     def execute_request_method(self, method, *args, **kwargs):
+        deadline = self._get_deadline(kwargs.pop('deadline', None))
         request = method(*args, **kwargs)
 
         if isinstance(request, HttpRequest):
-            return self._execute_request(request)
+            return self._execute_request(request, deadline)
 
         return request
 
-    def _execute_request(self, request):
+    def _get_deadline(self, deadline):
+        """Return the Deadline to use for a request.
+
+        The deadline may be given as a Deadline or a number of seconds.
+        If not given, the transport's own deadline is used.
+        """
+        if deadline is None:
+            return self.deadline
+        elif isinstance(deadline, Deadline):
+            return deadline
+        else:
+            return Deadline(deadline)
+
+    def _execute_request(self, request, deadline=None):
         """Execute an HTTPRequest and construct a resource from the payload"""
+        if request.method == 'GET':
+            result = self._coalesce_request(request, deadline)
+        else:
+            result = self._fetch_payload(request, deadline)
+
+        payload, mime_type, item_content_type = result
+
+        return create_resource(self, payload, request.url, mime_type=mime_type,
+                               item_mime_type=item_content_type,
+                               deadline=deadline)
+
+    def _coalesce_request(self, request, deadline=None):
+        """Fetch the payload for a GET request, sharing it with other callers.
+
+        If an identical request is already in flight, this waits for its
+        result instead of making a new request.
+        """
+        key = (request.url, tuple(sorted(request.headers.iteritems())))
+
+        self._in_flight_lock.acquire()
+
+        try:
+            in_flight = self._in_flight.get(key)
+            is_leader = in_flight is None
+
+            if is_leader:
+                in_flight = _InFlightRequest()
+                self._in_flight[key] = in_flight
+        finally:
+            self._in_flight_lock.release()
+
+        if is_leader:
+            try:
+                in_flight.result = self._fetch_payload(request, deadline)
+            except:
+                in_flight.exc_info = sys.exc_info()
+
+            self._in_flight_lock.acquire()
+
+            try:
+                del self._in_flight[key]
+            finally:
+                self._in_flight_lock.release()
+
+            in_flight.done.set()
+        else:
+            logging.debug('Waiting for in-flight HTTP GET request to %s'
+                          % request.url)
+
+            # Waiting with a timeout keeps the thread responsive to
+            # KeyboardInterrupt, and lets it give up at its own deadline.
+            while not in_flight.done.wait(0.1):
+                if deadline is not None and deadline.has_expired():
+                    raise create_timeout_error(request.url, deadline)
+
+        if in_flight.exc_info:
+            raise in_flight.exc_info[0], in_flight.exc_info[1], \
+                in_flight.exc_info[2]
+
+        return in_flight.result
+
+    def _fetch_payload(self, request, deadline=None):
+        """Make a request and return its decoded payload and mime types."""
         logging.debug('Making HTTP %s request to %s' % (request.method,
                                                         request.url))
 
-        rsp = self.server.make_request(request)
+        rsp = self.server.make_request(request, deadline)
         info = rsp.info()
         mime_type = info['Content-Type']
         item_content_type = info.get('Item-Content-Type', None)
-        payload = rsp.read()
+
+        try:
+            payload = rsp.read()
+        except socket.error, e:
+            if is_timeout_error(e):
+                raise create_timeout_error(request.url, deadline)
+
+            raise
+
+        if deadline is not None:
+            deadline.request_completed(request.url)
+
         payload = decode_response(payload, mime_type)
 
-        return create_resource(self, payload, request.url, mime_type=mime_type,
-                               item_mime_type=item_content_type)
+        return payload, mime_type, item_content_type
 
     def __repr__(self):
         return '<%s(url=%r, cookie_file=%r, agent=%r)>' % (
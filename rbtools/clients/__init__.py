@@ -1,13 +1,44 @@
 import logging
+import os
 import pkg_resources
 import sys
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from rbtools.utils.cache import FileCache, get_file_stamps
+from rbtools.utils.filesystem import (CONFIG_FILE, get_home_path,
+                                      walk_parents)
 from rbtools.utils.process import die, execute
 
 
 # The clients are lazy loaded via load_scmclients()
 SCMCLIENTS = None
 
+# Files or directories marking a checkout, and the name of the SCM client
+# for it. These are checked in each directory from the current directory
+# upwards, so the checkout nearest to the current directory is found.
+SCM_MARKERS = [
+    ('.git', 'git'),
+    ('.hg', 'mercurial'),
+    ('.svn', 'svn'),
+    ('.bzr', 'bazaar'),
+    (os.path.join('CVS', 'Root'), 'cvs'),
+    ('.plastic', 'plastic'),
+]
+
+# Repository detection results are kept for at most a day, even if none of
+# the files they were computed from have changed.
+DETECTION_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Options and environment variables which can change the result of
+# repository detection.
+DETECTION_CACHE_OPTIONS = ['repository_url', 'parent_branch', 'tracking',
+                           'p4_client', 'p4_port']
+DETECTION_CACHE_ENV = ['P4CLIENT', 'P4CONFIG', 'P4PORT', 'P4USER']
+
 
 class SCMClient(object):
     """
@@ -16,6 +47,12 @@ class SCMClient(object):
     """
     name = None
 
+    # The attributes set by get_repository_info which are needed by the
+    # rest of the client. Repository detection results are only cached
+    # between invocations for clients which list them.
+    detection_cache_attrs = []
+    detection_cache = None
+
     def __init__(self, user_config=None, configs=[], options=None,
                  capabilities=None):
         self.user_config = user_config
@@ -26,6 +63,28 @@ class SCMClient(object):
     def get_repository_info(self):
         return None
 
+    def get_detection_cache_files(self, root):
+        """Return the files that repository detection depends on.
+
+        The 'root' argument is the directory containing the checkout's
+        marker (such as the .git directory). The cached detection results
+        are discarded when any of these files (or any .reviewboardrc) are
+        created, modified or removed.
+
+        None may be returned if the results can't be cached for this
+        checkout.
+        """
+        return []
+
+    def load_detection_cache_state(self, state):
+        """Restore the attributes saved by the repository detection cache.
+
+        The values have been through JSON, so clients may need to convert
+        them back to their original types.
+        """
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def check_options(self):
         pass
 
@@ -278,35 +337,245 @@ def load_scmclients(options):
             logging.error('Could not load SCM Client "%s": %s' % (ep.name, e))
 
 
+def load_scmclient(name, options):
+    """Load a single SCM client by name.
+
+    The client is loaded from its entry point without loading any other
+    clients. None is returned if there's no such client.
+    """
+    if SCMCLIENTS is not None:
+        return SCMCLIENTS.get(name)
+
+    for ep in pkg_resources.iter_entry_points(group='rbtools_scm_clients',
+                                              name=name):
+        try:
+            return ep.load()(options=options)
+        except Exception, e:
+            logging.error('Could not load SCM Client "%s": %s' % (ep.name, e))
+
+    return None
+
+
+def find_scm_marker(path=None):
+    """Return the name of the SCM client for the checkout containing path.
+
+    This looks for files and directories marking a checkout, from path
+    (or the current directory) upwards. Perforce workspaces are found
+    through the file named by $P4CONFIG, if set.
+
+    A tuple of the client name and the directory containing the marker
+    is returned, or None if no marker was found.
+    """
+    markers = list(SCM_MARKERS)
+    p4config = os.environ.get('P4CONFIG')
+
+    if p4config and not os.path.dirname(p4config):
+        markers.append((p4config, 'perforce'))
+
+    for dirname in walk_parents(os.path.abspath(path or os.getcwd())):
+        for marker, name in markers:
+            if os.path.exists(os.path.join(dirname, marker)):
+                return name, dirname
+
+    return None
+
+
+class DetectionCache(object):
+    """Caches repository detection for a checkout between invocations.
+
+    The cache holds the RepositoryInfo, the client's state after
+    detection (as listed in its ``detection_cache_attrs``) and the result
+    of ``scan_for_server``. It's keyed on the client, the root of the
+    checkout, the current directory and any options which affect
+    detection.
+
+    The current directory is part of the key because the entry depends
+    on the .reviewboardrc files above it. Running from different
+    subdirectories of a checkout then uses separate entries, rather than
+    each run replacing the last.
+    """
+    def __init__(self, tool, client_name, root, options):
+        cwd = os.getcwd()
+
+        self.tool = tool
+        self.key = json.dumps(
+            [client_name, root, cwd] +
+            [getattr(options, name, None) for name in DETECTION_CACHE_OPTIONS] +
+            [os.environ.get(name) for name in DETECTION_CACHE_ENV])
+
+        files = [
+            os.path.join(path, CONFIG_FILE)
+            for path in walk_parents(cwd)
+        ]
+        files.append(os.path.join(get_home_path(), CONFIG_FILE))
+        client_files = tool.get_detection_cache_files(root)
+
+        self.enabled = client_files is not None
+        self.stamps = get_file_stamps(files + (client_files or []))
+        self.cache = FileCache('repository-detection',
+                               max_age=DETECTION_CACHE_MAX_AGE)
+        self.value = None
+
+    def load(self):
+        """Restore the client's state, and return the RepositoryInfo.
+
+        None is returned if there's no valid entry for the checkout.
+        """
+        if not self.enabled:
+            return None
+
+        value = self.cache.get(self.key, self.stamps)
+
+        if value is None:
+            return None
+
+        try:
+            module_name, class_name = value['repository_info_class']
+            __import__(module_name)
+            cls = getattr(sys.modules[module_name], class_name)
+            repository_info = cls.__new__(cls)
+            repository_info.__dict__.update(value['repository_info'])
+
+            if value['chdir']:
+                os.chdir(value['chdir'])
+        except Exception, e:
+            logging.debug('Ignoring cached repository detection: %s' % e)
+            return None
+
+        self.tool.load_detection_cache_state(value['state'])
+
+        logging.debug('Using cached repository detection for %s'
+                      % self.tool.name)
+        logging.debug("repository info: %s" % repository_info)
+        self.value = value
+
+        return repository_info
+
+    def save(self, repository_info, orig_cwd):
+        """Store the results of detection.
+
+        The 'orig_cwd' argument is the current directory before detection
+        ran, so that any change of directory can be repeated when loading.
+        """
+        if not self.enabled:
+            return
+
+        cwd = os.getcwd()
+
+        if cwd == orig_cwd:
+            cwd = None
+
+        cls = type(repository_info)
+        self.value = {
+            'repository_info_class': [cls.__module__, cls.__name__],
+            'repository_info': repository_info.__dict__,
+            'state': dict(
+                (name, getattr(self.tool, name, None))
+                for name in self.tool.detection_cache_attrs
+            ),
+            'chdir': cwd,
+        }
+
+        try:
+            self.cache.set(self.key, self.value, self.stamps)
+        except (TypeError, ValueError), e:
+            # Something in the state couldn't be stored.
+            logging.debug('Unable to cache repository detection: %s' % e)
+            self.value = None
+
+    def get_server_url(self):
+        """Return the cached result of scan_for_server, or None."""
+        if self.value is not None:
+            return self.value.get('server_url')
+
+        return None
+
+    def set_server_url(self, server_url):
+        """Store the result of scan_for_server."""
+        if self.value is not None:
+            self.value['server_url'] = server_url
+            self.cache.set(self.key, self.value, self.stamps)
+
+
+def scan_for_server(tool, repository_info):
+    """Return the Review Board server URL for a repository.
+
+    This calls the client's scan_for_server, using the result cached
+    along with the repository detection if possible.
+    """
+    cache = getattr(tool, 'detection_cache', None)
+
+    if cache is not None:
+        server_url = cache.get_server_url()
+
+        if server_url:
+            return server_url
+
+    server_url = tool.scan_for_server(repository_info)
+
+    if cache is not None and server_url:
+        cache.set_server_url(server_url)
+
+    return server_url
+
+
 def scan_usable_client(options, client_name=None):
     from rbtools.clients.perforce import PerforceClient
 
     repository_info = None
     tool = None
 
-    # TODO: We should only load all of the scm clients if the
-    # client_name isn't provided.
-    if SCMCLIENTS is None:
-        load_scmclients(options)
-
     if client_name:
-        if client_name not in SCMCLIENTS:
+        tool = load_scmclient(client_name, options)
+
+        if tool is None:
             logging.error('The provided repository type "%s" is invalid.' %
                           client_name)
             sys.exit(1)
-        else:
-            scmclients = {
-                client_name: SCMCLIENTS[client_name]
-            }
-    else:
-        scmclients = SCMCLIENTS
 
-    for name, tool in scmclients.iteritems():
         logging.debug('Checking for a %s repository...' % tool.name)
         repository_info = tool.get_repository_info()
+    else:
+        marker = None
 
-        if repository_info:
-            break
+        # A checkout can be found from its files, unless the repository
+        # has been given by URL.
+        if not getattr(options, 'repository_url', None):
+            marker = find_scm_marker()
+
+        if marker:
+            marker_name, marker_dir = marker
+            logging.debug('Found a %s marker in %s' % (marker_name,
+                                                      marker_dir))
+            tool = load_scmclient(marker_name, options)
+
+            if tool and tool.detection_cache_attrs:
+                tool.detection_cache = DetectionCache(tool, marker_name,
+                                                      marker_dir, options)
+                repository_info = tool.detection_cache.load()
+
+            if tool and not repository_info:
+                logging.debug('Checking for a %s repository...' % tool.name)
+                orig_cwd = os.getcwd()
+                repository_info = tool.get_repository_info()
+
+                if repository_info and tool.detection_cache_attrs:
+                    tool.detection_cache.save(repository_info, orig_cwd)
+
+        if not repository_info:
+            # Fall back on trying every client.
+            if SCMCLIENTS is None:
+                load_scmclients(options)
+
+            for name, tool in SCMCLIENTS.iteritems():
+                if marker and name == marker[0]:
+                    continue
+
+                logging.debug('Checking for a %s repository...' % tool.name)
+                repository_info = tool.get_repository_info()
+
+                if repository_info:
+                    break
 
     if not repository_info:
         if client_name:
@@ -4,6 +4,7 @@ import re
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.errors import TooManyRevisionsError
 from rbtools.utils.checks import check_install
+from rbtools.utils.diffs import generate_diffs, spool_diff
 from rbtools.utils.process import execute
 
 
@@ -174,13 +175,9 @@ class BazaarClient(SCMClient):
         return self._get_diff(revisions, files)
 
     def _get_diff(self, revisions, files):
-        diff = self._get_range_diff(revisions['base'], revisions['tip'], files)
-
-        if 'parent_base' in revisions:
-            parent_diff = self._get_range_diff(
-                revisions['parent_base'], revisions['base'], files)
-        else:
-            parent_diff = None
+        diff, parent_diff = generate_diffs(
+            lambda base, tip: self._get_range_diff(base, tip, files),
+            revisions)
 
         return {
             'diff': diff,
@@ -191,8 +188,12 @@ class BazaarClient(SCMClient):
         """Return the diff between 'base' and 'tip'."""
         diff_cmd = ['bzr', 'diff', '-q', '-r',
                     '%s..%s' % (base, tip)] + files
-        diff = execute(diff_cmd, ignore_errors=True)
-        return diff or None
+        diff = spool_diff(execute(diff_cmd, ignore_errors=True, stream=True))
+
+        if not diff:
+            return None
+
+        return diff
 
     def _set_summary(self, revision_range=None):
         """Set the summary based on the ``revision_range``.
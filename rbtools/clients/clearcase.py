@@ -5,9 +5,12 @@ from pkg_resources import parse_version
 
 from rbtools.api.errors import APIError
 from rbtools.clients import SCMClient, RepositoryInfo
+from rbtools.utils.cache import get_revision_cache
 from rbtools.utils.checks import check_gnu_diff, check_install
-from rbtools.utils.filesystem import make_tempfile
-from rbtools.utils.process import die, execute
+from rbtools.utils.diffs import DiffSet
+from rbtools.utils.filesystem import make_tempfile, owns_tempfiles
+from rbtools.utils.process import die, execute, run_parallel
+from rbtools.utils.unified_diff import diff_files
 
 # This specific import is necessary to handle the paths for
 # cygwin enabled machines.
@@ -46,7 +49,8 @@ class ClearCaseClient(SCMClient):
 
         # Now that we know it's ClearCase, make sure we have GNU diff
         # installed, and error out if we don't.
-        check_gnu_diff()
+        if not getattr(self.options, 'builtin_diff', False):
+            check_gnu_diff()
 
         property_lines = execute(
             ["cleartool", "lsview", "-full", "-properties", "-cview"],
@@ -235,6 +239,7 @@ class ClearCaseClient(SCMClient):
 
         return self._sanitize_branch_changeset(changeset)
 
+    @owns_tempfiles
     def diff(self, files):
         """Performs a diff of the specified file and its previous version."""
 
@@ -245,6 +250,7 @@ class ClearCaseClient(SCMClient):
 
         return self.do_diff(changeset)
 
+    @owns_tempfiles
     def diff_between_revisions(self, revision_range, args, repository_info):
         """Performs a diff between passed revisions or branch."""
 
@@ -261,6 +267,11 @@ class ClearCaseClient(SCMClient):
         Most effective and reliable way is use gnu diff.
         """
 
+        # We need oids of files to translate them to paths on reviewboard
+        # repository.
+        old_oid = execute(["cleartool", "describe", "-fmt", "%On", old_file])
+        new_oid = execute(["cleartool", "describe", "-fmt", "%On", new_file])
+
         # in snapshot view, diff can't access history clearcase file version
         # so copy cc files to tempdir by 'cleartool get -to dest-pname pname',
         # and compare diff with the new temp ones
@@ -280,14 +291,20 @@ class ClearCaseClient(SCMClient):
             except OSError:
                 pass
 
-            execute(["cleartool", "get", "-to", tmp_old_file, old_file])
-            execute(["cleartool", "get", "-to", tmp_new_file, new_file])
-            diff_cmd = ["diff", "-uN", tmp_old_file, tmp_new_file]
+            self._get_file(old_file, old_oid, tmp_old_file)
+            self._get_file(new_file, new_oid, tmp_new_file)
+            diff_old_file = tmp_old_file
+            diff_new_file = tmp_new_file
         else:
-            diff_cmd = ["diff", "-uN", old_file, new_file]
+            diff_old_file = old_file
+            diff_new_file = new_file
 
-        dl = execute(diff_cmd, extra_ignore_errors=(1, 2),
-                     translate_newlines=False)
+        if getattr(self.options, 'builtin_diff', False):
+            dl = ''.join(diff_files(diff_old_file, diff_new_file))
+        else:
+            diff_cmd = ["diff", "-uN", diff_old_file, diff_new_file]
+            dl = execute(diff_cmd, extra_ignore_errors=(1, 2),
+                         translate_newlines=False)
 
         # replace temporary file name in diff with the one in snapshot view
         if self.viewtype == "snapshot":
@@ -306,11 +323,6 @@ class ClearCaseClient(SCMClient):
             dl[0].startswith('Files %s and %s differ' % (old_file, new_file))):
             dl = ['Binary files %s and %s differ\n' % (old_file, new_file)]
 
-        # We need oids of files to translate them to paths on reviewboard
-        # repository.
-        old_oid = execute(["cleartool", "describe", "-fmt", "%On", old_file])
-        new_oid = execute(["cleartool", "describe", "-fmt", "%On", new_file])
-
         if dl == [] or dl[0].startswith("Binary files "):
             if dl == []:
                 dl = ["File %s in your changeset is unmodified\n" % new_file]
@@ -322,6 +334,23 @@ class ClearCaseClient(SCMClient):
 
         return dl
 
+    def _get_file(self, version, oid, tmpfile):
+        """Copy a version of a file out of the VOB to a temp file.
+
+        Checked-in versions never change, so they're kept in the revision
+        cache under their object ID, and only fetched the first time
+        they're needed.
+        """
+        if '@@' in version and 'CHECKEDOUT' not in version:
+            cache_key = 'clearcase:%s' % oid
+        else:
+            cache_key = None
+
+        get_revision_cache().fetch(
+            cache_key, tmpfile,
+            lambda filename: execute(["cleartool", "get", "-to", filename,
+                                      version]))
+
     def diff_directories(self, old_dir, new_dir):
         """Return uniffied diff between two directories content.
 
@@ -334,11 +363,14 @@ class ClearCaseClient(SCMClient):
         old_tmp = make_tempfile(content=old_content)
         new_tmp = make_tempfile(content=new_content)
 
-        diff_cmd = ["diff", "-uN", old_tmp, new_tmp]
-        dl = execute(diff_cmd,
-                     extra_ignore_errors=(1, 2),
-                     translate_newlines=False,
-                     split_lines=True)
+        if getattr(self.options, 'builtin_diff', False):
+            dl = diff_files(old_tmp, new_tmp)
+        else:
+            diff_cmd = ["diff", "-uN", old_tmp, new_tmp]
+            dl = execute(diff_cmd,
+                         extra_ignore_errors=(1, 2),
+                         translate_newlines=False,
+                         split_lines=True)
 
         # Replacing temporary filenames to
         # real directory names and add ids
@@ -354,27 +386,34 @@ class ClearCaseClient(SCMClient):
         return dl
 
     def do_diff(self, changeset):
-        """Generates a unified diff for all files in the changeset."""
-
-        diff = []
-        for old_file, new_file in changeset:
-            dl = []
-            if cpath.isdir(new_file):
-                dl = self.diff_directories(old_file, new_file)
-            elif cpath.exists(new_file) or self.viewtype == 'snapshot':
-                dl = self.diff_files(old_file, new_file)
-            else:
-                logging.error("File %s does not exist or access is denied."
-                              % new_file)
-                continue
+        """Generates a unified diff for all files in the changeset.
 
-            if dl:
-                diff.append(''.join(dl))
+        The files are diffed in parallel.
+        """
+        diff = DiffSet(spool=True)
+        diff.add_files(run_parallel(
+            lambda entry: diff.make_file(self._diff_changeset_entry(entry)),
+            changeset))
 
         return {
-            'diff': ''.join(diff),
+            'diff': diff,
         }
 
+    def _diff_changeset_entry(self, entry):
+        """Return the diff lines for an (old file, new file) entry."""
+        old_file, new_file = entry
+
+        if cpath.isdir(new_file):
+            dl = self.diff_directories(old_file, new_file)
+        elif cpath.exists(new_file) or self.viewtype == 'snapshot':
+            dl = self.diff_files(old_file, new_file)
+        else:
+            logging.error("File %s does not exist or access is denied."
+                          % new_file)
+            return []
+
+        return dl
+
 
 class ClearCaseRepositoryInfo(RepositoryInfo):
     """
@@ -6,6 +6,7 @@ from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.errors import (InvalidRevisionSpecError,
                                     TooManyRevisionsError)
 from rbtools.utils.checks import check_install
+from rbtools.utils.diffs import spool_diff
 from rbtools.utils.process import execute
 
 
@@ -140,5 +141,6 @@ class CVSClient(SCMClient):
             diff_cmd.extend(['-r', base, '-r', tip])
 
         return {
-            'diff': execute(diff_cmd + files, extra_ignore_errors=(1,)),
+            'diff': spool_diff(execute(diff_cmd + files,
+                                       extra_ignore_errors=(1,), stream=True)),
         }
@@ -1,18 +1,290 @@
+import bisect
+import binascii
 import logging
+import mmap
 import os
 import re
+import struct
 import sys
 
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.errors import (InvalidRevisionSpecError,
                                     TooManyRevisionsError)
-from rbtools.clients.perforce import PerforceClient
+from rbtools.clients.perforce import PerforceClient, P4Wrapper
 from rbtools.clients.svn import SVNClient, SVNRepositoryInfo
+from rbtools.utils.cache import FileCache
 from rbtools.utils.checks import check_install
 from rbtools.utils.console import edit_text
+from rbtools.utils.diffs import DiffSet, generate_diffs, spool_diff
+from rbtools.utils.filesystem import get_home_path
 from rbtools.utils.process import die, execute
 
 
+def _read_git_config(cmd):
+    """Return the (key, value) pairs output by 'git config -z'.
+
+    Keys are listed as git prints them, with lowercase section and
+    variable names. Settings given without a value have an empty value.
+    """
+    data = execute(cmd, ignore_errors=True, none_on_ignored_error=True,
+                   with_errors=False, translate_newlines=False)
+    settings = []
+
+    for entry in (data or '').split('\0'):
+        if entry:
+            key, value = (entry.split('\n', 1) + [''])[:2]
+            settings.append((key, value))
+
+    return settings
+
+
+class GitSVNMetadata(object):
+    """Reads the metadata git-svn keeps in a repository.
+
+    This finds what 'git svn info', 'git svn rebase -n' and
+    'git svn find-rev' would, without starting git-svn, which can take
+    seconds. git-svn stores:
+
+    * The svn-remotes, with their URLs and the paths fetched into each
+      remote branch, in the git configuration.
+    * The Subversion repository's root and UUID for each svn-remote, in
+      .git/svn/.metadata.
+    * A "git-svn-id: URL@REVISION UUID" line, in the message of each
+      commit it creates.
+    * A .rev_map file for each remote branch, mapping revisions to
+      commits. This is an array of 24-byte records, each a 4-byte
+      big-endian revision and a 20-byte commit SHA-1, sorted by revision.
+
+    None is returned for anything which can't be found this way, so that
+    callers can fall back on git-svn.
+
+    If the repository's configuration has already been read, its
+    (key, value) pairs can be passed as 'config' to avoid reading it
+    again.
+    """
+    GIT_SVN_ID_RE = re.compile(r'^git-svn-id: (\S+)@(\d+) (\S+)\s*$', re.M)
+    REV_MAP_RECORD_SIZE = 24
+
+    def __init__(self, git, git_dir, config=None):
+        self.git = git
+        self.git_dir = git_dir
+        self.config = config
+        self._remotes = None
+
+    def get_info(self, commit='HEAD'):
+        """Return the Subversion information for a commit's branch.
+
+        This is found from the newest Subversion commit in the first-parent
+        history of 'commit'. Returns a dictionary with the repository's
+        'root', 'url' and 'uuid', and the remote branch ('ref') tracking
+        it, or None.
+        """
+        data = execute([self.git, 'log', '-1', '--first-parent',
+                        '--grep=^git-svn-id: ', '--format=%B', commit],
+                       ignore_errors=True, none_on_ignored_error=True)
+        m = data and self.GIT_SVN_ID_RE.search(data)
+
+        if not m:
+            return None
+
+        url, uuid = m.group(1), m.group(3)
+
+        for remote in self._get_remotes().itervalues():
+            ref = self._get_remote_ref(remote, url)
+
+            if ref is None:
+                continue
+
+            # With rewriteRoot, the URLs in git-svn-id lines aren't the
+            # repository's real URLs, so git-svn is left to sort that out.
+            root = remote.get('reposroot')
+
+            if (not root or remote.get('rewriteroot') or
+                not url.startswith(root)):
+                return None
+
+            return {
+                'root': root,
+                'url': url,
+                'uuid': uuid,
+                'ref': ref,
+            }
+
+        return None
+
+    def find_rev(self, commit):
+        """Return the Subversion revision of a commit made by git-svn.
+
+        The revision in the commit's git-svn-id line is checked against the
+        remote branch's .rev_map. An empty string is returned if the commit
+        doesn't correspond to a revision, and None if there's no .rev_map
+        to check.
+        """
+        data = execute([self.git, 'log', '-1', '--format=%H%n%B', commit],
+                       ignore_errors=True, none_on_ignored_error=True)
+
+        if not data:
+            return ''
+
+        sha1 = data.split('\n', 1)[0].strip()
+        m = self.GIT_SVN_ID_RE.search(data)
+
+        if not m:
+            return ''
+
+        url, revision, uuid = m.group(1), int(m.group(2)), m.group(3)
+
+        for remote in self._get_remotes().itervalues():
+            ref = self._get_remote_ref(remote, url)
+
+            if ref is None:
+                continue
+
+            rev_map = os.path.join(self.git_dir, 'svn', ref,
+                                   '.rev_map.%s' % uuid)
+
+            if not os.path.isfile(rev_map):
+                return None
+
+            if self.get_commit(rev_map, revision) == sha1:
+                return str(revision)
+
+            return ''
+
+        return None
+
+    def get_commit(self, rev_map, revision):
+        """Return the commit for a revision in a .rev_map file, or None.
+
+        The records are sorted by revision, so they're binary searched in
+        place, without reading the whole file.
+        """
+        f = open(rev_map, 'rb')
+
+        try:
+            size = os.fstat(f.fileno()).st_size
+            num_records = size // self.REV_MAP_RECORD_SIZE
+
+            if num_records == 0:
+                return None
+
+            m = mmap.mmap(f.fileno(), num_records * self.REV_MAP_RECORD_SIZE,
+                          access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        try:
+            i = bisect.bisect_left(_RevMapRevisions(m, num_records), revision)
+
+            if i == num_records:
+                return None
+
+            offset = i * self.REV_MAP_RECORD_SIZE
+            record_revision, = struct.unpack('>I', m[offset:offset + 4])
+            sha1 = binascii.hexlify(
+                m[offset + 4:offset + self.REV_MAP_RECORD_SIZE])
+
+            # Revisions without a commit are stored with a zero SHA-1.
+            if record_revision != revision or sha1 == '0' * 40:
+                return None
+
+            return sha1
+        finally:
+            m.close()
+
+    def _get_remotes(self):
+        """Return the svn-remotes, keyed by name.
+
+        Each is a dictionary of its settings, with lowercase names. The
+        'fetch', 'branches' and 'tags' settings are lists.
+        """
+        if self._remotes is not None:
+            return self._remotes
+
+        remotes = {}
+        metadata = os.path.join(self.git_dir, 'svn', '.metadata')
+
+        if self.config is not None:
+            settings = list(self.config)
+        else:
+            settings = _read_git_config([self.git, 'config', '-z',
+                                        '--get-regexp', r'^svn-remote\.'])
+
+        if os.path.isfile(metadata):
+            settings += _read_git_config([self.git, 'config', '-z', '-f',
+                                         metadata, '--list'])
+
+        for key, value in settings:
+            parts = key.split('.')
+
+            if len(parts) < 3 or parts[0] != 'svn-remote':
+                continue
+
+            name = '.'.join(parts[1:-1])
+            setting = parts[-1].lower()
+            remote = remotes.setdefault(name, {
+                'fetch': [],
+                'branches': [],
+                'tags': [],
+            })
+
+            if setting in ('fetch', 'branches', 'tags'):
+                remote[setting].append(value)
+            else:
+                remote[setting] = value
+
+        self._remotes = remotes
+
+        return remotes
+
+    def _get_remote_ref(self, remote, url):
+        """Return the remote branch that an svn-remote fetches a URL into.
+
+        None is returned if the svn-remote doesn't fetch the URL.
+        """
+        base_url = remote.get('url', '').rstrip('/')
+
+        if not base_url or not url.startswith(base_url):
+            return None
+
+        path = url[len(base_url):].strip('/')
+
+        for spec in remote['fetch']:
+            remote_path, ref = spec.rsplit(':', 1)
+
+            if remote_path.strip('/') == path:
+                return ref
+
+        for spec in remote['branches'] + remote['tags']:
+            # These are like "branches/*:refs/remotes/*".
+            remote_path, ref = spec.rsplit(':', 1)
+            prefix, star, suffix = remote_path.strip('/').partition('*')
+
+            if (star and path.startswith(prefix) and path.endswith(suffix) and
+                len(path) > len(prefix) + len(suffix)):
+                name = path[len(prefix):len(path) - len(suffix)]
+
+                if '/' not in name:
+                    return ref.replace('*', name)
+
+        return None
+
+
+class _RevMapRevisions(object):
+    """The revisions in a mapped .rev_map file, as a sequence for bisect."""
+    def __init__(self, m, num_records):
+        self.m = m
+        self.num_records = num_records
+
+    def __len__(self):
+        return self.num_records
+
+    def __getitem__(self, i):
+        offset = i * GitSVNMetadata.REV_MAP_RECORD_SIZE
+
+        return struct.unpack('>I', self.m[offset:offset + 4])[0]
+
+
 class GitClient(SCMClient):
     """
     A wrapper around git that fetches repository information and generates
@@ -21,12 +293,26 @@ class GitClient(SCMClient):
     """
     name = 'Git'
 
+    detection_cache_attrs = ['git', 'git_dir', 'bare', 'head_ref', 'type',
+                             'upstream_branch']
+
+    # The absolute path to the repository's git directory.
+    git_dir = None
+
+    # How long the Perforce change found for a git-p4 commit is cached for,
+    # in seconds. Commits never change, so this just keeps the cache small.
+    GIT_P4_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
     def __init__(self, **kwargs):
         super(GitClient, self).__init__(**kwargs)
         # Store the 'correct' way to invoke git, just plain old 'git' by
         # default.
         self.git = 'git'
 
+        # The repository's configuration, read on first use by _get_config.
+        self._config_items = None
+        self._config = None
+
     def parse_revision_spec(self, revisions=[]):
         """Parses the given revision spec.
 
@@ -151,29 +437,38 @@ class GitClient(SCMClient):
             else:
                 return None
 
-        git_dir = execute([self.git, "rev-parse", "--git-dir"],
-                          ignore_errors=True).rstrip("\n")
+        # The top level is printed after the git directory, since it
+        # fails in bare repositories.
+        paths = execute([self.git, 'rev-parse', '--git-dir',
+                         '--show-toplevel'],
+                        ignore_errors=True, with_errors=False,
+                        split_lines=True)
+        paths = [path.rstrip('\n') for path in paths]
 
-        if git_dir.startswith("fatal:") or not os.path.isdir(git_dir):
+        if not paths or not os.path.isdir(paths[0]):
             return None
-        self.bare = execute([self.git, "config",
-                             "core.bare"]).strip() == 'true'
+
+        git_dir = paths[0]
+        self.git_dir = os.path.abspath(git_dir)
+
+        # The configuration may have been read before the directory changed.
+        self._config_items = None
+        self._config = None
+        self.bare = self._get_config('core.bare') == 'true'
 
         # post-review in directories other than the top level of
         # of a work-tree would result in broken diffs on the server
         if not self.bare:
-            git_top = execute([self.git, "rev-parse", "--show-toplevel"],
-                              ignore_errors=True).rstrip("\n")
-
             # Top level might not work on old git version se we use git dir
             # to find it.
-            if git_top.startswith("fatal:") or not os.path.isdir(git_dir):
+            if len(paths) > 1 and os.path.isdir(paths[1]):
+                git_top = paths[1]
+            else:
                 git_top = git_dir
 
             os.chdir(os.path.abspath(git_top))
 
-        self.head_ref = execute([self.git, 'symbolic-ref', '-q',
-                                 'HEAD'], ignore_errors=True).strip()
+        self.head_ref = self._read_head_ref()
 
         # We know we have something we can work with. Let's find out
         # what it is. We'll try SVN first, but only if there's a .git/svn
@@ -184,6 +479,25 @@ class GitClient(SCMClient):
 
         if (not getattr(self.options, 'repository_url', None) and
             os.path.isdir(git_svn_dir) and len(os.listdir(git_svn_dir)) > 0):
+            # git-svn's metadata is read directly where possible, since
+            # git-svn itself is slow to start.
+            svn_info = GitSVNMetadata(self.git, self.git_dir,
+                                      self._get_config_items()).get_info()
+
+            if svn_info:
+                self.type = 'svn'
+
+                if getattr(self.options, 'parent_branch', None):
+                    self.upstream_branch = self.options.parent_branch
+                else:
+                    self.upstream_branch = svn_info['ref']
+
+                return SVNRepositoryInfo(
+                    path=svn_info['root'],
+                    base_path=svn_info['url'][len(svn_info['root']):] or '/',
+                    uuid=svn_info['uuid'],
+                    supports_parent_diffs=True)
+
             data = execute([self.git, "svn", "info"], ignore_errors=True)
 
             m = re.search(r'^Repository Root: (.+)$', data, re.M)
@@ -230,9 +544,7 @@ class GitClient(SCMClient):
                                   ignore_errors=True)
                 version_parts = re.search('version (\d+)\.(\d+)\.(\d+)',
                                           version)
-                svn_remote = execute(
-                    [self.git, "config", "--get", "svn-remote.svn.url"],
-                    ignore_errors=True)
+                svn_remote = self._get_config('svn-remote.svn.url')
 
                 if (version_parts and svn_remote and
                     not self.is_valid_version((int(version_parts.group(1)),
@@ -244,11 +556,9 @@ class GitClient(SCMClient):
 
         # Okay, maybe Perforce (git-p4).
         git_p4_ref = os.path.join(git_dir, 'refs', 'remotes', 'p4', 'master')
-        data = execute([self.git, 'config', '--get', 'git-p4.port'],
-                       ignore_errors=True)
-        m = re.search(r'(.+)', data)
-        if m and os.path.exists(git_p4_ref):
-            port = m.group(1)
+        port = self._get_config('git-p4.port')
+
+        if port and os.path.exists(git_p4_ref):
             self.type = 'perforce'
             self.upstream_branch = 'remotes/p4/master'
             return RepositoryInfo(path=port,
@@ -260,12 +570,8 @@ class GitClient(SCMClient):
         self.upstream_branch = ''
         if self.head_ref:
             short_head = self._strip_heads_prefix(self.head_ref)
-            merge = execute([self.git, 'config', '--get',
-                             'branch.%s.merge' % short_head],
-                            ignore_errors=True).strip()
-            remote = execute([self.git, 'config', '--get',
-                              'branch.%s.remote' % short_head],
-                             ignore_errors=True).strip()
+            merge = self._get_config('branch.%s.merge' % short_head) or ''
+            remote = self._get_config('branch.%s.remote' % short_head) or ''
 
             merge = self._strip_heads_prefix(merge)
 
@@ -301,6 +607,83 @@ class GitClient(SCMClient):
 
         return None
 
+    def get_detection_cache_files(self, root):
+        """Return the files that repository detection depends on."""
+        git_dir = os.path.join(root, '.git')
+
+        if not os.path.isdir(git_dir):
+            # Worktrees and submodules keep their metadata elsewhere.
+            return None
+
+        return [
+            os.path.join(git_dir, 'config'),
+            os.path.join(git_dir, 'HEAD'),
+            os.path.join(git_dir, 'refs', 'remotes', 'p4', 'master'),
+            os.path.join(get_home_path(), '.gitconfig'),
+        ]
+
+    def _get_config_items(self):
+        """Return the (key, value) pairs of the repository's configuration.
+
+        The configuration is read with a single 'git config --list' the
+        first time it's needed, rather than running git for each setting.
+        """
+        if self._config_items is None:
+            self._config_items = _read_git_config([self.git, 'config', '-z',
+                                                   '--list'])
+
+        return self._config_items
+
+    def _get_config(self, name):
+        """Return the value of a configuration setting, or None if unset.
+
+        As with 'git config --get', the section and variable names are
+        case-insensitive, and the last value wins for multi-valued
+        settings.
+        """
+        if self._config is None:
+            self._config = dict(self._get_config_items())
+
+        parts = name.split('.')
+        parts[0] = parts[0].lower()
+        parts[-1] = parts[-1].lower()
+
+        return self._config.get('.'.join(parts))
+
+    def _read_head_ref(self):
+        """Return the ref that HEAD points to, or '' if HEAD is detached.
+
+        This reads .git/HEAD, and only runs 'git symbolic-ref' for a HEAD
+        stored in some other way, such as a symlink.
+        """
+        head_path = os.path.join(self.git_dir, 'HEAD')
+        data = None
+
+        if not os.path.islink(head_path):
+            try:
+                f = open(head_path, 'r')
+
+                try:
+                    data = f.read().strip()
+                finally:
+                    f.close()
+            except IOError:
+                pass
+
+        if data:
+            if data.startswith('ref: '):
+                ref = data[len('ref: '):]
+
+                # Newer ref storage formats keep HEAD in their own files,
+                # and leave this placeholder in .git/HEAD.
+                if ref != 'refs/heads/.invalid':
+                    return ref
+            elif re.match(r'^[0-9a-f]{40,64}$', data):
+                return ''
+
+        return execute([self.git, 'symbolic-ref', '-q', 'HEAD'],
+                       ignore_errors=True).strip()
+
     def _strip_heads_prefix(self, ref):
         """Strips prefix from ref name, if possible."""
         return re.sub(r'^refs/heads/', '', ref)
@@ -314,10 +697,8 @@ class GitClient(SCMClient):
                            default_upstream_branch or
                            'origin/master')
         upstream_remote = upstream_branch.split('/')[0]
-        origin_url = execute(
-            [self.git, "config", "--get", "remote.%s.url" % upstream_remote],
-            ignore_errors=True).rstrip("\n")
-        return (upstream_branch, origin_url)
+        origin_url = self._get_config('remote.%s.url' % upstream_remote)
+        return (upstream_branch, origin_url or '')
 
     def is_valid_version(self, actual, expected):
         """
@@ -340,8 +721,7 @@ class GitClient(SCMClient):
             return server_url
 
         # TODO: Maybe support a server per remote later? Is that useful?
-        url = execute([self.git, "config", "--get", "reviewboard.url"],
-                      ignore_errors=True).strip()
+        url = self._get_config('reviewboard.url')
         if url:
             return url
 
@@ -446,15 +826,9 @@ class GitClient(SCMClient):
         # 'post-review' get changed to orchestrate the whole process.
         revisions = self.parse_revision_spec(revisions)
 
-        diff_lines = self.make_diff(revisions['base'], revisions['tip'])
-
-        if 'parent_base' in revisions:
-            parent_diff_lines = self.make_diff(revisions['parent_base'],
-                                               revisions['base'])
-            base_commit_id = revisions['parent_base']
-        else:
-            parent_diff_lines = None
-            base_commit_id = revisions['base']
+        diff_lines, parent_diff_lines = generate_diffs(self.make_diff,
+                                                       revisions)
+        base_commit_id = revisions.get('parent_base', revisions['base'])
 
         return {
             'diff': diff_lines,
@@ -492,12 +866,12 @@ class GitClient(SCMClient):
             diff_lines = execute([self.git, "diff", "--no-color",
                                   "--no-prefix", "--no-ext-diff", "-r", "-u",
                                   rev_range],
-                                 split_lines=True)
+                                 split_lines=True, stream=True)
             return self.make_svn_diff(ancestor, diff_lines)
         elif self.type == "perforce":
             diff_lines = execute([self.git, "diff", "--no-color",
                                   "--no-prefix", "-r", "-u", rev_range],
-                                 split_lines=True)
+                                 split_lines=True, stream=True)
             return self.make_perforce_diff(ancestor, diff_lines)
         elif self.type == "git":
             cmdline = [self.git, "diff", "--no-color", "--full-index",
@@ -508,26 +882,43 @@ class GitClient(SCMClient):
                 self.capabilities.has_capability('diffs', 'moved_files')):
                 cmdline.append('-M')
 
-            return execute(cmdline)
+            return spool_diff(execute(cmdline, stream=True))
 
         return None
 
+    def _find_svn_rev(self, commit):
+        """Return the Subversion revision of a git-svn commit.
+
+        This reads git-svn's metadata directly, and only runs
+        'git svn find-rev' if that isn't possible.
+        """
+        if self.git_dir is None:
+            self.git_dir = os.path.abspath(
+                execute([self.git, 'rev-parse', '--git-dir']).strip())
+
+        rev = GitSVNMetadata(self.git, self.git_dir,
+                             self._get_config_items()).find_rev(commit)
+
+        if rev is None:
+            rev = execute([self.git, 'svn', 'find-rev', commit]).strip()
+
+        return rev
+
     def make_svn_diff(self, parent_branch, diff_lines):
         """
         Formats the output of git diff such that it's in a form that
         svn diff would generate. This is needed so the SVNTool in Review
         Board can properly parse this diff.
         """
-        rev = execute([self.git, "svn", "find-rev", parent_branch]).strip()
+        rev = self._find_svn_rev(parent_branch)
 
         if not rev and self.merge_base:
-            rev = execute([self.git, "svn", "find-rev",
-                           self.merge_base]).strip()
+            rev = self._find_svn_rev(self.merge_base)
 
         if not rev:
             return None
 
-        diff_data = ""
+        diff_data = DiffSet(spool=True)
         filename = ""
         newfile = False
 
@@ -538,9 +929,9 @@ class GitClient(SCMClient):
                 #
                 # diff --git a/path/to/file b/path/to/file
                 info = line.split(" ")
-                diff_data += "Index: %s\n" % info[2]
-                diff_data += "=" * 67
-                diff_data += "\n"
+                diff_data.start_file(info[2])
+                diff_data.append("Index: %s\n" % info[2])
+                diff_data.append("=" * 67 + "\n")
             elif line.startswith("index "):
                 # Filter this out.
                 pass
@@ -549,48 +940,44 @@ class GitClient(SCMClient):
                 newfile = True
             elif line.startswith("--- "):
                 newfile = False
-                diff_data += "--- %s\t(revision %s)\n" % \
-                             (line[4:].strip(), rev)
+                diff_data.append("--- %s\t(revision %s)\n" %
+                                 (line[4:].strip(), rev))
             elif line.startswith("+++ "):
                 filename = line[4:].strip()
                 if newfile:
-                    diff_data += "--- %s\t(revision 0)\n" % filename
-                    diff_data += "+++ %s\t(revision 0)\n" % filename
+                    diff_data.append("--- %s\t(revision 0)\n" % filename)
+                    diff_data.append("+++ %s\t(revision 0)\n" % filename)
                 else:
                     # We already printed the "--- " line.
-                    diff_data += "+++ %s\t(working copy)\n" % filename
+                    diff_data.append("+++ %s\t(working copy)\n" % filename)
             elif line.startswith("new file mode"):
                 # Filter this out.
                 pass
             elif line.startswith("Binary files "):
                 # Add the following so that we know binary files were
                 # added/changed.
-                diff_data += "Cannot display: file marked as a binary type.\n"
-                diff_data += "svn:mime-type = application/octet-stream\n"
+                diff_data.append("Cannot display: file marked as a binary "
+                                 "type.\n")
+                diff_data.append("svn:mime-type = application/octet-stream\n")
             else:
-                diff_data += line
+                diff_data.append(line)
 
         return diff_data
 
     def make_perforce_diff(self, parent_branch, diff_lines):
         """Format the output of git diff to look more like perforce's."""
-        diff_data = ''
+        diff_data = DiffSet(spool=True)
         filename = ''
-        p4rev = ''
 
         # Find which depot changelist we're based on
-        log = execute([self.git, 'log', parent_branch], ignore_errors=True)
+        base_path, p4rev = self._get_git_p4_base(parent_branch)
 
-        for line in log:
-            m = re.search(r'[rd]epo.-paths = "(.+)": change = (\d+)\]', log, re.M)
-
-            if m:
-                base_path = m.group(1).strip()
-                p4rev = m.group(2).strip()
-                break
-            else:
-                # We should really raise an error here, base_path is required
-                pass
+        # The depot revision of each file is looked up once the whole diff
+        # has been read, so that they can all be looked up at once. Until
+        # then, the "--- " lines are stored as the filename they're for,
+        # and their positions are recorded.
+        filenames = []
+        headers = []
 
         for line in diff_lines:
             if line.startswith('diff '):
@@ -598,34 +985,78 @@ class GitClient(SCMClient):
                 # This will be in the format of:
                 #    diff --git a/path/to/file b/path/to/file
                 filename = line.split(' ')[2].strip()
+                diff_data.start_file(filename)
             elif (line.startswith('index ') or
                   line.startswith('new file mode ')):
                 # Filter this out
                 pass
             elif line.startswith('--- '):
-                data = execute(
-                    ['p4', 'files', base_path + filename + '@' + p4rev],
-                    ignore_errors=True)
-                m = re.search(r'^%s%s#(\d+).*$' % (re.escape(base_path),
-                                                   re.escape(filename)),
-                              data, re.M)
-                if m:
-                    fileVersion = m.group(1).strip()
-                else:
-                    fileVersion = 1
+                entry = diff_data.get_current_file()
+                headers.append((entry, len(entry.chunks)))
+                entry.add_chunk(filename)
 
-                diff_data += '--- %s%s\t%s%s#%s\n' % (base_path, filename,
-                                                      base_path, filename,
-                                                      fileVersion)
+                if filename not in filenames:
+                    filenames.append(filename)
             elif line.startswith('+++ '):
                 # TODO: add a real timestamp
-                diff_data += '+++ %s%s\t%s\n' % (base_path, filename,
-                                                 'TIMESTAMP')
+                diff_data.append('+++ %s%s\t%s\n' % (base_path, filename,
+                                                     'TIMESTAMP'))
             else:
-                diff_data += line
+                diff_data.append(line)
+
+        if filenames:
+            depot_files = P4Wrapper().files_batch([
+                '%s%s@%s' % (base_path, filename, p4rev)
+                for filename in filenames
+            ])
+        else:
+            depot_files = {}
+
+        for entry, i in headers:
+            filename = entry.chunks[i]
+            depot_file = depot_files.get(base_path + filename, {})
+            entry.replace_chunk(i, '--- %s%s\t%s%s#%s\n' % (
+                base_path, filename, base_path, filename,
+                depot_file.get('rev', 1)))
 
         return diff_data
 
+    def _get_git_p4_base(self, parent_branch):
+        """Return the depot path and change that git-p4 last imported.
+
+        These are read from the "[git-p4: ...]" line which git-p4 adds to
+        each commit message, in the newest commit on parent_branch which
+        has one. They're cached for the commit parent_branch points to.
+        """
+        commit = execute([self.git, 'rev-parse', '--verify', '-q',
+                          '%s^{commit}' % parent_branch],
+                         ignore_errors=True, none_on_ignored_error=True)
+        cache = FileCache('git-p4-changes', max_age=self.GIT_P4_CACHE_MAX_AGE)
+
+        if commit:
+            commit = commit.strip()
+            base = cache.get(commit)
+
+            if base is not None:
+                return tuple(base)
+
+        log = execute([self.git, 'log', '-1', '--format=%B',
+                       '--grep=[rd]epo.-paths = ".*": change = [0-9]*]',
+                       parent_branch],
+                      ignore_errors=True)
+        m = re.search(r'[rd]epo.-paths = "(.+)": change = (\d+)\]', log, re.M)
+
+        if not m:
+            die('Unable to find the Perforce change that %s is based on.'
+                % parent_branch)
+
+        base = (m.group(1).strip(), m.group(2).strip())
+
+        if commit:
+            cache.set(commit, list(base))
+
+        return base
+
     def has_pending_changes(self):
         """Checks if there are changes waiting to be committed.
 
@@ -9,6 +9,8 @@ from rbtools.clients.errors import (InvalidRevisionSpecError,
                                     TooManyRevisionsError)
 from rbtools.clients.svn import SVNClient
 from rbtools.utils.checks import check_install
+from rbtools.utils.diffs import generate_diffs, spool_diff
+from rbtools.utils.filesystem import get_home_path
 from rbtools.utils.process import execute
 
 
@@ -19,6 +21,9 @@ class MercurialClient(SCMClient):
     """
     name = 'Mercurial'
 
+    detection_cache_attrs = ['hgrc', '_type', '_remote_path', '_svn_info',
+                             '_hg_root', '_initted']
+
     def __init__(self, **kwargs):
         super(MercurialClient, self).__init__(**kwargs)
 
@@ -134,6 +139,19 @@ class MercurialClient(SCMClient):
             return RepositoryInfo(path=path, base_path=base_path,
                                   supports_parent_diffs=True)
 
+    def get_detection_cache_files(self, root):
+        """Return the files that repository detection depends on."""
+        return [
+            os.path.join(root, '.hg', 'hgrc'),
+            os.path.join(get_home_path(), '.hgrc'),
+        ]
+
+    def load_detection_cache_state(self, state):
+        super(MercurialClient, self).load_detection_cache_state(state)
+
+        if self._remote_path:
+            self._remote_path = tuple(self._remote_path)
+
     def parse_revision_spec(self, revisions=[]):
         """Parses the given revision spec.
 
@@ -329,7 +347,8 @@ class MercurialClient(SCMClient):
             rs = '.'
 
         return {
-            'diff': self._execute(["hg", "diff", "--hidden", "--svn", rs]),
+            'diff': spool_diff(self._execute(
+                ["hg", "diff", "--hidden", "--svn", rs], stream=True)),
         }
 
     def _get_remote_branch(self):
@@ -512,18 +531,13 @@ class MercurialClient(SCMClient):
 
         diff_cmd = ['hg', 'diff', '--hidden'] + files
 
-        diff = self._execute(
-            diff_cmd + ['-r', revisions['base'], '-r', revisions['tip']],
-            env=self._hg_env)
+        def make_diff(base, tip):
+            return spool_diff(self._execute(
+                diff_cmd + ['-r', base, '-r', tip], env=self._hg_env,
+                stream=True))
 
-        if 'parent_base' in revisions:
-            base_commit_id = revisions['parent_base']
-            parent_diff = self._execute(
-                diff_cmd + ['-r', base_commit_id, '-r', revisions['base']],
-                env=self._hg_env)
-        else:
-            base_commit_id = revisions['base']
-            parent_diff = None
+        diff, parent_diff = generate_diffs(make_diff, revisions)
+        base_commit_id = revisions.get('parent_base', revisions['base'])
 
         return {
             'diff': diff,
@@ -1,3 +1,4 @@
+import itertools
 import logging
 import marshal
 import os
@@ -5,14 +6,21 @@ import re
 import socket
 import stat
 import subprocess
+import tempfile
+import threading
+import time
 
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.errors import (InvalidRevisionSpecError,
                                     OptionsCheckError,
                                     TooManyRevisionsError)
+from rbtools.utils.cache import FileCache, get_revision_cache
 from rbtools.utils.checks import check_gnu_diff, check_install
-from rbtools.utils.filesystem import make_tempfile
-from rbtools.utils.process import die, execute
+from rbtools.utils.diffs import DiffSet
+from rbtools.utils.filesystem import (link_or_copy_file, make_tempfile,
+                                      owns_tempfiles)
+from rbtools.utils.process import die, execute, record_command, run_parallel
+from rbtools.utils.unified_diff import diff_files
 
 
 class P4Wrapper(object):
@@ -25,22 +33,106 @@ class P4Wrapper(object):
     KEYVAL_RE = re.compile('^([^:]+): (.+)$')
     COUNTERS_RE = re.compile('^([^ ]+) = (.+)$')
 
+    # The size of the blocks marshalled output is read from p4 in.
+    READ_BLOCK_SIZE = 64 * 1024
+
+    # Returned by print_files for files which have to be printed with
+    # print_file instead.
+    PRINT_THROUGH_CLIENT = object()
+
     def is_supported(self):
         return check_install(['p4', 'help'])
 
-    def counters(self):
-        lines = self.run_p4(['counters'], split_lines=True)
+    def counter(self, name):
+        """Return the value of a counter, which is '0' if it isn't set.
+
+        None is returned if the counter couldn't be read.
+        """
+        value = self.run_p4(['counter', name], ignore_errors=True,
+                            none_on_ignored_error=True, with_errors=False)
+
+        if value is None:
+            return None
+
+        return value.strip()
+
+    def counters(self, name_filter=None):
+        cmd = ['counters']
+
+        if name_filter:
+            cmd += ['-e', name_filter]
+
+        lines = self.run_p4(cmd, split_lines=True)
         return self._parse_keyval_lines(lines, self.COUNTERS_RE)
 
+    def client_spec(self):
+        """Return the records of 'p4 client -o' for the current client."""
+        return self.run_p4(['client', '-o'], marshalled=True)
+
     def change(self, changenum, password=None):
         return self.run_p4(['change', '-o', str(changenum)],
                            password=password, ignore_errors=True,
                            none_on_ignored_error=True,
                            marshalled=True)
 
+    def describe(self, changenum, shelved=False):
+        """Return the lines of 'p4 describe' for a change, with diffs.
+
+        The diffs are unified diffs of the change's edited files. If
+        shelved is True, the shelved files are described.
+        """
+        cmd = ['describe', '-du']
+
+        if shelved:
+            cmd.append('-S')
+
+        cmd.append(str(changenum))
+
+        return self.run_p4(cmd, split_lines=True, translate_newlines=False,
+                           with_errors=False, stream=True)
+
+    def diff2_batch(self, file_pairs):
+        """Return the lines of 'p4 diff2' for several pairs of files.
+
+        'file_pairs' is a list of (old path, new path) pairs. The diffs are
+        unified diffs, which all come from a single p4 process: the paths
+        are read from a file with -x, and -b 2 has p4 run diff2 for each
+        pair in turn.
+        """
+        args_file = make_tempfile()
+        fp = open(args_file, 'w')
+
+        try:
+            for old_path, new_path in file_pairs:
+                fp.write('%s\n%s\n' % (old_path, new_path))
+        finally:
+            fp.close()
+
+        return self.run_p4(['-b', '2', '-x', args_file, 'diff2', '-du'],
+                           split_lines=True, translate_newlines=False,
+                           with_errors=False, stream=True)
+
     def files(self, path):
         return self.run_p4(['files', path], marshalled=True)
 
+    def iter_files(self, path):
+        """Yield the records from 'p4 files' as they're read."""
+        return self.run_p4_records(['files', path])
+
+    def files_batch(self, paths):
+        """Look up several files' revisions with one p4 command.
+
+        This returns a dictionary mapping each file's depot path to its
+        record from 'p4 files'. Files which don't exist are left out.
+        """
+        files = {}
+
+        for record in self.run_p4_batch(['files'], paths):
+            if record.get('code') == 'stat' and 'depotFile' in record:
+                files[record['depotFile']] = record
+
+        return files
+
     def fstat(self, depot_path, fields=[]):
         args = ['fstat']
 
@@ -61,6 +153,27 @@ class P4Wrapper(object):
 
         return stat_info
 
+    def fstat_batch(self, depot_paths, fields):
+        """Look up fstat information for several files with one p4 command.
+
+        This returns a dictionary mapping each file's depot path to its
+        requested fields. Files which p4 doesn't return information for
+        are left out.
+        """
+        fields = list(fields)
+
+        if 'depotFile' not in fields:
+            fields.append('depotFile')
+
+        stat_infos = {}
+
+        for record in self.run_p4_batch(['fstat', '-T', ','.join(fields)],
+                                        depot_paths):
+            if record.get('code') == 'stat' and 'depotFile' in record:
+                stat_infos[record['depotFile']] = record
+
+        return stat_infos
+
     def info(self):
         lines = self.run_p4(['info'],
                             ignore_errors=True,
@@ -72,6 +185,10 @@ class P4Wrapper(object):
         return self.run_p4(['opened', '-c', str(changenum)],
                            marshalled=True)
 
+    def iter_opened(self, changenum):
+        """Yield the records from 'p4 opened' as they're read."""
+        return self.run_p4_records(['opened', '-c', str(changenum)])
+
     def print_file(self, depot_path, out_file=None):
         cmd = ['print']
 
@@ -82,49 +199,231 @@ class P4Wrapper(object):
 
         return self.run_p4(cmd)
 
+    def print_files(self, files, line_end='\n'):
+        """Print several files with a single p4 command.
+
+        'files' is a list of (depot path, output filename) pairs. This
+        returns a list with an entry for each file, which is None if it
+        was printed, or a message saying why it couldn't be.
+
+        Unlike 'p4 print -o', the contents aren't written through the
+        client workspace, so the client's options aren't applied to them.
+        Text files are written with 'line_end' ending each line, as the
+        client's LineEnd option would have them. Files with Unicode types
+        would also be converted to the client's character set, so they're
+        left for print_file, and PRINT_THROUGH_CLIENT is returned for them.
+
+        Symlinks aren't printed as links, and are reported as errors.
+        """
+        depot_paths = [depot_path for depot_path, out_file in files]
+        errors = [None] * len(files)
+        index = -1
+        out = None
+        translate = False
+
+        try:
+            for record in self.run_p4_batch(['print'], depot_paths):
+                code = record.get('code')
+
+                if code in ('stat', 'error'):
+                    # Each file starts with a stat record (followed by its
+                    # contents) or an error.
+                    if out is not None:
+                        out.close()
+                        out = None
+
+                    index += 1
+
+                    if index >= len(files):
+                        break
+                    elif code == 'error':
+                        errors[index] = record.get('data', '').strip()
+                        continue
+
+                    file_type = record.get('type', '')
+
+                    if 'symlink' in file_type:
+                        errors[index] = ("'%s' is a symlink"
+                                         % depot_paths[index])
+                    elif 'unicode' in file_type or 'utf' in file_type:
+                        errors[index] = self.PRINT_THROUGH_CLIENT
+                    else:
+                        out = open(files[index][1], 'wb')
+                        translate = line_end != '\n' and 'text' in file_type
+                elif out is not None and 'data' in record:
+                    if translate:
+                        out.write(record['data'].replace('\n', line_end))
+                    else:
+                        out.write(record['data'])
+        finally:
+            if out is not None:
+                out.close()
+
+        for i in xrange(index + 1, len(files)):
+            errors[i] = 'No output from p4 print'
+
+        return errors
+
     def where(self, depot_path):
         return self.run_p4(['where', depot_path], marshalled=True)
 
-    def run_p4(self, p4_args, marshalled=False, password=None,
-               *args, **kwargs):
-        cmd = ['p4']
+    def where_batch(self, depot_paths):
+        """Look up the local paths of several files with one p4 command.
 
-        if marshalled:
-            cmd += ['-G']
+        This returns a dictionary mapping each depot path to its path on
+        the local filesystem. Files which aren't mapped into the client
+        are left out.
+        """
+        local_paths = {}
+
+        for record in self.run_p4_batch(['where'], depot_paths):
+            if (record.get('code') == 'stat' and 'path' in record and
+                'unmap' not in record):
+                # Like _depot_to_local, the last mapping wins.
+                local_paths[record['depotFile']] = record['path']
+
+        return local_paths
+
+    def run_p4_batch(self, p4_args, batch_args, password=None):
+        """Run a p4 command once for each of a list of arguments.
+
+        This runs a single 'p4 -G -x -' process, with the arguments
+        given on its standard input, which saves starting p4 and
+        connecting to the server for each one. The marshalled records
+        for all the arguments are yielded in order as they're read.
+
+        Errors for individual arguments are returned as records. This
+        only fails if p4 exits with an error without returning anything.
+        """
+        cmd = ['p4', '-G', '-x', '-']
+
+        if password is not None:
+            cmd += ['-P', password]
 
         cmd += p4_args
 
+        # The arguments are written to a temporary file which is used as
+        # p4's standard input, rather than being written to a pipe by
+        # another thread while the output is read.
+        args_file = tempfile.TemporaryFile(prefix='rbtools.')
+
+        try:
+            for arg in batch_args:
+                args_file.write(arg + '\n')
+
+            args_file.seek(0)
+
+            start_time = time.time()
+            p = subprocess.Popen(cmd, stdin=args_file, stdout=subprocess.PIPE)
+        finally:
+            args_file.close()
+
+        num_records = 0
+        output_size = 0
+
+        try:
+            for record, size in self._read_records(p.stdout):
+                num_records += 1
+                output_size += size
+
+                yield record
+        finally:
+            p.stdout.close()
+            rc = p.wait()
+            record_command(cmd, start_time, output_size, rc)
+
+        if rc and not num_records:
+            die('Failed to execute command: %s\n' % (cmd,))
+
+    def run_p4_records(self, p4_args, password=None):
+        """Run a p4 command, yielding its marshalled records as they're read.
+
+        This lets callers start working on the first records of a long
+        listing before p4 has finished writing it, without holding all of
+        them in memory. Errors are checked once all the records have been
+        read: if p4 failed or returned any errors, they're printed, and
+        this exits.
+        """
+        cmd = ['p4', '-G'] + p4_args
+
         if password is not None:
             cmd += ['-P', password]
 
-        if marshalled:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            result = []
-            has_error = False
+        start_time = time.time()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        errors = []
+        output_size = 0
+
+        try:
+            for record, size in self._read_records(p.stdout):
+                output_size += size
+
+                if record.get('code', None) == 'error':
+                    errors.append(record)
+
+                yield record
+        finally:
+            p.stdout.close()
+            rc = p.wait()
+            record_command(cmd, start_time, output_size, rc)
+
+        if rc or errors:
+            for record in errors:
+                if 'data' in record:
+                    print record['data']
+
+            die('Failed to execute command: %s\n' % (cmd,))
+
+    def _read_records(self, stdout):
+        """Yield the marshalled records read from p4, with their sizes.
+
+        The output is read in blocks with os.read, which lets other
+        threads run while waiting for p4. marshal.load would hold the GIL
+        for as long as it waited for data. Each record is decoded with
+        marshal.loads once all of its data has been read.
+        """
+        fd = stdout.fileno()
+        data = ''
+        pos = 0
 
-            while 1:
+        while 1:
+            block = os.read(fd, self.READ_BLOCK_SIZE)
+            data = data[pos:] + block
+            pos = 0
+
+            while pos < len(data):
                 try:
-                    data = marshal.load(p.stdout)
-                except EOFError:
+                    record = marshal.loads(buffer(data, pos))
+                except (EOFError, ValueError):
+                    # The rest of the record hasn't been read yet.
                     break
-                else:
-                    result.append(data)
-                    if data.get('code', None) == 'error':
-                        has_error = True
 
-            rc = p.wait()
+                # The size of the record as p4 wrote it.
+                size = len(marshal.dumps(record, 0))
 
-            if rc or has_error:
-                for record in result:
-                    if 'data' in record:
-                        print record['data']
-                die('Failed to execute command: %s\n' % (cmd,))
+                if pos + size > len(data):
+                    break
 
-            return result
-        else:
-            result = execute(cmd, *args, **kwargs)
+                pos += size
+                yield record, size
+
+            if not block:
+                break
+
+        if pos < len(data):
+            raise ValueError('Incomplete marshalled output from p4')
+
+    def run_p4(self, p4_args, marshalled=False, password=None,
+               *args, **kwargs):
+        if marshalled:
+            return list(self.run_p4_records(p4_args, password=password))
+
+        cmd = ['p4'] + p4_args
+
+        if password is not None:
+            cmd += ['-P', password]
 
-        return result
+        return execute(cmd, *args, **kwargs)
 
     def _parse_keyval_lines(self, lines, regex=KEYVAL_RE):
         keyvals = {}
@@ -151,18 +450,102 @@ class PerforceClient(SCMClient):
                          '(\d\d\d\d)')
     ENCODED_COUNTER_URL_RE = re.compile('reviewboard.url\.(\S+)')
 
+    # The output of 'p4 describe -du' and 'p4 diff2 -du'. describe lists
+    # the affected files, followed by a header for each file, and diff2 has
+    # a header for each pair of files.
+    AFFECTED_FILE_RE = re.compile(r'^\.\.\. (//.+)#(\d+) (\S+)$')
+    SERVER_DIFF_HEADER_RE = re.compile(
+        r'^==== (.+?)(?: - (.+?))? ====(?: (\w+))?$')
+    SERVER_DIFF_FILE_RE = re.compile(r'^(//.+)#(\d+)(?: \(([^)]+)\))?$')
+    HUNK_RE = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
     REVISION_CURRENT_SYNC = '--rbtools-current-sync'
     REVISION_PENDING_CLN_PREFIX = '--rbtools-pending-cln:'
 
+    detection_cache_attrs = ['p4d_version', 'server_address']
+
+    # The address of the Perforce server, used to key the revision cache.
+    server_address = None
+
+    # Files are printed in batches of at most MAX_PRINT_BATCH_SIZE.
+    MAX_PRINT_BATCH_SIZE = 100
+
+    # The line endings text files are written with, for each of the
+    # client's LineEnd options. 'local' uses the platform's line endings.
+    LINE_ENDS = {
+        'unix': '\n',
+        'share': '\n',
+        'win': '\r\n',
+        'mac': '\r',
+    }
+
+    # How long the information looked up about the server in P4PORT is
+    # cached for, in seconds.
+    SERVER_CACHE_MAX_AGE = 60 * 60
+
+    # The cached information get_repository_info needs about the server.
+    # The Review Board URL may be cached for a server before these are.
+    REPOSITORY_INFO_KEYS = ('server_address', 'p4d_version',
+                            'repository_path', 'has_gnu_diff')
+
     def __init__(self, p4_class=P4Wrapper, **kwargs):
         super(PerforceClient, self).__init__(**kwargs)
         self.p4 = p4_class()
 
+        # Information looked up in bulk before diffing, keyed by depot path.
+        # These are filled in by _print_files, _where_files and _fstat_files,
+        # and emptied by _clear_file_info.
+        self._printed_files = {}
+        self._local_paths = {}
+        self._stat_infos = {}
+
+        # Diffs generated by the server for shelved files, keyed by depot
+        # path, and the timestamp to use in their headers.
+        self._server_diffs = {}
+        self._server_diff_timestamp = None
+
+        # The line ending the client writes text files with, looked up by
+        # _get_line_end.
+        self._line_end = None
+
+    def get_detection_cache_files(self, root):
+        """Return the files that repository detection depends on."""
+        p4config = os.environ.get('P4CONFIG')
+
+        if not p4config:
+            return None
+
+        return [os.path.join(root, p4config)]
+
+    def load_detection_cache_state(self, state):
+        super(PerforceClient, self).load_detection_cache_state(state)
+        self.p4d_version = tuple(self.p4d_version)
+
     def get_repository_info(self):
         if not self.p4.is_supported():
             return None
 
+        # Looking up the server's aliases can be slow, so what's found is
+        # cached for the server in P4PORT.
+        server_info = self._get_server_info()
+
+        if (server_info is not None and
+            all(key in server_info for key in self.REPOSITORY_INFO_KEYS)):
+            logging.debug('Using cached information for Perforce server %s'
+                          % self._get_server_cache_key())
+            self.server_address = server_info['server_address']
+            self.p4d_version = tuple(server_info['p4d_version'])
+
+            if (not getattr(self.options, 'builtin_diff', False) and
+                not server_info['has_gnu_diff']):
+                check_gnu_diff()
+                self._set_server_info(has_gnu_diff=True)
+
+            return RepositoryInfo(path=server_info['repository_path'],
+                                  supports_changesets=True)
+
         p4_info = self.p4.info()
+        self.server_address = p4_info.get('Server address', None)
 
         # For the repository path, we first prefer p4 brokers, then the
         # upstream p4 server. If neither of those are found, just return None.
@@ -226,10 +609,53 @@ class PerforceClient(SCMClient):
 
         # Now that we know it's Perforce, make sure we have GNU diff
         # installed, and error out if we don't.
-        check_gnu_diff()
+        has_gnu_diff = not getattr(self.options, 'builtin_diff', False)
+
+        if has_gnu_diff:
+            check_gnu_diff()
+
+        self._set_server_info(server_address=self.server_address,
+                              p4d_version=list(self.p4d_version),
+                              repository_path=repository_path,
+                              has_gnu_diff=has_gnu_diff)
 
         return RepositoryInfo(path=repository_path, supports_changesets=True)
 
+    def _get_server_cache_key(self):
+        """Return the key for caching information about the server.
+
+        The server is identified by P4PORT. None is returned if P4CONFIG is
+        set, since a config file could point at a different server. The
+        repository detection cache covers that case instead.
+        """
+        if os.environ.get('P4CONFIG'):
+            return None
+
+        return os.environ.get('P4PORT') or None
+
+    def _get_server_info(self):
+        """Return the cached information about the server, or None."""
+        key = self._get_server_cache_key()
+
+        if key is None:
+            return None
+
+        return FileCache('perforce-servers',
+                         max_age=self.SERVER_CACHE_MAX_AGE).get(key)
+
+    def _set_server_info(self, **kwargs):
+        """Add to the cached information about the server."""
+        key = self._get_server_cache_key()
+
+        if key is None:
+            return
+
+        cache = FileCache('perforce-servers',
+                          max_age=self.SERVER_CACHE_MAX_AGE)
+        server_info = cache.get(key) or {}
+        server_info.update(kwargs)
+        cache.set(key, server_info)
+
     def parse_revision_spec(self, revisions=[]):
         """Parses the given revision spec.
 
@@ -372,16 +798,34 @@ class PerforceClient(SCMClient):
         pipe ('|') characters should be used. These should be safe because they
         should not be used unencoded in urls.
         """
-        counters = self.p4.counters()
+        server_info = self._get_server_info()
 
-        # Try for a "reviewboard.url" counter first.
-        url = counters.get('reviewboard.url', None)
+        if server_info is not None and 'server_url' in server_info:
+            return server_info['server_url']
 
-        if url:
+        url = self._get_server_url_from_counters()
+        self._set_server_info(server_url=url)
+
+        return url
+
+    def _get_server_url_from_counters(self):
+        # Try for a "reviewboard.url" counter first. This is looked up
+        # directly, rather than listing every counter on the server.
+        url = self.p4.counter('reviewboard.url')
+
+        if url and url != '0':
             return url
 
         # Next try for a counter of the form:
         # reviewboard_url.http:||reviewboard.example.com
+        #
+        # Servers since 2010.1 can list just the counters with names like
+        # that.
+        if getattr(self, 'p4d_version', (0, 0)) >= (2010, 1):
+            counters = self.p4.counters('reviewboard.url.*')
+        else:
+            counters = self.p4.counters()
+
         for key, value in counters.iteritems():
             m = self.ENCODED_COUNTER_URL_RE.match(key)
 
@@ -406,6 +850,7 @@ class PerforceClient(SCMClient):
         else:
             return None
 
+    @owns_tempfiles
     def diff(self, args):
         """
         Goes through the hard work of generating a diff on Perforce in order
@@ -442,23 +887,30 @@ class PerforceClient(SCMClient):
 
             # Try to get the files out of the working directory first. If that
             # doesn't work, look at shelved files.
-            opened_files = self.p4.opened(tip)
-            if not opened_files:
-                opened_files = self.p4.files('//...@=%s' % tip)
+            #
+            # The files are diffed as p4 lists them, so only the first one
+            # is read here.
+            opened_files = self.p4.iter_opened(tip)
+            first_file = next(opened_files, None)
+
+            if first_file is None:
+                opened_files = self.p4.iter_files('//...@=%s' % tip)
+                first_file = next(opened_files, None)
                 cl_is_shelved = True
 
-            if not opened_files:
+            if first_file is None:
                 die("Couldn't find any affected files for this change.")
 
+            opened_files = itertools.chain([first_file], opened_files)
+
             if cl_is_shelved:
                 logging.info('Generating diff for shelved changeset %s' % tip)
             else:
                 logging.info('Generating diff for pending changeset %s' % tip)
         else:
-            # TODO: diff between submitted revisions
-            return {}
+            return self._diff_submitted(base, tip)
 
-        diff_lines = []
+        diff = DiffSet(spool=True)
 
         action_mapping = {
             'edit': 'M',
@@ -487,86 +939,205 @@ class PerforceClient(SCMClient):
             action_mapping['move/add'] = 'A'
             action_mapping['move/delete'] = 'D'
 
+        def diff_batch(files):
+            # The batch's files are looked up and printed with one p4
+            # command for each step, and then diffed. While one batch is
+            # being diffed, the other workers are still printing theirs.
+            self._look_up_opened_files(files, cl_is_shelved, action_mapping)
+            self._print_files(self._get_print_paths(files, tip, cl_is_shelved,
+                                                    action_mapping))
+
+            return [diff.make_file(self._diff_opened_file(f, tip,
+                                                          cl_is_shelved,
+                                                          action_mapping))
+                    for f in files]
+
+        if cl_is_shelved and getattr(self.options, 'p4_server_diff', False):
+            # The server diffs the shelved files against their base
+            # revisions, so edited files don't need to be printed.
+            self._get_shelved_server_diffs(tip)
+
+        try:
+            # Printing the files is bound by the server's bandwidth, so the
+            # files are split into batches which are printed and diffed in
+            # parallel, starting while p4 is still listing the files. The
+            # results are in the same order as the files.
+            batches = self._iter_print_batches(opened_files)
+
+            for entries in run_parallel(diff_batch, batches):
+                diff.add_files(entries)
+        finally:
+            self._clear_file_info()
+
+        return {
+            'diff': diff,
+        }
+
+    def _iter_print_batches(self, files):
+        """Yield batches of files to print and diff in parallel.
+
+        The batches start small and double in size up to
+        MAX_PRINT_BATCH_SIZE, so that a small change is still spread
+        across the workers, while most of a large change is printed with
+        one p4 command for each full batch. 'files' may be an iterator
+        over the records being read from p4.
+        """
+        batch = []
+        batch_size = 1
+
+        for f in files:
+            batch.append(f)
+
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+                batch_size = min(batch_size * 2, self.MAX_PRINT_BATCH_SIZE)
+
+        if batch:
+            yield batch
+
+    def _get_print_paths(self, opened_files, tip, cl_is_shelved,
+                         action_mapping):
+        """Return the depot paths that _diff_opened_file writes out."""
+        print_paths = []
+
         for f in opened_files:
             depot_file = f['depotFile']
-            new_depot_file = ''
-            try:
-                base_revision = int(f['rev'])
-            except ValueError:
-                # For actions like deletes, there won't be any "current
-                # revision". Just pass through whatever was there before.
-                base_revision = f['rev']
-            action = f['action']
+            changetype_short = action_mapping.get(f['action'])
+
+            if changetype_short == 'M' and depot_file in self._server_diffs:
+                continue
+
+            if changetype_short in ('M', 'D', 'MV'):
+                print_paths.append('%s#%s' % (depot_file, f['rev']))
+
+            if changetype_short in ('M', 'A') and cl_is_shelved:
+                print_paths.append('%s@=%s' % (depot_file, tip))
+
+        return print_paths
+
+    def _look_up_opened_files(self, opened_files, cl_is_shelved,
+                              action_mapping):
+        """Look up what's needed to diff a batch of opened files, in bulk.
+
+        This looks up the local paths and move information that
+        _diff_opened_file uses, with one p4 command for each.
+        """
+        where_paths = []
+        fstat_paths = []
+
+        for f in opened_files:
+            depot_file = f['depotFile']
+            changetype_short = action_mapping.get(f['action'])
 
-            old_file = ''
-            new_file = ''
+            if changetype_short in ('M', 'A'):
+                if not cl_is_shelved:
+                    where_paths.append(depot_file)
+            elif changetype_short in ('MV', 'MV-a'):
+                fstat_paths.append(depot_file)
 
-            logging.debug('Processing %s of %s', action, depot_file)
+        fields = ['clientFile', 'movedFile', 'depotFile']
+        self._where_files(where_paths)
+        self._fstat_files(fstat_paths, fields)
 
+        # Both sides of each move are opened, but the file a file was moved
+        # to may be in another batch.
+        moved_paths = []
+
+        for depot_file in fstat_paths:
+            stat_info = self._stat_infos.get(depot_file, {})
+
+            if 'movedFile' in stat_info:
+                moved_paths.append(stat_info['movedFile'])
+
+        self._fstat_files(moved_paths, fields)
+
+    def _diff_opened_file(self, f, tip, cl_is_shelved, action_mapping):
+        """Return the diff lines for a file opened in a changeset.
+
+        'f' is the file's information from 'p4 opened' or 'p4 files'. An
+        empty list is returned if the file is skipped.
+        """
+        depot_file = f['depotFile']
+        new_depot_file = ''
+        try:
+            base_revision = int(f['rev'])
+        except ValueError:
+            # For actions like deletes, there won't be any "current
+            # revision". Just pass through whatever was there before.
+            base_revision = f['rev']
+        action = f['action']
+
+        old_file = ''
+        new_file = ''
+
+        logging.debug('Processing %s of %s', action, depot_file)
+
+        try:
+            changetype_short = action_mapping[action]
+        except KeyError:
+            die('Unknown action type "%s" for %s' % (action, depot_file))
+
+        if changetype_short == 'M' and depot_file in self._server_diffs:
+            file_type, hunk_lines = self._server_diffs[depot_file]
+
+            return self._format_server_diff(
+                depot_file, base_revision, '%s@=%s' % (depot_file, tip),
+                file_type, hunk_lines)
+        elif changetype_short == 'M':
             try:
-                changetype_short = action_mapping[action]
-            except KeyError:
-                die('Unknown action type "%s" for %s' % (action, depot_file))
+                old_file, new_file = self._extract_edit_files(
+                    depot_file, tip, base_revision, cl_is_shelved)
+            except ValueError, e:
+                logging.warning('Skipping file %s: %s', depot_file, e)
+                return []
+        elif changetype_short == 'A':
+            # Perforce has a charming quirk where the revision listed for
+            # a file is '1' in both the first submitted revision, as well
+            # as before it's added. On the Review Board side, when we parse
+            # the diff, we'll check to see if that revision exists, but
+            # that only works for pending changes. If the change is shelved
+            # or submitted, revision 1 will exist, which causes the
+            # displayed diff to contain revision 1 twice.
+            #
+            # Setting the revision in the diff file to be '0' will avoid
+            # problems with patches that add files.
+            base_revision = 0
 
-            if changetype_short == 'M':
-                try:
-                    old_file, new_file = self._extract_edit_files(
+            try:
+                old_file, new_file = self._extract_add_files(
+                    depot_file, tip, cl_is_shelved)
+            except ValueError, e:
+                logging.warning('Skipping file %s: %s', depot_file, e)
+                return []
+
+            if os.path.islink(new_file):
+                logging.warning('Skipping symlink %s', new_file)
+                return []
+        elif changetype_short == 'D':
+            try:
+                old_file, new_file = self._extract_delete_files(
+                    depot_file, base_revision, cl_is_shelved)
+            except ValueError, e:
+                logging.warning('Skipping file %s#%s: %s', depot_file, e)
+                return []
+        elif changetype_short == 'MV-a':
+            # The server supports move information. We ignore this
+            # particular entry, and handle the moves within the equivalent
+            # 'move/delete' entry.
+            return []
+        elif changetype_short == 'MV':
+            try:
+                old_file, new_file, new_depot_file = \
+                    self._extract_move_files(
                         depot_file, tip, base_revision, cl_is_shelved)
-                except ValueError, e:
-                    logging.warning('Skipping file %s: %s', depot_file, e)
-                    continue
-            elif changetype_short == 'A':
-                # Perforce has a charming quirk where the revision listed for
-                # a file is '1' in both the first submitted revision, as well
-                # as before it's added. On the Review Board side, when we parse
-                # the diff, we'll check to see if that revision exists, but
-                # that only works for pending changes. If the change is shelved
-                # or submitted, revision 1 will exist, which causes the
-                # displayed diff to contain revision 1 twice.
-                #
-                # Setting the revision in the diff file to be '0' will avoid
-                # problems with patches that add files.
-                base_revision = 0
+            except ValueError, e:
+                logging.warning('Skipping file %s: %s', depot_file, e)
+                return []
 
-                try:
-                    old_file, new_file = self._extract_add_files(
-                        depot_file, tip, cl_is_shelved)
-                except ValueError, e:
-                    logging.warning('Skipping file %s: %s', depot_file, e)
-                    continue
-
-                if os.path.islink(new_file):
-                    logging.warning('Skipping symlink %s', new_file)
-                    continue
-            elif changetype_short == 'D':
-                try:
-                    old_file, new_file = self._extract_delete_files(
-                        depot_file, base_revision, cl_is_shelved)
-                except ValueError, e:
-                    logging.warning('Skipping file %s#%s: %s', depot_file, e)
-                    continue
-            elif changetype_short == 'MV-a':
-                # The server supports move information. We ignore this
-                # particular entry, and handle the moves within the equivalent
-                # 'move/delete' entry.
-                continue
-            elif changetype_short == 'MV':
-                try:
-                    old_file, new_file, new_depot_file = \
-                        self._extract_move_files(
-                            depot_file, tip, base_revision, cl_is_shelved)
-                except ValueError, e:
-                    logging.warning('Skipping file %s: %s', depot_file, e)
-                    continue
-
-            dl = self._do_diff(old_file, new_file, depot_file, base_revision,
-                               new_depot_file, changetype_short,
-                               ignore_unmodified=True)
-            diff_lines += dl
-
-        return {
-            'diff': ''.join(diff_lines),
-        }
+        return self._do_diff(old_file, new_file, depot_file, base_revision,
+                             new_depot_file, changetype_short,
+                             ignore_unmodified=True)
 
     def _extract_edit_files(self, depot_file, tip, base_revision,
                             cl_is_shelved):
@@ -639,8 +1210,7 @@ class PerforceClient(SCMClient):
         # else:
         fstat_path = old_depot_file
 
-        stat_info = self.p4.fstat(fstat_path,
-                                  ['clientFile', 'movedFile'])
+        stat_info = self._fstat(fstat_path, ['clientFile', 'movedFile'])
         if 'clientFile' not in stat_info or 'movedFile' not in stat_info:
             raise ValueError('Unable to get moved file information')
 
@@ -653,8 +1223,7 @@ class PerforceClient(SCMClient):
         # else:
         fstat_path = stat_info['movedFile']
 
-        stat_info = self.p4.fstat(fstat_path,
-                                  ['clientFile', 'depotFile'])
+        stat_info = self._fstat(fstat_path, ['clientFile', 'depotFile'])
         if 'clientFile' not in stat_info or 'depotFile' not in stat_info:
             raise ValueError('Unable to get moved file information')
 
@@ -666,6 +1235,317 @@ class PerforceClient(SCMClient):
 
         return old_filename, new_filename, new_depot_file
 
+    def _diff_submitted(self, base, tip):
+        """Return the diff between two submitted changesets.
+
+        The server diffs the edited files, rather than both revisions of
+        each one being printed and diffed locally. A single changeset is
+        diffed with 'p4 describe', and a range of changesets with a batched
+        'p4 diff2' of the edited files. The server doesn't include the
+        contents of added and deleted files, so those are still printed.
+
+        Moved files are shown as adds and deletes, as they are for
+        shelved changesets.
+        """
+        timestamp = self._get_change_timestamp(tip)
+
+        if int(tip) == int(base) + 1:
+            logging.info('Generating diff for submitted changeset %s' % tip)
+            changed_files = self._get_described_files(tip)
+        else:
+            logging.info('Generating diff for submitted changesets %s to %s'
+                         % (base, tip))
+            changed_files = self._get_range_files(base, tip)
+
+        # changed_files is a list of (depot path, base revision, new
+        # revision, file type, hunk lines) tuples. The base revision is None
+        # for added files, and the new revision is None for deleted files.
+        print_paths = []
+
+        for depot_file, base_rev, new_rev, file_type, hunk_lines in \
+                changed_files:
+            if base_rev is None:
+                print_paths.append('%s#%s' % (depot_file, new_rev))
+            elif new_rev is None:
+                print_paths.append('%s#%s' % (depot_file, base_rev))
+
+        def diff_file(changed_file):
+            depot_file, base_rev, new_rev, file_type, hunk_lines = \
+                changed_file
+            new_path = '%s#%s' % (depot_file, new_rev)
+
+            if base_rev is not None and new_rev is not None:
+                return self._format_server_diff(depot_file, base_rev,
+                                                new_path, file_type,
+                                                hunk_lines, timestamp)
+
+            old_file = make_tempfile()
+            new_file = make_tempfile()
+
+            try:
+                if base_rev is None:
+                    self._write_file(new_path, new_file)
+                    base_rev = 0
+                    changetype_short = 'A'
+                else:
+                    self._write_file('%s#%s' % (depot_file, base_rev),
+                                     old_file)
+                    changetype_short = 'D'
+            except ValueError, e:
+                logging.warning('Skipping file %s: %s', depot_file, e)
+                return []
+
+            return self._do_diff(old_file, new_file, depot_file, base_rev,
+                                 '', changetype_short,
+                                 ignore_unmodified=True)
+
+        self._print_files(print_paths)
+        diff = DiffSet(spool=True)
+
+        try:
+            diff.add_files(run_parallel(
+                lambda changed_file: diff.make_file(diff_file(changed_file)),
+                changed_files))
+        finally:
+            self._clear_file_info()
+
+        return {
+            'diff': diff,
+        }
+
+    def _get_described_files(self, changenum):
+        """Return the files changed in a submitted changeset.
+
+        The changed files are returned in the form used by _diff_submitted,
+        with the diffs of edited files from 'p4 describe'.
+        """
+        affected_files, diffs = self._parse_server_diff(
+            self.p4.describe(changenum))
+        hunks = {}
+
+        for old, new, hunk_lines in diffs:
+            if old is not None:
+                hunks[old[0]] = (old[2], hunk_lines)
+
+        changed_files = []
+
+        for depot_file, rev, action in affected_files:
+            file_type, hunk_lines = hunks.get(depot_file, (None, []))
+
+            if action in ('add', 'branch', 'import', 'move/add'):
+                changed_files.append((depot_file, None, rev, file_type, None))
+            elif action in ('delete', 'move/delete'):
+                changed_files.append((depot_file, rev - 1, None, file_type,
+                                      None))
+            elif action in ('edit', 'integrate'):
+                changed_files.append((depot_file, rev - 1, rev, file_type,
+                                      hunk_lines))
+            else:
+                die('Unknown action type "%s" for %s' % (action, depot_file))
+
+        return changed_files
+
+    def _get_range_files(self, base, tip):
+        """Return the files changed between two submitted changesets.
+
+        The changed files are returned in the form used by _diff_submitted,
+        with the diffs of edited files from 'p4 diff2'. Only the files
+        changed in the range are diffed, rather than the whole depot.
+        """
+        tip_files = self.p4.files('//...@%d,@%s' % (int(base) + 1, tip))
+        tip_files = [f for f in tip_files
+                     if f.get('code') == 'stat' and 'depotFile' in f]
+        base_files = self.p4.files_batch(['%s@%s' % (f['depotFile'], base)
+                                          for f in tip_files])
+        changed_files = []
+        diff_pairs = []
+
+        for f in tip_files:
+            depot_file = f['depotFile']
+            base_file = base_files.get(depot_file)
+
+            if base_file is None or 'delete' in base_file['action']:
+                base_rev = None
+            else:
+                base_rev = int(base_file['rev'])
+
+            if 'delete' in f['action']:
+                new_rev = None
+            else:
+                new_rev = int(f['rev'])
+
+            if base_rev is not None and new_rev is not None:
+                diff_pairs.append(('%s#%s' % (depot_file, base_rev),
+                                   '%s#%s' % (depot_file, new_rev)))
+
+            if base_rev is not None or new_rev is not None:
+                changed_files.append((depot_file, base_rev, new_rev,
+                                      f.get('type'), None))
+
+        if not diff_pairs:
+            return changed_files
+
+        affected_files, diffs = self._parse_server_diff(
+            self.p4.diff2_batch(diff_pairs))
+        hunks = {}
+
+        for old, new, hunk_lines in diffs:
+            if old is not None and new is not None:
+                hunks[new[0]] = (new[2], hunk_lines)
+
+        # Edited files which aren't in the output of diff2 have identical
+        # contents at both changesets.
+        for i, (depot_file, base_rev, new_rev, file_type, hunk_lines) in \
+                enumerate(changed_files):
+            if base_rev is not None and new_rev is not None:
+                file_type, hunk_lines = hunks.get(depot_file, (None, []))
+                changed_files[i] = (depot_file, base_rev, new_rev, file_type,
+                                    hunk_lines)
+
+        return changed_files
+
+    def _get_shelved_server_diffs(self, changenum):
+        """Look up the server's diffs of the files in a shelved changeset.
+
+        _diff_opened_file uses the diffs for edited files until
+        _clear_file_info is called.
+        """
+        affected_files, diffs = self._parse_server_diff(
+            self.p4.describe(changenum, shelved=True))
+
+        for old, new, hunk_lines in diffs:
+            if old is not None:
+                self._server_diffs[old[0]] = (old[2], hunk_lines)
+
+        self._server_diff_timestamp = self._get_change_timestamp(changenum)
+
+    def _get_change_timestamp(self, changenum):
+        """Return the date of a changeset, for use in diff headers."""
+        change = self.p4.change(changenum)
+
+        if change and 'Date' in change[0]:
+            return change[0]['Date'].replace('/', '-')
+
+        return time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def _parse_server_diff(self, lines):
+        """Parse the output of 'p4 describe -du' or 'p4 diff2 -du'.
+
+        Returns a tuple of the affected files listed by describe, as
+        (depot path, revision, action) tuples, and the diffs, as (old file,
+        new file, hunk lines) tuples. The files are (depot path, revision,
+        file type) tuples, or None for a file which doesn't exist. describe
+        only shows one file for each diff, which is returned as the old
+        file.
+        """
+        affected_files = []
+        diffs = []
+        hunk_lines = None
+        old_left = 0
+        new_left = 0
+
+        for line in lines:
+            if old_left > 0 or new_left > 0:
+                if line.startswith('-'):
+                    old_left -= 1
+                elif line.startswith('+'):
+                    new_left -= 1
+                elif not line.startswith('\\'):
+                    if not line.startswith(' '):
+                        # Blank context lines may have lost their space.
+                        line = ' ' + line
+
+                    old_left -= 1
+                    new_left -= 1
+
+                hunk_lines.append(line.replace('\r\r\n', '\r\n'))
+                continue
+            elif hunk_lines is not None and line.startswith('\\'):
+                # A "No newline at end of file" marker after a hunk.
+                hunk_lines.append(line)
+                continue
+
+            m = self.HUNK_RE.match(line)
+
+            if m and hunk_lines is not None:
+                old_left = int(m.group(1) or 1)
+                new_left = int(m.group(2) or 1)
+                hunk_lines.append(line)
+                continue
+
+            line = line.rstrip('\r\n')
+            m = self.SERVER_DIFF_HEADER_RE.match(line)
+
+            if m:
+                if m.group(3) == 'identical':
+                    hunk_lines = None
+                else:
+                    hunk_lines = []
+                    diffs.append((self._parse_server_diff_file(m.group(1)),
+                                  self._parse_server_diff_file(m.group(2)),
+                                  hunk_lines))
+
+                continue
+
+            m = self.AFFECTED_FILE_RE.match(line)
+
+            if m:
+                affected_files.append((m.group(1), int(m.group(2)),
+                                       m.group(3)))
+
+        return affected_files, diffs
+
+    def _parse_server_diff_file(self, text):
+        """Parse one side of a server diff header.
+
+        Returns a (depot path, revision, file type) tuple, or None if the
+        file doesn't exist.
+        """
+        if text is None:
+            return None
+
+        m = self.SERVER_DIFF_FILE_RE.match(text)
+
+        if not m:
+            return None
+
+        return m.group(1), int(m.group(2)), m.group(3)
+
+    def _format_server_diff(self, depot_file, base_revision, new_path,
+                            file_type, hunk_lines, timestamp=None):
+        """Return the diff lines for an edited file diffed by the server.
+
+        The lines are in the same form as those from _do_diff. new_path
+        identifies the new revision, for binary files. An empty list is
+        returned if the file is unmodified.
+        """
+        if not hunk_lines:
+            if file_type and 'binary' in file_type:
+                return [
+                    '==== %s#%s ==M== %s ====\n' % (depot_file, base_revision,
+                                                    depot_file),
+                    'Binary files %s#%s and %s differ\n' % (depot_file,
+                                                            base_revision,
+                                                            new_path),
+                    '\n',
+                ]
+
+            return []
+
+        if timestamp is None:
+            timestamp = self._server_diff_timestamp
+
+        dl = [
+            '--- %s\t%s#%s\n' % (depot_file, depot_file, base_revision),
+            '+++ %s\t%s\n' % (depot_file, timestamp),
+        ] + hunk_lines
+
+        # The server may leave off the newline at the end of the diff.
+        if dl[-1][-1] != '\n':
+            dl.append('\n')
+
+        return dl
+
     def check_options(self):
         if self.options.revision_range:
             raise OptionsCheckError(
@@ -702,11 +1582,8 @@ class PerforceClient(SCMClient):
                                       r'(?P<revision1>[#@][^,]+)?' +
                                       r'(?P<revision2>,[#@][^,]+)?$')
 
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
-
-        diff_lines = []
+        diff = DiffSet(spool=True)
+        changed_files = []
 
         for path in args:
             m = r_revision_range.match(path)
@@ -719,7 +1596,7 @@ class PerforceClient(SCMClient):
 
             if revision1:
                 first_rev_path += revision1
-            records = self.p4.files(first_rev_path)
+            records = self.p4.iter_files(first_rev_path)
 
             # Make a map for convenience.
             files = {}
@@ -742,7 +1619,7 @@ class PerforceClient(SCMClient):
             if revision2:
                 # [1:] to skip the comma.
                 second_rev_path = m.group('path') + revision2[1:]
-                records = self.p4.files(second_rev_path)
+                records = self.p4.iter_files(second_rev_path)
                 for record in records:
                     if record['action'] not in ('delete', 'move/delete'):
                         try:
@@ -751,53 +1628,96 @@ class PerforceClient(SCMClient):
                         except KeyError:
                             files[record['depotFile']] = [None, record]
 
+            # When we know the revisions are the same, we don't need to do
+            # any diffing. This speeds up large revision-range diffs quite
+            # a bit. The files are sorted so the diff is always in the same
+            # order.
+            changed_files += [
+                (depot_path, first_record, second_record)
+                for depot_path, (first_record, second_record)
+                in sorted(files.items())
+                if (first_record is None or second_record is None or
+                    first_record['rev'] != second_record['rev'])
+            ]
+
+        empty_filename = make_tempfile()
+        scratch = threading.local()
+        scratch_filenames = []
+
+        def diff_file(changed_file):
+            depot_path, first_record, second_record = changed_file
+
+            # Each worker writes the revisions it's diffing to its own pair
+            # of files.
+            if not hasattr(scratch, 'filenames'):
+                scratch.filenames = (make_tempfile(), make_tempfile())
+                scratch_filenames.extend(scratch.filenames)
+
+            tmp_diff_from_filename, tmp_diff_to_filename = scratch.filenames
             old_file = new_file = empty_filename
-            changetype_short = None
-
-            for depot_path, (first_record, second_record) in files.items():
-                old_file = new_file = empty_filename
-                if first_record is None:
-                    new_path = '%s#%s' % (depot_path, second_record['rev'])
-                    self._write_file(new_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    changetype_short = 'A'
-                    base_revision = 0
-                elif second_record is None:
-                    old_path = '%s#%s' % (depot_path, first_record['rev'])
-                    self._write_file(new_path, tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                    changetype_short = 'D'
-                    base_revision = int(first_record['rev'])
-                elif first_record['rev'] == second_record['rev']:
-                    # We when we know the revisions are the same, we don't need
-                    # to do any diffing. This speeds up large revision-range
-                    # diffs quite a bit.
-                    continue
-                else:
-                    old_path = '%s#%s' % (depot_path, first_record['rev'])
-                    new_path = '%s#%s' % (depot_path, second_record['rev'])
-                    self._write_file(old_path, tmp_diff_from_filename)
-                    self._write_file(new_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    old_file = tmp_diff_from_filename
-                    changetype_short = 'M'
-                    base_revision = int(first_record['rev'])
-
-                # TODO: We're passing new_depot_file='' here just to make
-                # things work like they did before the moved file change was
-                # added (58ccae27). This section of code needs to be updated
-                # to properly work with moved files.
-                dl = self._do_diff(old_file, new_file, depot_path,
-                                   base_revision, '', changetype_short,
-                                   ignore_unmodified=True)
-                diff_lines += dl
-
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
+
+            if first_record is None:
+                new_path = '%s#%s' % (depot_path, second_record['rev'])
+                self._write_file(new_path, tmp_diff_to_filename)
+                new_file = tmp_diff_to_filename
+                changetype_short = 'A'
+                base_revision = 0
+            elif second_record is None:
+                old_path = '%s#%s' % (depot_path, first_record['rev'])
+                self._write_file(old_path, tmp_diff_from_filename)
+                old_file = tmp_diff_from_filename
+                changetype_short = 'D'
+                base_revision = int(first_record['rev'])
+            else:
+                old_path = '%s#%s' % (depot_path, first_record['rev'])
+                new_path = '%s#%s' % (depot_path, second_record['rev'])
+                self._write_file(old_path, tmp_diff_from_filename)
+                self._write_file(new_path, tmp_diff_to_filename)
+                new_file = tmp_diff_to_filename
+                old_file = tmp_diff_from_filename
+                changetype_short = 'M'
+                base_revision = int(first_record['rev'])
+
+            # TODO: We're passing new_depot_file='' here just to make
+            # things work like they did before the moved file change was
+            # added (58ccae27). This section of code needs to be updated
+            # to properly work with moved files.
+            return self._do_diff(old_file, new_file, depot_path,
+                                 base_revision, '', changetype_short,
+                                 ignore_unmodified=True)
+
+        def diff_batch(batch):
+            # The batch's files are printed with one p4 command, and then
+            # diffed, while the other workers print and diff theirs.
+            print_paths = []
+
+            for depot_path, first_record, second_record in batch:
+                if first_record is not None:
+                    print_paths.append('%s#%s' % (depot_path,
+                                                  first_record['rev']))
+
+                if second_record is not None:
+                    print_paths.append('%s#%s' % (depot_path,
+                                                  second_record['rev']))
+
+            self._print_files(print_paths)
+
+            return [diff.make_file(diff_file(changed_file))
+                    for changed_file in batch]
+
+        try:
+            # The results are in the same order as the files.
+            for entries in run_parallel(
+                    diff_batch, self._iter_print_batches(changed_files)):
+                diff.add_files(entries)
+        finally:
+            self._clear_file_info()
+
+            for filename in [empty_filename] + scratch_filenames:
+                os.unlink(filename)
 
         return {
-            'diff': ''.join(diff_lines),
+            'diff': diff,
         }
 
     def sanitize_changenum(self, changenum):
@@ -844,18 +1764,21 @@ class PerforceClient(SCMClient):
 
         Returns a list of strings of diff lines.
         """
-        if hasattr(os, 'uname') and os.uname()[0] == 'SunOS':
-            diff_cmd = ["gdiff", "-urNp", old_file, new_file]
+        if getattr(self.options, 'builtin_diff', False):
+            diff_lines = diff_files(old_file, new_file, show_function=True)
         else:
-            diff_cmd = ["diff", "-urNp", old_file, new_file]
+            if hasattr(os, 'uname') and os.uname()[0] == 'SunOS':
+                diff_cmd = ["gdiff", "-urNp", old_file, new_file]
+            else:
+                diff_cmd = ["diff", "-urNp", old_file, new_file]
 
-        # Diff returns "1" if differences were found.
-        dl = execute(diff_cmd, extra_ignore_errors=(1, 2),
-                     translate_newlines=False)
+            # Diff returns "1" if differences were found.
+            diff_lines = execute(diff_cmd, extra_ignore_errors=(1, 2),
+                                 translate_newlines=False, split_lines=True,
+                                 stream=True)
 
         # If the input file has ^M characters at end of line, lets ignore them.
-        dl = dl.replace('\r\r\n', '\r\n')
-        dl = dl.splitlines(True)
+        dl = [line.replace('\r\r\n', '\r\n') for line in diff_lines]
 
         cwd = os.getcwd()
 
@@ -948,7 +1871,155 @@ class PerforceClient(SCMClient):
         Grabs a file from Perforce and writes it to a temp file. p4 print sets
         the file readonly and that causes a later call to unlink fail. So we
         make the file read/write.
+
+        Files at numbered revisions never change, so they're kept in the
+        revision cache and only printed the first time they're needed.
+        """
+        printed = self._printed_files.get(depot_path)
+
+        if isinstance(printed, ValueError):
+            raise printed
+        elif printed is not None:
+            logging.debug('Using printed "%s" for "%s"', printed, depot_path)
+            link_or_copy_file(printed, tmpfile)
+            return
+
+        get_revision_cache().fetch(
+            self._get_revision_cache_key(depot_path), tmpfile,
+            lambda filename: self._print_file(depot_path, filename))
+
+    def _print_files(self, depot_paths):
+        """Print a list of files from Perforce with a single p4 command.
+
+        Files which are in the revision cache aren't printed. _write_file
+        uses the printed files until _clear_file_info is called, and
+        raises a ValueError for any that couldn't be printed.
+        """
+        cache = get_revision_cache()
+        to_print = []
+
+        for depot_path in depot_paths:
+            if depot_path in self._printed_files:
+                continue
+
+            filename = make_tempfile()
+            cache_key = self._get_revision_cache_key(depot_path)
+
+            if cache_key is not None and cache.get(cache_key, filename):
+                self._printed_files[depot_path] = filename
+            else:
+                to_print.append((depot_path, filename, cache_key))
+
+        if not to_print:
+            return
+
+        logging.debug('Printing %d files', len(to_print))
+        errors = self.p4.print_files([(depot_path, filename)
+                                      for depot_path, filename, cache_key
+                                      in to_print],
+                                     line_end=self._get_line_end())
+
+        for (depot_path, filename, cache_key), error in zip(to_print, errors):
+            if error is self.p4.PRINT_THROUGH_CLIENT:
+                # _write_file will print these with 'p4 print -o'.
+                continue
+            elif error:
+                self._printed_files[depot_path] = ValueError(error)
+            else:
+                self._printed_files[depot_path] = filename
+
+                if cache_key is not None:
+                    cache.add(cache_key, filename)
+
+    def _where_files(self, depot_paths):
+        """Look up the local paths of a list of files with one p4 command.
+
+        _depot_to_local uses the results until _clear_file_info is called.
         """
+        depot_paths = [depot_path for depot_path in depot_paths
+                       if depot_path not in self._local_paths]
+
+        if depot_paths:
+            self._local_paths.update(self.p4.where_batch(depot_paths))
+
+    def _fstat_files(self, depot_paths, fields):
+        """Look up fstat information for a list of files with one p4 command.
+
+        _fstat uses the results until _clear_file_info is called.
+        """
+        depot_paths = [depot_path for depot_path in depot_paths
+                       if depot_path not in self._stat_infos]
+
+        if depot_paths:
+            self._stat_infos.update(self.p4.fstat_batch(depot_paths, fields))
+
+    def _fstat(self, depot_path, fields):
+        """Return fstat information for a file.
+
+        Information looked up by _fstat_files is used if it has all the
+        fields. Otherwise, p4 fstat is run for the file.
+        """
+        stat_info = self._stat_infos.get(depot_path)
+
+        if stat_info is not None:
+            for field in fields:
+                if field not in stat_info:
+                    break
+            else:
+                return stat_info
+
+        return self.p4.fstat(depot_path, fields)
+
+    def _clear_file_info(self):
+        """Forget the information looked up in bulk, and remove any files
+        printed by _print_files.
+        """
+        for printed in self._printed_files.itervalues():
+            if not isinstance(printed, ValueError):
+                try:
+                    os.unlink(printed)
+                except OSError:
+                    pass
+
+        self._printed_files = {}
+        self._local_paths = {}
+        self._stat_infos = {}
+        self._server_diffs = {}
+        self._server_diff_timestamp = None
+
+    def _get_revision_cache_key(self, depot_path):
+        """Return the revision cache key for a depot path, if it has one.
+
+        Only files at numbered revisions are cached, since they can't
+        change. Text files are written with the client's line endings, so
+        those are part of the key.
+        """
+        if self.server_address and re.match(r'^//.*#\d+$', depot_path):
+            return 'perforce:%s:%s:%s' % (self.server_address,
+                                          self._get_line_end().encode('hex'),
+                                          depot_path)
+
+        return None
+
+    def _get_line_end(self):
+        """Return the line ending the client writes text files with.
+
+        This comes from the client's LineEnd option, which is looked up
+        the first time it's needed.
+        """
+        if self._line_end is None:
+            client_spec = self.p4.client_spec()
+            line_end = 'local'
+
+            if client_spec and 'LineEnd' in client_spec[0]:
+                line_end = client_spec[0]['LineEnd']
+
+            self._line_end = self.LINE_ENDS.get(line_end, os.linesep)
+
+        return self._line_end
+
+    def _print_file(self, depot_path, tmpfile):
+        """Print a file from Perforce to a temp file, and make it writable."""
         logging.debug('Writing "%s" to "%s"' % (depot_path, tmpfile))
         self.p4.print_file(depot_path, out_file=tmpfile)
 
@@ -974,6 +2045,11 @@ class PerforceClient(SCMClient):
         the same file.  If there are multiple results, take only the last
         result from the where command.
         """
+        local_path = self._local_paths.get(depot_path)
+
+        if local_path is not None:
+            return local_path
+
         where_output = self.p4.where(depot_path)
 
         try:
@@ -5,9 +5,11 @@ import re
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.errors import (InvalidRevisionSpecError,
                                     TooManyRevisionsError)
+from rbtools.utils.cache import get_revision_cache
 from rbtools.utils.checks import check_install
-from rbtools.utils.filesystem import make_tempfile
-from rbtools.utils.process import die, execute
+from rbtools.utils.filesystem import make_tempfile, owns_tempfiles
+from rbtools.utils.process import die, execute, run_parallel
+from rbtools.utils.unified_diff import diff_files
 
 
 class PlasticClient(SCMClient):
@@ -17,6 +19,9 @@ class PlasticClient(SCMClient):
     """
     name = 'Plastic'
 
+    # The repository spec, used to key the revision cache.
+    repository_path = None
+
     def __init__(self, **kwargs):
         super(PlasticClient, self).__init__(**kwargs)
 
@@ -44,6 +49,7 @@ class PlasticClient(SCMClient):
             return None
 
         path = m.group(1)
+        self.repository_path = path
 
         return RepositoryInfo(path,
                               supports_changesets=True,
@@ -95,6 +101,7 @@ class PlasticClient(SCMClient):
         """ Return a "sanitized" change number.  Currently a no-op """
         return changenum
 
+    @owns_tempfiles
     def diff(self, args):
         """
         Performs a diff across all modified files in a Plastic workspace
@@ -124,6 +131,7 @@ class PlasticClient(SCMClient):
             'diff': diff,
         }
 
+    @owns_tempfiles
     def diff_between_revisions(self, revision_range, args, repository_info):
         """
         This doesn't make much sense in Plastic SCM 4.
@@ -134,88 +142,93 @@ class PlasticClient(SCMClient):
 
     def _process_diffs(self, my_diff_entries):
         # Diff generation based on perforce client
+        empty_filename = make_tempfile()
+
+        # The entries are diffed in parallel. Each one uses its own temporary
+        # files, and only reads the empty file.
+        entries = [f.strip() for f in my_diff_entries if f.strip()]
+        diffs = run_parallel(
+            lambda f: self._process_diff_entry(f, empty_filename), entries)
+
+        os.unlink(empty_filename)
+
+        return ''.join([''.join(dl) for dl in diffs])
+
+    def _process_diff_entry(self, f, empty_filename):
+        """Return the diff lines for an entry from 'cm log'."""
+        m = re.search(r'(?P<type>[ACMD]) (?P<file>.*) '
+                      r'(?P<revspec>rev:revid:[-\d]+) '
+                      r'(?P<parentrevspec>rev:revid:[-\d]+) '
+                      r'src:(?P<srcpath>.*) '
+                      r'dst:(?P<dstpath>.*)$',
+                      f)
+        if not m:
+            die("Could not parse 'cm log' response: %s" % f)
+
+        changetype = m.group("type")
+        filename = m.group("file")
         diff_lines = []
 
-        empty_filename = make_tempfile()
         tmp_diff_from_filename = make_tempfile()
         tmp_diff_to_filename = make_tempfile()
 
-        for f in my_diff_entries:
-            f = f.strip()
-
-            if not f:
-                continue
-
-            m = re.search(r'(?P<type>[ACMD]) (?P<file>.*) '
-                          r'(?P<revspec>rev:revid:[-\d]+) '
-                          r'(?P<parentrevspec>rev:revid:[-\d]+) '
-                          r'src:(?P<srcpath>.*) '
-                          r'dst:(?P<dstpath>.*)$',
-                          f)
-            if not m:
-                die("Could not parse 'cm log' response: %s" % f)
-
-            changetype = m.group("type")
-            filename = m.group("file")
-
-            if changetype == "M":
-                # Handle moved files as a delete followed by an add.
-                # Clunky, but at least it works
-                oldfilename = m.group("srcpath")
-                oldspec = m.group("revspec")
-                newfilename = m.group("dstpath")
-                newspec = m.group("revspec")
-
-                self._write_file(oldfilename, oldspec, tmp_diff_from_filename)
-                dl = self._diff_files(tmp_diff_from_filename, empty_filename,
-                                      oldfilename, "rev:revid:-1", oldspec,
-                                      changetype)
-                diff_lines += dl
-
-                self._write_file(newfilename, newspec, tmp_diff_to_filename)
-                dl = self._diff_files(empty_filename, tmp_diff_to_filename,
-                                      newfilename, newspec, "rev:revid:-1",
-                                      changetype)
-                diff_lines += dl
+        if changetype == "M":
+            # Handle moved files as a delete followed by an add.
+            # Clunky, but at least it works
+            oldfilename = m.group("srcpath")
+            oldspec = m.group("revspec")
+            newfilename = m.group("dstpath")
+            newspec = m.group("revspec")
+
+            self._write_file(oldfilename, oldspec, tmp_diff_from_filename)
+            dl = self._diff_files(tmp_diff_from_filename, empty_filename,
+                                  oldfilename, "rev:revid:-1", oldspec,
+                                  changetype)
+            diff_lines += dl
+
+            self._write_file(newfilename, newspec, tmp_diff_to_filename)
+            dl = self._diff_files(empty_filename, tmp_diff_to_filename,
+                                  newfilename, newspec, "rev:revid:-1",
+                                  changetype)
+            diff_lines += dl
 
+        else:
+            newrevspec = m.group("revspec")
+            parentrevspec = m.group("parentrevspec")
+
+            logging.debug("Type %s File %s Old %s New %s"
+                          % (changetype, filename, parentrevspec,
+                             newrevspec))
+
+            old_file = new_file = empty_filename
+
+            if (changetype in ['A'] or
+                (changetype in ['C'] and parentrevspec == "rev:revid:-1")):
+                # There's only one content to show
+                self._write_file(filename, newrevspec, tmp_diff_to_filename)
+                new_file = tmp_diff_to_filename
+            elif changetype in ['C']:
+                self._write_file(filename, parentrevspec,
+                                 tmp_diff_from_filename)
+                old_file = tmp_diff_from_filename
+                self._write_file(filename, newrevspec, tmp_diff_to_filename)
+                new_file = tmp_diff_to_filename
+            elif changetype in ['D']:
+                self._write_file(filename, parentrevspec,
+                                 tmp_diff_from_filename)
+                old_file = tmp_diff_from_filename
             else:
-                newrevspec = m.group("revspec")
-                parentrevspec = m.group("parentrevspec")
-
-                logging.debug("Type %s File %s Old %s New %s"
-                              % (changetype, filename, parentrevspec,
-                                 newrevspec))
-
-                old_file = new_file = empty_filename
-
-                if (changetype in ['A'] or
-                    (changetype in ['C'] and parentrevspec == "rev:revid:-1")):
-                    # There's only one content to show
-                    self._write_file(filename, newrevspec, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                elif changetype in ['C']:
-                    self._write_file(filename, parentrevspec,
-                                     tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                    self._write_file(filename, newrevspec, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                elif changetype in ['D']:
-                    self._write_file(filename, parentrevspec,
-                                     tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                else:
-                    die("Don't know how to handle change type '%s' for %s" %
-                        (changetype, filename))
-
-                dl = self._diff_files(old_file, new_file, filename,
-                                      newrevspec, parentrevspec, changetype)
-                diff_lines += dl
+                die("Don't know how to handle change type '%s' for %s" %
+                    (changetype, filename))
+
+            dl = self._diff_files(old_file, new_file, filename,
+                                  newrevspec, parentrevspec, changetype)
+            diff_lines += dl
 
-        os.unlink(empty_filename)
         os.unlink(tmp_diff_from_filename)
         os.unlink(tmp_diff_to_filename)
 
-        return ''.join(diff_lines)
+        return diff_lines
 
     def _diff_files(self, old_file, new_file, filename, newrevspec,
                     parentrevspec, changetype):
@@ -234,10 +247,13 @@ class PlasticClient(SCMClient):
         if filename.startswith(self.workspacedir):
             filename = filename[len(self.workspacedir):]
 
-        diff_cmd = ["diff", "-urN", old_file, new_file]
-        # Diff returns "1" if differences were found.
-        dl = execute(diff_cmd, extra_ignore_errors=(1, 2),
-                     translate_newlines = False)
+        if getattr(self.options, 'builtin_diff', False):
+            dl = ''.join(diff_files(old_file, new_file))
+        else:
+            diff_cmd = ["diff", "-urN", old_file, new_file]
+            # Diff returns "1" if differences were found.
+            dl = execute(diff_cmd, extra_ignore_errors=(1, 2),
+                         translate_newlines = False)
 
         # If the input file has ^M characters at end of line, lets ignore them.
         dl = dl.replace('\r\r\n', '\r\n')
@@ -270,7 +286,19 @@ class PlasticClient(SCMClient):
         return dl
 
     def _write_file(self, filename, filespec, tmpfile):
-        """ Grabs a file from Plastic and writes it to a temp file """
-        logging.debug("Writing '%s' (rev %s) to '%s'"
-                      % (filename, filespec, tmpfile))
-        execute(["cm", "cat", filespec, "--file=" + tmpfile])
+        """ Grabs a file from Plastic and writes it to a temp file
+
+        Revisions given by revid never change, so they're kept in the
+        revision cache and only fetched the first time they're needed.
+        """
+        if self.repository_path and re.match(r'^rev:revid:\d+$', filespec):
+            cache_key = 'plastic:%s:%s' % (self.repository_path, filespec)
+        else:
+            cache_key = None
+
+        def fetch(tmpfile):
+            logging.debug("Writing '%s' (rev %s) to '%s'"
+                          % (filename, filespec, tmpfile))
+            execute(["cm", "cat", filespec, "--file=" + tmpfile])
+
+        get_revision_cache().fetch(cache_key, tmpfile, fetch)
@@ -9,8 +9,9 @@ from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.errors import (InvalidRevisionSpecError,
                                     OptionsCheckError, TooManyRevisionsError)
 from rbtools.utils.checks import check_gnu_diff, check_install
+from rbtools.utils.diffs import spool_diff
 from rbtools.utils.filesystem import walk_parents
-from rbtools.utils.process import execute
+from rbtools.utils.process import execute, run_parallel
 
 
 class SVNClient(SCMClient):
@@ -27,6 +28,10 @@ class SVNClient(SCMClient):
     REVISION_WORKING_COPY = '--rbtools-working-copy'
     REVISION_CHANGELIST_PREFIX = '--rbtools-changelist:'
 
+    # The number of files looked up at once when converting the paths in
+    # a diff to absolute paths.
+    SVN_INFO_BATCH_SIZE = 32
+
     def __init__(self, **kwargs):
         super(SVNClient, self).__init__(**kwargs)
 
@@ -280,14 +285,14 @@ class SVNClient(SCMClient):
                 sys.exit(1)
             else:
                 if svn_show_copies_as_adds in 'Yy':
-                    cmd.append("--show-copies-as-adds")
+                    diff_cmd.append("--show-copies-as-adds")
 
-        diff = execute(cmd, split_lines=True)
+        diff = execute(diff_cmd, split_lines=True, stream=True)
         diff = self.handle_renames(diff)
         diff = self.convert_to_absolute_paths(diff, repository_info)
 
         return {
-            'diff': ''.join(diff),
+            'diff': spool_diff(diff),
         }
 
     def history_scheduled_with_commit(self):
@@ -344,15 +349,18 @@ class SVNClient(SCMClient):
         relative to its parent, the diff header doesn't reflect this.
         This function fixes the relevant section headers of the patch to
         portray this relationship.
+
+        The lines are generated as they're read from diff_content.
         """
 
         # svn diff against a repository URL on two revisions appears to
         # handle moved files properly, so only adjust the diff file names
         # if they were created using a working copy.
         if self.options.repository_url:
-            return diff_content
+            for line in diff_content:
+                yield line
 
-        result = []
+            return
 
         from_line = ""
         for line in diff_content:
@@ -365,61 +373,104 @@ class SVNClient(SCMClient):
                 to_file, _ = self.parse_filename_header(line[4:])
                 copied_from = self.find_copyfrom(to_file)
                 if copied_from is not None:
-                    result.append(from_line.replace(to_file, copied_from))
+                    yield from_line.replace(to_file, copied_from)
                 else:
-                    result.append(from_line)  # As is, no copy performed
+                    yield from_line  # As is, no copy performed
 
             # We only mangle '---' lines. All others get added straight to
             # the output.
-            result.append(line)
-
-        return result
+            yield line
 
     def convert_to_absolute_paths(self, diff_content, repository_info):
         """
         Converts relative paths in a diff output to absolute paths.
         This handles paths that have been svn switched to other parts of the
         repository.
-        """
 
-        result = []
+        The lines are generated as they're read from diff_content. Paths in
+        a working copy are looked up with 'svn info' in parallel, a batch of
+        files at a time, so lines are held back until their batch is done.
+        """
+        svn_infos = {}
+        lines = []
+        paths = []
 
         for line in diff_content:
-            front = None
-            orig_line = line
-            if (self.DIFF_NEW_FILE_LINE_RE.match(line)
-                or self.DIFF_ORIG_FILE_LINE_RE.match(line)
-                or line.startswith('Index: ')):
-                front, line = line.split(" ", 1)
-
-            if front:
-                if line.startswith('/'):  # Already absolute
-                    line = front + " " + line
+            lines.append(line)
+
+            if not self.options.repository_url:
+                path = self._get_relative_header_path(line)
+
+                if path is not None and path not in svn_infos:
+                    svn_infos[path] = None
+                    paths.append(path)
+
+            if not paths or len(paths) >= self.SVN_INFO_BATCH_SIZE:
+                self._fetch_svn_infos(paths, svn_infos)
+
+                for pending_line in lines:
+                    yield self._convert_header_path(pending_line, svn_infos,
+                                                    repository_info)
+
+                lines = []
+                paths = []
+
+        self._fetch_svn_infos(paths, svn_infos)
+
+        for line in lines:
+            yield self._convert_header_path(line, svn_infos, repository_info)
+
+    def _get_relative_header_path(self, line):
+        """Return the relative path in a diff header line, if any."""
+        if (self.DIFF_NEW_FILE_LINE_RE.match(line)
+            or self.DIFF_ORIG_FILE_LINE_RE.match(line)
+            or line.startswith('Index: ')):
+            line = line.split(" ", 1)[1]
+
+            if not line.startswith('/'):
+                return self.parse_filename_header(line)[0]
+
+        return None
+
+    def _fetch_svn_infos(self, paths, svn_infos):
+        """Look up the 'svn info' for several paths in parallel."""
+        results = run_parallel(lambda path: self.svn_info(path, True), paths)
+        svn_infos.update(zip(paths, results))
+
+    def _convert_header_path(self, line, svn_infos, repository_info):
+        """Return a diff line with any relative path made absolute."""
+        front = None
+        orig_line = line
+        if (self.DIFF_NEW_FILE_LINE_RE.match(line)
+            or self.DIFF_ORIG_FILE_LINE_RE.match(line)
+            or line.startswith('Index: ')):
+            front, line = line.split(" ", 1)
+
+        if front:
+            if line.startswith('/'):  # Already absolute
+                line = front + " " + line
+            else:
+                # Filename and rest of line (usually the revision
+                # component)
+                file, rest = self.parse_filename_header(line)
+
+                # If working with a diff generated outside of a working
+                # copy, then file paths are already absolute, so just
+                # add initial slash.
+                if self.options.repository_url:
+                    path = urllib.unquote(
+                        "%s/%s" % (repository_info.base_path, file))
                 else:
-                    # Filename and rest of line (usually the revision
-                    # component)
-                    file, rest = self.parse_filename_header(line)
-
-                    # If working with a diff generated outside of a working
-                    # copy, then file paths are already absolute, so just
-                    # add initial slash.
-                    if self.options.repository_url:
-                        path = urllib.unquote(
-                            "%s/%s" % (repository_info.base_path, file))
-                    else:
-                        info = self.svn_info(file, True)
-                        if info is None:
-                            result.append(orig_line)
-                            continue
-                        url = info["URL"]
-                        root = info["Repository Root"]
-                        path = urllib.unquote(url[len(root):])
-
-                    line = front + " " + path + rest
-
-            result.append(line)
-
-        return result
+                    info = svn_infos[file]
+                    if info is None:
+                        return orig_line
+                    url = info["URL"]
+                    root = info["Repository Root"]
+                    path = urllib.unquote(url[len(root):])
+
+                line = front + " " + path + rest
+
+        return line
 
     def svn_info(self, path, ignore_errors=False):
         """Return a dict which is the result of 'svn info' at a given path."""
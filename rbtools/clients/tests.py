@@ -1,5 +1,8 @@
+import binascii
+import marshal
 import os
 import re
+import struct
 import sys
 import time
 from hashlib import md5
@@ -11,7 +14,8 @@ from nose import SkipTest
 from nose.tools import raises
 
 from rbtools.api.capabilities import Capabilities
-from rbtools.clients import RepositoryInfo
+from rbtools.clients import (DetectionCache, find_scm_marker,
+                             RepositoryInfo)
 from rbtools.clients.bazaar import (
     BazaarClient,
     USING_PARENT_PREFIX as BZR_USING_PARENT_PREFIX)
@@ -21,8 +25,10 @@ from rbtools.clients.mercurial import MercurialClient
 from rbtools.clients.perforce import PerforceClient, P4Wrapper
 from rbtools.clients.svn import SVNRepositoryInfo, SVNClient
 from rbtools.tests import OptionsStub
+from rbtools.utils.cache import FileCache
 from rbtools.utils.filesystem import load_config_files, make_tempfile
-from rbtools.utils.process import execute
+from rbtools.utils.process import (execute, get_max_workers,
+                                   set_max_workers)
 from rbtools.utils.testbase import RBTestBase
 
 
@@ -35,6 +41,35 @@ class SCMClientTests(RBTestBase):
         self.clients_dir = os.path.dirname(__file__)
 
 
+class SCMMarkerTests(SCMClientTests):
+    def test_find_scm_marker_nearest(self):
+        """Testing find_scm_marker finds the nearest checkout"""
+        root_dir = self.chdir_tmp()
+        os.mkdir(os.path.join(root_dir, '.svn'))
+        os.makedirs(os.path.join(root_dir, 'a', 'b', '.git'))
+        os.mkdir(os.path.join(root_dir, 'a', 'b', 'c'))
+
+        self.assertEqual(find_scm_marker(os.path.join(root_dir, 'a')),
+                         ('svn', root_dir))
+        self.assertEqual(find_scm_marker(os.path.join(root_dir, 'a', 'b', 'c')),
+                         ('git', os.path.join(root_dir, 'a', 'b')))
+
+    def test_find_scm_marker_p4config(self):
+        """Testing find_scm_marker with $P4CONFIG"""
+        root_dir = self.chdir_tmp()
+        open(os.path.join(root_dir, '.p4config'), 'w').close()
+        old_p4config = os.environ.get('P4CONFIG')
+        os.environ['P4CONFIG'] = '.p4config'
+
+        try:
+            self.assertEqual(find_scm_marker(), ('perforce', root_dir))
+        finally:
+            if old_p4config is None:
+                del os.environ['P4CONFIG']
+            else:
+                os.environ['P4CONFIG'] = old_p4config
+
+
 class GitClientTests(SCMClientTests):
     TESTSERVER = "http://127.0.0.1:8080"
 
@@ -84,6 +119,151 @@ class GitClientTests(SCMClientTests):
         self.assertTrue(ri.supports_parent_diffs)
         self.assertFalse(ri.supports_changesets)
 
+    def test_get_repository_info_config(self):
+        """Testing GitClient get_repository_info reading the configuration"""
+        self._run_git(['checkout', '-b', 'Topic'])
+        self._run_git(['config', 'branch.Topic.remote', 'upstream'])
+        self._run_git(['config', 'branch.Topic.merge', 'refs/heads/dev'])
+        self._run_git(['config', 'remote.upstream.url',
+                       'git://example.com/old.git'])
+        self._run_git(['config', '--add', 'remote.upstream.url',
+                       'git://example.com/repo.git'])
+        self._run_git(['config', 'ReviewBoard.URL', 'multi\nline'])
+
+        os.mkdir('subdir')
+        os.chdir('subdir')
+        ri = self.client.get_repository_info()
+
+        self.assertEqual(os.path.realpath(os.getcwd()),
+                         os.path.realpath(self.clone_dir))
+        self.assertEqual(self.client.head_ref, 'refs/heads/Topic')
+        self.assertEqual(self.client.upstream_branch, 'upstream/dev')
+        self.assertEqual(ri.path, 'git://example.com/repo.git')
+        self.assertEqual(self.client._get_config('reviewboard.url'),
+                         'multi\nline')
+        self.assertEqual(self.client._get_config('branch.topic.remote'),
+                         None)
+
+        self._run_git(['checkout', '-q', '--detach'])
+        self.client.get_repository_info()
+        self.assertEqual(self.client.head_ref, '')
+
+    def test_detection_cache(self):
+        """Testing GitClient with the repository detection cache"""
+        # The cache is stored in the home directory, which mustn't be the
+        # shared testdata one.
+        self.set_user_home_tmp()
+
+        cache = DetectionCache(self.client, 'git', self.clone_dir,
+                               self.options)
+        self.assertTrue(cache.load() is None)
+
+        ri = self.client.get_repository_info()
+        cache.save(ri, os.getcwd())
+
+        client = GitClient(options=self.options)
+        cache = DetectionCache(client, 'git', self.clone_dir, self.options)
+        cached_ri = cache.load()
+
+        self.assertTrue(isinstance(cached_ri, RepositoryInfo))
+        self.assertEqual(cached_ri.path, ri.path)
+        self.assertEqual(cached_ri.base_path, ri.base_path)
+        self.assertEqual(client.type, 'git')
+        self.assertEqual(client.upstream_branch, self.client.upstream_branch)
+        self.assertEqual(client.head_ref, self.client.head_ref)
+
+        # Runs from another directory of the checkout don't replace the
+        # entry.
+        subdir = os.path.join(self.clone_dir, 'subdir')
+        os.mkdir(subdir)
+        os.chdir(subdir)
+        client = GitClient(options=self.options)
+        cache = DetectionCache(client, 'git', self.clone_dir, self.options)
+        self.assertTrue(cache.load() is None)
+        cache.save(client.get_repository_info(), subdir)
+
+        os.chdir(subdir)
+        cache = DetectionCache(GitClient(options=self.options), 'git',
+                               self.clone_dir, self.options)
+        self.assertTrue(cache.load() is not None)
+        self.assertEqual(os.getcwd(), cache.value['chdir'])
+
+        os.chdir(self.clone_dir)
+        cache = DetectionCache(GitClient(options=self.options), 'git',
+                               self.clone_dir, self.options)
+        self.assertTrue(cache.load() is not None)
+
+        # Changing the git configuration invalidates the cache.
+        time.sleep(0.01)
+        self._run_git(['config', 'remote.origin.url', 'git://example.com/'])
+        cache = DetectionCache(GitClient(options=self.options), 'git',
+                               self.clone_dir, self.options)
+        self.assertTrue(cache.load() is None)
+
+    def test_git_svn_metadata(self):
+        """Testing GitClient reading git-svn metadata without git-svn"""
+        uuid = '7c1d4dc6-6b55-4a7b-9ec4-bd1a2a4f0b3e'
+        repos_root = 'svn://svn.example.com/repo'
+
+        self._run_git(['config', 'svn-remote.svn.url', repos_root])
+        self._run_git(['config', 'svn-remote.svn.fetch',
+                       'trunk:refs/remotes/trunk'])
+        self._run_git(['config', 'svn-remote.svn.branches',
+                       'branches/*:refs/remotes/*'])
+
+        git_svn_dir = os.path.join(self.clone_dir, '.git', 'svn')
+        rev_map_dir = os.path.join(git_svn_dir, 'refs', 'remotes', 'trunk')
+        os.makedirs(rev_map_dir)
+        self._run_git(['config', '-f', os.path.join(git_svn_dir, '.metadata'),
+                       'svn-remote.svn.reposRoot', repos_root])
+
+        self._git_add_file_commit(
+            'foo.txt', FOO1,
+            'Imported revision\n\n'
+            'git-svn-id: %s/trunk@42 %s' % (repos_root, uuid))
+        svn_commit = self._git_get_head()
+        self._git_add_file_commit(
+            'foo.txt', FOO2,
+            'Not imported\n\n'
+            'git-svn-id: %s/trunk@43 %s' % (repos_root, uuid))
+        self._git_add_file_commit('foo.txt', FOO3, 'Local change')
+
+        fp = open(os.path.join(rev_map_dir, '.rev_map.%s' % uuid), 'wb')
+        fp.write(struct.pack('>I', 40) + '\x11' * 20)
+        fp.write(struct.pack('>I', 42) + binascii.unhexlify(svn_commit))
+        fp.write(struct.pack('>I', 43) + '\0' * 20)
+        fp.close()
+
+        ri = self.client.get_repository_info()
+
+        self.assertTrue(isinstance(ri, SVNRepositoryInfo))
+        self.assertEqual(ri.path, repos_root)
+        self.assertEqual(ri.base_path, '/trunk')
+        self.assertEqual(ri.uuid, uuid)
+        self.assertEqual(self.client.type, 'svn')
+        self.assertEqual(self.client.upstream_branch, 'refs/remotes/trunk')
+
+        self.assertEqual(self.client._find_svn_rev(svn_commit), '42')
+        self.assertEqual(self.client._find_svn_rev('HEAD^'), '')
+        self.assertEqual(self.client._find_svn_rev('HEAD'), '')
+
+    def test_get_git_p4_base(self):
+        """Testing GitClient finding the Perforce change for git-p4"""
+        self._git_add_file_commit(
+            'foo.txt', FOO1,
+            'Imported change\n\n'
+            '[git-p4: depot-paths = "//depot/project/": change = 1234]')
+        self._git_add_file_commit('foo.txt', FOO2, 'Local change')
+        head = self._git_get_head()
+
+        self.set_user_home_tmp()
+        self.client.get_repository_info()
+
+        self.assertEqual(self.client._get_git_p4_base('HEAD'),
+                         ('//depot/project/', '1234'))
+        self.assertEqual(FileCache('git-p4-changes').get(head),
+                         ['//depot/project/', '1234'])
+
     def test_scan_for_server_simple(self):
         """Testing GitClient scan_for_server, simple case"""
         ri = self.client.get_repository_info()
@@ -122,7 +302,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '69d4616cf985f6b10571036db744e2d8')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -143,7 +323,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          'c9a31264f773406edff57a8ed10d9acc')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -163,7 +343,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          'cfb79a46f7a35b07e21765608a7852f7')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -177,7 +357,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '69d4616cf985f6b10571036db744e2d8')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -199,7 +379,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '69d4616cf985f6b10571036db744e2d8')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -220,7 +400,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          'cfb79a46f7a35b07e21765608a7852f7')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -244,7 +424,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '69d4616cf985f6b10571036db744e2d8')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -265,7 +445,7 @@ class GitClientTests(SCMClientTests):
         self.assertTrue('diff' in result)
         self.assertTrue('parent_diff' in result)
         self.assertTrue('base_commit_id' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          'd2015ff5fd0297fd7f1210612f87b6b3')
         self.assertEqual(result['parent_diff'], None)
         self.assertEqual(result['base_commit_id'], base_commit_id)
@@ -548,7 +728,7 @@ class MercurialClientTests(MercurialTestBase):
         result = self.client.diff(None)
         self.assertTrue(isinstance(result, dict))
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '68c2bdccf52a4f0baddd0ac9f2ecb7d2')
 
     def test_diff_simple_multiple(self):
@@ -561,7 +741,7 @@ class MercurialClientTests(MercurialTestBase):
         self.assertTrue(isinstance(result, dict))
         self.assertTrue('diff' in result)
         print result['diff']
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '9c8796936646be5c7349973b0fceacbd')
 
     def test_diff_branch_diverge(self):
@@ -574,7 +754,7 @@ class MercurialClientTests(MercurialTestBase):
         result = self.client.diff(None)
         self.assertTrue(isinstance(result, dict))
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '6b12723baab97f346aa938005bc4da4d')
 
         self._run_hg(['update', '-C', 'default'])
@@ -582,7 +762,7 @@ class MercurialClientTests(MercurialTestBase):
         result = self.client.diff(None)
         self.assertTrue(isinstance(result, dict))
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '68c2bdccf52a4f0baddd0ac9f2ecb7d2')
 
     def test_parse_revision_spec_no_args(self):
@@ -867,7 +1047,7 @@ class MercurialSubversionClientTests(MercurialTestBase):
         self.assertTrue(isinstance(result, dict))
         self.assertEqual(len(result), 1)
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '2eb0a5f2149232c43a1745d90949fcd5')
 
     def testDiffSimpleMultiple(self):
@@ -882,7 +1062,7 @@ class MercurialSubversionClientTests(MercurialTestBase):
         self.assertTrue(isinstance(result, dict))
         self.assertEqual(len(result), 1)
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '3d007394de3831d61e477cbcfe60ece8')
 
     def testDiffOfRevision(self):
@@ -898,14 +1078,14 @@ class MercurialSubversionClientTests(MercurialTestBase):
         self.assertTrue(isinstance(result, dict))
         self.assertEqual(len(result), 1)
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '2eb0a5f2149232c43a1745d90949fcd5')
 
         result = self.client.diff(['5'])
         self.assertTrue(isinstance(result, dict))
         self.assertEqual(len(result), 1)
         self.assertTrue('diff' in result)
-        self.assertEqual(md5(result['diff']).hexdigest(),
+        self.assertEqual(md5(str(result['diff'])).hexdigest(),
                          '3d007394de3831d61e477cbcfe60ece8')
 
 
@@ -1098,8 +1278,16 @@ class PerforceClientTests(SCMClientTests):
     class P4DiffTestWrapper(P4Wrapper):
         def __init__(self):
             self._timestamp = time.mktime(time.gmtime(0))
+            self.printed = []
+            self.print_batches = []
+            self.single_lookups = []
+            self.change_status = 'pending'
+            self.described = []
+            self.diffed = []
+            self.line_end = 'unix'
 
         def fstat(self, depot_path, fields=[]):
+            self.single_lookups.append(('fstat', depot_path))
             assert depot_path in self.fstat_files
 
             fstat_info = self.fstat_files[depot_path]
@@ -1109,11 +1297,28 @@ class PerforceClientTests(SCMClientTests):
 
             return fstat_info
 
-        def opened(self, changenum):
-            return [info for info in self.repo_files
-                    if info['change'] == changenum]
+        def files(self, path):
+            return self.path_files[path]
+
+        def iter_files(self, path):
+            return iter(self.path_files[path])
+
+        def files_batch(self, paths):
+            files = {}
+
+            for path in paths:
+                for info in self.path_files.get(path, []):
+                    files[info['depotFile']] = info
+
+            return files
+
+        def iter_opened(self, changenum):
+            return iter([info for info in self.repo_files
+                         if info['change'] == changenum])
 
         def print_file(self, depot_path, out_file):
+            self.printed.append(depot_path)
+
             for info in self.repo_files:
                 if depot_path == '%s#%s' % (info['depotFile'], info['rev']):
                     fp = open(out_file, 'w')
@@ -1122,25 +1327,195 @@ class PerforceClientTests(SCMClientTests):
                     return
             assert False
 
+        def run_p4_batch(self, p4_args, batch_args, password=None):
+            if p4_args[0] == 'where':
+                for depot_path in batch_args:
+                    assert depot_path in self.where_files
+
+                    yield {
+                        'code': 'stat',
+                        'depotFile': depot_path,
+                        'path': self.where_files[depot_path],
+                    }
+
+                return
+            elif p4_args[0] == 'fstat':
+                for depot_path in batch_args:
+                    assert depot_path in self.fstat_files
+
+                    record = {
+                        'code': 'stat',
+                        'depotFile': depot_path,
+                    }
+                    record.update(self.fstat_files[depot_path])
+                    yield record
+
+                return
+
+            assert p4_args == ['print']
+            self.print_batches.append(batch_args)
+
+            for depot_path in batch_args:
+                self.printed.append(depot_path)
+
+                for info in self.repo_files:
+                    if depot_path == '%s#%s' % (info['depotFile'],
+                                                info['rev']):
+                        yield {
+                            'code': 'stat',
+                            'depotFile': info['depotFile'],
+                            'rev': info['rev'],
+                            'type': 'text',
+                        }
+                        yield {
+                            'code': 'text',
+                            'data': info['text'],
+                        }
+                        break
+                else:
+                    yield {
+                        'code': 'error',
+                        'data': '%s - no such file(s).\n' % depot_path,
+                    }
+
         def where(self, depot_path):
+            self.single_lookups.append(('where', depot_path))
             assert depot_path in self.where_files
 
             return [{
                 'path': self.where_files[depot_path],
             }]
 
+        def client_spec(self):
+            return [{
+                'Client': 'myclient',
+                'LineEnd': self.line_end,
+            }]
+
         def change(self, changenum):
             return [{
                 'Change': str(changenum),
                 'Date': '2013/01/02 22:33:44',
                 'User': 'joe@example.com',
-                'Status': 'pending',
+                'Status': self.change_status,
                 'Description': 'This is a test.\n',
             }]
 
+        def describe(self, changenum, shelved=False):
+            self.described.append((changenum, shelved))
+
+            return self.describe_lines
+
+        def diff2_batch(self, file_pairs):
+            self.diffed.append(file_pairs)
+
+            return self.diff2_lines
+
         def run_p4(self, *args, **kwargs):
             assert False
 
+    def test_read_records(self):
+        """Testing P4Wrapper reading marshalled records split across blocks
+        """
+        records = [
+            {'code': 'stat', 'depotFile': '//depot/a', 'rev': '1'},
+            {'code': 'text', 'data': 'x' * 100},
+            {'code': 'error', 'data': 'no such file(s).\n'},
+        ]
+        data = ''.join([marshal.dumps(record, 0) for record in records])
+
+        filename = make_tempfile()
+        fp = open(filename, 'wb')
+        fp.write(data)
+        fp.close()
+
+        wrapper = P4Wrapper()
+        wrapper.READ_BLOCK_SIZE = 7
+
+        fp = open(filename, 'rb')
+        self.assertEqual(list(wrapper._read_records(fp)),
+                         [(record, len(marshal.dumps(record, 0)))
+                          for record in records])
+        fp.close()
+
+        # A truncated record is an error.
+        fp = open(filename, 'wb')
+        fp.write(data[:-3])
+        fp.close()
+
+        fp = open(filename, 'rb')
+        self.assertRaises(ValueError, list, wrapper._read_records(fp))
+        fp.close()
+
+    def test_print_files(self):
+        """Testing P4Wrapper.print_files splitting up batched output"""
+        class TestWrapper(P4Wrapper):
+            def run_p4_batch(self, p4_args, batch_args, password=None):
+                self.args = (p4_args, batch_args)
+
+                return [
+                    {'code': 'stat', 'depotFile': '//depot/a', 'type': 'text'},
+                    {'code': 'text', 'data': 'line 1\n'},
+                    {'code': 'text', 'data': 'line 2\n'},
+                    {'code': 'error', 'data': '//depot/b#2 - no such file\n'},
+                    {'code': 'stat', 'depotFile': '//depot/c',
+                     'type': 'symlink'},
+                    {'code': 'text', 'data': '/etc/passwd'},
+                    {'code': 'stat', 'depotFile': '//depot/d',
+                     'type': 'binary'},
+                ]
+
+        filenames = [make_tempfile() for i in xrange(5)]
+        wrapper = TestWrapper()
+        errors = wrapper.print_files(zip(
+            ['//depot/a#1', '//depot/b#2', '//depot/c#1', '//depot/d#4',
+             '//depot/e#1'],
+            filenames))
+
+        self.assertEqual(wrapper.args,
+                         (['print'], ['//depot/a#1', '//depot/b#2',
+                                      '//depot/c#1', '//depot/d#4',
+                                      '//depot/e#1']))
+        self.assertEqual(errors, [
+            None,
+            '//depot/b#2 - no such file',
+            "'//depot/c#1' is a symlink",
+            None,
+            'No output from p4 print',
+        ])
+        self.assertEqual(open(filenames[0], 'r').read(), 'line 1\nline 2\n')
+        self.assertEqual(open(filenames[2], 'r').read(), '')
+        self.assertEqual(open(filenames[3], 'r').read(), '')
+
+    def test_print_files_line_end(self):
+        """Testing P4Wrapper.print_files with the client's line endings"""
+        class TestWrapper(P4Wrapper):
+            def run_p4_batch(self, p4_args, batch_args, password=None):
+                return [
+                    {'code': 'stat', 'depotFile': '//depot/a',
+                     'type': 'ktext'},
+                    {'code': 'text', 'data': 'line 1\nline '},
+                    {'code': 'text', 'data': '2\n'},
+                    {'code': 'stat', 'depotFile': '//depot/b',
+                     'type': 'binary'},
+                    {'code': 'binary', 'data': '\x00\n\x01'},
+                    {'code': 'stat', 'depotFile': '//depot/c',
+                     'type': 'utf16'},
+                    {'code': 'text', 'data': 'line 1\n'},
+                ]
+
+        filenames = [make_tempfile() for i in xrange(3)]
+        wrapper = TestWrapper()
+        errors = wrapper.print_files(
+            zip(['//depot/a#1', '//depot/b#1', '//depot/c#1'], filenames),
+            line_end='\r\n')
+
+        self.assertEqual(errors, [None, None, wrapper.PRINT_THROUGH_CLIENT])
+        self.assertEqual(open(filenames[0], 'rb').read(),
+                         'line 1\r\nline 2\r\n')
+        self.assertEqual(open(filenames[1], 'rb').read(), '\x00\n\x01')
+        self.assertEqual(open(filenames[2], 'rb').read(), '')
+
     def test_error_on_revision_range(self):
         """Testing PerforceClient with --revision-range causes an exit"""
         self.options.revision_range = "12345"
@@ -1152,7 +1527,10 @@ class PerforceClientTests(SCMClientTests):
         RB_URL = 'http://reviewboard.example.com/'
 
         class TestWrapper(P4Wrapper):
-            def counters(self):
+            def counter(self, name):
+                return self.counters().get(name, '0')
+
+            def counters(self, name_filter=None):
                 return {
                     'reviewboard.url': RB_URL,
                     'foo': 'bar',
@@ -1185,13 +1563,112 @@ class PerforceClientTests(SCMClientTests):
         self.assertEqual(info.path, SERVER_PATH)
         self.assertEqual(client.p4d_version, (2012, 2))
 
+    def test_repository_info_server_cache(self):
+        """Testing PerforceClient.get_repository_info caching per P4PORT"""
+        SERVER_PATH = 'perforce.example.com:1666'
+        RB_URL = 'http://reviewboard.example.com/'
+        calls = []
+
+        class TestWrapper(P4Wrapper):
+            def is_supported(self):
+                return True
+
+            def info(self):
+                calls.append('info')
+
+                return {
+                    'Server address': SERVER_PATH,
+                    'Server version': 'P4D/FREEBSD60X86_64/2012.2/525804 '
+                                      '(2012/09/18)',
+                }
+
+            def counter(self, name):
+                calls.append('counter')
+
+                return '0'
+
+            def counters(self, name_filter=None):
+                calls.append(('counters', name_filter))
+
+                return {
+                    'reviewboard.url.%s' % RB_URL.replace('/', '|'): '1',
+                }
+
+        self.set_user_home_tmp()
+        self.options.builtin_diff = True
+        old_environ = dict(os.environ)
+        os.environ.pop('P4CONFIG', None)
+        os.environ['P4PORT'] = SERVER_PATH
+
+        try:
+            for i in range(2):
+                client = PerforceClient(TestWrapper, options=self.options)
+                info = client.get_repository_info()
+
+                self.assertEqual(info.path, SERVER_PATH)
+                self.assertEqual(client.p4d_version, (2012, 2))
+                self.assertEqual(client.server_address, SERVER_PATH)
+                self.assertEqual(client.scan_for_server_counter(info), RB_URL)
+
+            # The second client used the cached information.
+            self.assertEqual(calls, ['info', 'counter',
+                                     ('counters', 'reviewboard.url.*')])
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+
+    def test_repository_info_after_server_counter(self):
+        """Testing PerforceClient.get_repository_info after only the server
+        URL was cached
+        """
+        SERVER_PATH = 'perforce.example.com:1666'
+        RB_URL = 'http://reviewboard.example.com/'
+
+        class TestWrapper(P4Wrapper):
+            def is_supported(self):
+                return True
+
+            def info(self):
+                return {
+                    'Server address': SERVER_PATH,
+                    'Server version': 'P4D/FREEBSD60X86_64/2012.2/525804 '
+                                      '(2012/09/18)',
+                }
+
+            def counter(self, name):
+                return RB_URL
+
+        self.set_user_home_tmp()
+        self.options.builtin_diff = True
+        old_environ = dict(os.environ)
+        os.environ.pop('P4CONFIG', None)
+        os.environ['P4PORT'] = SERVER_PATH
+
+        try:
+            client = PerforceClient(TestWrapper, options=self.options)
+            self.assertEqual(client.scan_for_server_counter(None), RB_URL)
+
+            client = PerforceClient(TestWrapper, options=self.options)
+            info = client.get_repository_info()
+
+            self.assertEqual(info.path, SERVER_PATH)
+            self.assertEqual(client.server_address, SERVER_PATH)
+            self.assertEqual(client.p4d_version, (2012, 2))
+            self.assertEqual(client.scan_for_server_counter(info), RB_URL)
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+
     def test_scan_for_server_counter_with_reviewboard_url_encoded(self):
         """Testing PerforceClient.scan_for_server_counter with encoded reviewboard.url.http:||"""
         URL_KEY = 'reviewboard.url.http:||reviewboard.example.com/'
         RB_URL = 'http://reviewboard.example.com/'
 
         class TestWrapper(P4Wrapper):
-            def counters(self):
+            def counter(self, name):
+                return self.counters().get(name, '0')
+
+            def counters(self, name_filter=None):
                 return {
                     URL_KEY: '1',
                     'foo': 'bar',
@@ -1204,7 +1681,295 @@ class PerforceClientTests(SCMClientTests):
 
     def test_diff_with_changenum(self):
         """Testing PerforceClient.diff with changenums"""
+        self._test_diff_with_changenum()
+
+    def test_diff_with_changenum_builtin_diff(self):
+        """Testing PerforceClient.diff with changenums and the builtin diff"""
+        self.options.builtin_diff = True
+        self._test_diff_with_changenum()
+
+    def test_diff_with_changenum_revision_cache(self):
+        """Testing PerforceClient.diff with changenums and the revision cache
+        """
+        self.set_user_home_tmp()
+
+        client = self._test_diff_with_changenum('perforce.example.com:1666')
+        self.assertTrue('//mydepot/test/README#2' in client.p4.printed)
+
+        # Posting again should use the cached base revision.
+        client = self._test_diff_with_changenum('perforce.example.com:1666')
+        self.assertFalse('//mydepot/test/README#2' in client.p4.printed)
+
+    def test_diff_with_changenum_line_end(self):
+        """Testing PerforceClient.diff with changenums and a client's
+        LineEnd
+        """
         client = self._build_client()
+        client.server_address = 'perforce.example.com:1666'
+        client.p4.line_end = 'win'
+        client.p4.repo_files = [
+            {
+                'depotFile': '//mydepot/test/README',
+                'rev': '2',
+                'action': 'edit',
+                'change': '12345',
+                'text': 'This is a test.\nGoodbye.\n',
+            },
+        ]
+
+        readme_file = make_tempfile('This is a test.\r\nHello.\r\n')
+        client.p4.where_files = {
+            '//mydepot/test/README': readme_file,
+        }
+
+        diff = str(client.diff(['12345'])['diff'])
+
+        self.assertTrue(' This is a test.\r\n' in diff)
+        self.assertTrue('-Goodbye.\r\n+Hello.\r\n' in diff)
+
+        # The printed files are cached for each kind of line ending.
+        key = client._get_revision_cache_key('//mydepot/test/README#2')
+        client = self._build_client()
+        client.server_address = 'perforce.example.com:1666'
+        self.assertNotEqual(
+            client._get_revision_cache_key('//mydepot/test/README#2'), key)
+
+    def test_diff_submitted(self):
+        """Testing PerforceClient.diff with a submitted changenum"""
+        client = self._build_client()
+        client.p4.change_status = 'submitted'
+        client.p4.repo_files = [
+            {
+                'depotFile': '//mydepot/test/COPYING',
+                'rev': '1',
+                'text': 'Copyright 2013 Joe User.\n',
+            },
+            {
+                'depotFile': '//mydepot/test/Makefile',
+                'rev': '2',
+                'text': 'all: all\n',
+            },
+        ]
+        client.p4.describe_lines = [
+            'Change 12345 by joe@myclient on 2013/01/02 22:33:44\n',
+            '\n',
+            '\tThis is a test.\n',
+            '\n',
+            'Affected files ...\n',
+            '\n',
+            '... //mydepot/test/README#3 edit\n',
+            '... //mydepot/test/COPYING#1 add\n',
+            '... //mydepot/test/Makefile#3 delete\n',
+            '... //mydepot/test/logo.png#2 edit\n',
+            '\n',
+            'Differences ...\n',
+            '\n',
+            '==== //mydepot/test/README#3 (text) ====\n',
+            '\n',
+            '@@ -1,3 +1,3 @@\n',
+            ' This is a test.\n',
+            '\n',
+            '-Goodbye.\n',
+            '+Hello.\n',
+            '\n',
+            '==== //mydepot/test/logo.png#2 (binary) ====\n',
+            '\n',
+        ]
+
+        diff = str(client.diff(['12345'])['diff'])
+
+        self.assertEqual(client.p4.described, [('12345', False)])
+        self.assertEqual(sorted(client.p4.printed),
+                         ['//mydepot/test/COPYING#1',
+                          '//mydepot/test/Makefile#2'])
+
+        self.assertTrue(diff.startswith(
+            '--- //mydepot/test/README\t//mydepot/test/README#2\n'
+            '+++ //mydepot/test/README\t2013-01-02 22:33:44\n'
+            '@@ -1,3 +1,3 @@\n'
+            ' This is a test.\n'
+            ' \n'
+            '-Goodbye.\n'
+            '+Hello.\n'
+            '--- //mydepot/test/COPYING\t//mydepot/test/COPYING#0\n'))
+        self.assertTrue('+Copyright 2013 Joe User.\n' in diff)
+        self.assertTrue(
+            '--- //mydepot/test/Makefile\t//mydepot/test/Makefile#2\n'
+            in diff)
+        self.assertTrue('-all: all\n' in diff)
+        self.assertTrue(diff.endswith(
+            '==== //mydepot/test/logo.png#1 ==M== //mydepot/test/logo.png '
+            '====\n'
+            'Binary files //mydepot/test/logo.png#1 and '
+            '//mydepot/test/logo.png#2 differ\n'
+            '\n'))
+
+    def test_diff_submitted_range(self):
+        """Testing PerforceClient.diff with a range of submitted changenums"""
+        client = self._build_client()
+        client.p4.change_status = 'submitted'
+        client.p4.repo_files = [
+            {
+                'depotFile': '//mydepot/test/COPYING',
+                'rev': '1',
+                'text': 'Copyright 2013 Joe User.\n',
+            },
+        ]
+        client.p4.path_files = {
+            '//...@12341,@12345': [
+                {'code': 'stat', 'depotFile': '//mydepot/test/README',
+                 'rev': '3', 'action': 'edit', 'type': 'text'},
+                {'code': 'stat', 'depotFile': '//mydepot/test/NEWS',
+                 'rev': '2', 'action': 'edit', 'type': 'text'},
+                {'code': 'stat', 'depotFile': '//mydepot/test/COPYING',
+                 'rev': '1', 'action': 'add', 'type': 'text'},
+            ],
+            '//mydepot/test/README@12340': [
+                {'code': 'stat', 'depotFile': '//mydepot/test/README',
+                 'rev': '1', 'action': 'add'},
+            ],
+            '//mydepot/test/NEWS@12340': [
+                {'code': 'stat', 'depotFile': '//mydepot/test/NEWS',
+                 'rev': '1', 'action': 'add'},
+            ],
+        }
+        client.p4.diff2_lines = [
+            '==== //mydepot/test/NEWS#1 (text) - '
+            '//mydepot/test/NEWS#2 (text) ==== identical\n',
+            '==== //mydepot/test/README#1 (text) - '
+            '//mydepot/test/README#3 (text) ==== content\n',
+            '@@ -1 +1 @@\n',
+            '-This is a test.\n',
+            '+This is a mess.\n',
+        ]
+
+        diff = str(client.diff(['12340', '12345'])['diff'])
+
+        self.assertEqual(client.p4.diffed,
+                         [[('//mydepot/test/README#1',
+                            '//mydepot/test/README#3'),
+                           ('//mydepot/test/NEWS#1',
+                            '//mydepot/test/NEWS#2')]])
+        self.assertEqual(client.p4.printed, ['//mydepot/test/COPYING#1'])
+        self.assertTrue(diff.startswith(
+            '--- //mydepot/test/README\t//mydepot/test/README#1\n'
+            '+++ //mydepot/test/README\t2013-01-02 22:33:44\n'
+            '@@ -1 +1 @@\n'
+            '-This is a test.\n'
+            '+This is a mess.\n'
+            '--- //mydepot/test/COPYING\t//mydepot/test/COPYING#0\n'))
+        self.assertTrue('+Copyright 2013 Joe User.\n' in diff)
+        self.assertFalse('NEWS' in diff)
+
+    def test_path_diff_range(self):
+        """Testing PerforceClient.diff with a path and revision range"""
+        client = self._build_client()
+        client.MAX_PRINT_BATCH_SIZE = 1
+        client.p4.change_status = None
+        client.p4.repo_files = [
+            {
+                'depotFile': '//mydepot/test/README',
+                'rev': '1',
+                'text': 'This is a test.\n',
+            },
+            {
+                'depotFile': '//mydepot/test/README',
+                'rev': '2',
+                'text': 'This is a mess.\n',
+            },
+            {
+                'depotFile': '//mydepot/test/Makefile',
+                'rev': '1',
+                'text': 'all: all\n',
+            },
+            {
+                'depotFile': '//mydepot/test/NEWS',
+                'rev': '1',
+                'text': 'Nothing new.\n',
+            },
+        ]
+        client.p4.path_files = {
+            '//mydepot/test/...@1': [
+                {'depotFile': '//mydepot/test/README', 'rev': '1',
+                 'action': 'add'},
+                {'depotFile': '//mydepot/test/Makefile', 'rev': '1',
+                 'action': 'add'},
+                {'depotFile': '//mydepot/test/COPYING', 'rev': '1',
+                 'action': 'add'},
+            ],
+            '//mydepot/test/...@2': [
+                {'depotFile': '//mydepot/test/README', 'rev': '2',
+                 'action': 'edit'},
+                {'depotFile': '//mydepot/test/Makefile', 'rev': '2',
+                 'action': 'delete'},
+                {'depotFile': '//mydepot/test/NEWS', 'rev': '1',
+                 'action': 'add'},
+                {'depotFile': '//mydepot/test/COPYING', 'rev': '1',
+                 'action': 'add'},
+            ],
+        }
+
+        old_max_workers = get_max_workers()
+        set_max_workers(2)
+
+        try:
+            diff = str(client.diff(['//mydepot/test/...@1,@2'])['diff'])
+        finally:
+            set_max_workers(old_max_workers)
+
+        self.assertEqual(
+            [line.split('\t')[0] for line in diff.splitlines()
+             if line.startswith('--- ')],
+            ['--- //mydepot/test/Makefile', '--- //mydepot/test/NEWS',
+             '--- //mydepot/test/README'])
+        self.assertTrue('-all: all\n' in diff)
+        self.assertTrue('+Nothing new.\n' in diff)
+        self.assertTrue('-This is a test.\n+This is a mess.\n' in diff)
+        self.assertFalse('//mydepot/test/COPYING#1' in client.p4.printed)
+
+    def test_parse_server_diff(self):
+        """Testing PerforceClient._parse_server_diff with p4 diff2 output"""
+        client = self._build_client()
+        affected_files, diffs = client._parse_server_diff([
+            '==== //depot/a#1 (text) - //depot/a#1 (text) ==== identical\n',
+            '==== //depot/b#2 (text) - //depot/b#4 (ktext) ==== content\n',
+            '@@ -1,2 +0,0 @@\n',
+            '-one\n',
+            '-two\n',
+            '\\ No newline at end of file\n',
+            '==== <none> - //depot/c#1 ====\n',
+        ])
+
+        self.assertEqual(affected_files, [])
+        self.assertEqual(diffs, [
+            (('//depot/b', 2, 'text'), ('//depot/b', 4, 'ktext'),
+             ['@@ -1,2 +0,0 @@\n', '-one\n', '-two\n',
+              '\\ No newline at end of file\n']),
+            (None, ('//depot/c', 1, None), []),
+        ])
+
+    def test_diff_with_changenum_print_batches(self):
+        """Testing PerforceClient.diff with changenums printed in batches"""
+        old_max_workers = get_max_workers()
+        set_max_workers(2)
+
+        try:
+            client = self._test_diff_with_changenum(max_print_batch_size=1)
+        finally:
+            set_max_workers(old_max_workers)
+
+        self.assertEqual(sorted(client.p4.print_batches),
+                         [['//mydepot/test/Makefile#3'],
+                          ['//mydepot/test/README#2']])
+
+    def _test_diff_with_changenum(self, server_address=None,
+                                  max_print_batch_size=None):
+        client = self._build_client()
+        client.server_address = server_address
+
+        if max_print_batch_size is not None:
+            client.MAX_PRINT_BATCH_SIZE = max_print_batch_size
+
         client.p4.repo_files = [
             {
                 'depotFile': '//mydepot/test/README',
@@ -1248,6 +2013,9 @@ class PerforceClientTests(SCMClientTests):
 
         diff = client.diff(['12345'])
         self._compare_diff(diff, '07aa18ff67f9aa615fcda7ecddcb354e')
+        self.assertEqual(client.p4.single_lookups, [])
+
+        return client
 
     def test_diff_with_moved_files_cap_on(self):
         """Testing PerforceClient.diff with moved files and capability on"""
@@ -1265,6 +2033,11 @@ class PerforceClientTests(SCMClientTests):
         """Testing PerforceClient.diff with moved files and capability off"""
         self._test_diff_with_moved_files('20e5ab395e170dce1b062a796e6c2c13')
 
+    def test_diff_with_moved_files_builtin_diff(self):
+        """Testing PerforceClient.diff with moved files and the builtin diff"""
+        self.options.builtin_diff = True
+        self._test_diff_with_moved_files('20e5ab395e170dce1b062a796e6c2c13')
+
     def _test_diff_with_moved_files(self, expected_diff_hash, caps={}):
         client = self._build_client()
         client.capabilities = Capabilities(caps)
@@ -1337,6 +2110,9 @@ class PerforceClientTests(SCMClientTests):
         diff = client.diff(['12345'])
         self._compare_diff(diff, expected_diff_hash)
 
+        # The client paths and move information are all looked up in bulk.
+        self.assertEqual(client.p4.single_lookups, [])
+
     def _build_client(self):
         self.options.p4_client = 'myclient'
         self.options.p4_port = 'perforce.example.com:1666'
@@ -1352,7 +2128,7 @@ class PerforceClientTests(SCMClientTests):
 
         diff_content = re.sub('\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}',
                               '1970-01-01 00:00:00',
-                              diff_info['diff'])
+                              str(diff_info['diff']))
         print diff_content
         self.assertEqual(md5(diff_content).hexdigest(), expected_diff_hash)
 
@@ -1540,7 +2316,7 @@ class BazaarClientTests(SCMClientTests):
         """
         Testing that the full_diff for ``filename`` matches the ``expected_diff``.
         """
-        diff_lines = full_diff.splitlines()
+        diff_lines = str(full_diff).splitlines()
 
         self.assertEqual("=== modified file %r" % filename, diff_lines[0])
         self.assertTrue(diff_lines[1].startswith("--- %s\t" % filename))
@@ -2,16 +2,24 @@ import getpass
 import inspect
 import logging
 import sys
+import threading
 from optparse import make_option, OptionParser
 from urlparse import urlparse
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 from rbtools.api.capabilities import Capabilities
 from rbtools.api.client import RBClient
-from rbtools.api.errors import APIError, ServerInterfaceError
-from rbtools.clients import scan_usable_client
+from rbtools.api.errors import (APIError, ServerInterfaceError,
+                                ServerTimeoutError)
+from rbtools.clients import scan_for_server, scan_usable_client
 from rbtools.clients.errors import OptionsCheckError
 from rbtools.utils.filesystem import cleanup_tempfiles, load_config
-from rbtools.utils.process import die
+from rbtools.utils.process import (die, set_max_workers, start_profiling,
+                                   stop_profiling)
 
 
 RB_MAIN = "rbt"
@@ -96,10 +104,64 @@ class Command(object):
                config_key="DEBUG",
                default=False,
                help="display debug output"),
+        Option("--debug-profile",
+               action="store_true",
+               dest="debug_profile",
+               default=False,
+               help="display a report of the external commands which "
+                    "were run, and the time they took"),
+        Option("--debug-profile-file",
+               dest="debug_profile_file",
+               default=None,
+               metavar="FILENAME",
+               help="write a profile of the external commands which were "
+                    "run to FILENAME, as JSON"),
+        Option("--builtin-diff",
+               action="store_true",
+               dest="builtin_diff",
+               config_key="BUILTIN_DIFF",
+               default=False,
+               help="compare files with RBTools' own diff engine instead "
+                    "of running GNU diff for each one (Perforce, ClearCase "
+                    "and Plastic)"),
+        Option("--jobs",
+               dest="jobs",
+               type="int",
+               config_key="JOBS",
+               default=None,
+               metavar="COUNT",
+               help="the number of external commands to run in parallel "
+                    "(defaults to the number of CPUs)"),
+        Option("--connect-timeout",
+               dest="connect_timeout",
+               type="float",
+               config_key="CONNECT_TIMEOUT",
+               default=None,
+               metavar="SECONDS",
+               help="the number of seconds to wait for a connection to "
+                    "the Review Board server"),
+        Option("--read-timeout",
+               dest="read_timeout",
+               type="float",
+               config_key="READ_TIMEOUT",
+               default=None,
+               metavar="SECONDS",
+               help="the number of seconds to wait for data from the "
+                    "Review Board server"),
+        Option("--deadline",
+               dest="deadline",
+               type="float",
+               config_key="DEADLINE",
+               default=None,
+               metavar="SECONDS",
+               help="the total number of seconds allowed for all "
+                    "requests to the Review Board server"),
     ]
 
     def __init__(self):
         self.log = logging.getLogger('rb.%s' % self.name)
+        self._bootstrap_root = None
+        self._bootstrap_resources = {}
 
     def create_parser(self, config):
         """Create and return the ``OptionParser`` which will be used to
@@ -154,32 +216,65 @@ class Command(object):
         if self.options.debug:
             logging.getLogger().setLevel(logging.DEBUG)
 
+        if self.options.jobs is not None:
+            set_max_workers(self.options.jobs)
+
+        if self.options.debug_profile or self.options.debug_profile_file:
+            start_profiling()
+
         try:
-            exit_code = self.main(*args) or 0
-        except CommandError, e:
-            if isinstance(e, ParseError):
-                parser.error(e)
-            elif self.options.debug:
-                raise
-
-            logging.error(e)
-            exit_code = 1
-        except CommandExit, e:
-            exit_code = e.exit_code
-        except Exception, e:
-            # If debugging is on, we'll let python spit out the
-            # stack trace and report the exception, otherwise
-            # we'll suppress the trace and print the exception
-            # manually.
-            if self.options.debug:
-                raise
-
-            logging.critical(e)
-            exit_code = 1
+            try:
+                exit_code = self.main(*args) or 0
+            except CommandError, e:
+                if isinstance(e, ParseError):
+                    parser.error(e)
+                elif self.options.debug:
+                    raise
+
+                logging.error(e)
+                exit_code = 1
+            except CommandExit, e:
+                exit_code = e.exit_code
+            except Exception, e:
+                # If debugging is on, we'll let python spit out the
+                # stack trace and report the exception, otherwise
+                # we'll suppress the trace and print the exception
+                # manually.
+                if self.options.debug:
+                    raise
+
+                logging.critical(e)
+                exit_code = 1
+        finally:
+            # The profile is written even if the command exited early,
+            # since that's often when it's wanted.
+            self.write_profile()
 
         cleanup_tempfiles()
         sys.exit(exit_code)
 
+    def write_profile(self):
+        """Output the profile of external commands, if one was requested."""
+        profile = stop_profiling()
+
+        if profile is None:
+            return
+
+        if self.options.debug_profile:
+            sys.stderr.write('\n%s' % profile.get_report())
+
+        if self.options.debug_profile_file:
+            try:
+                f = open(self.options.debug_profile_file, 'w')
+
+                try:
+                    json.dump(profile.serialize(), f, indent=2)
+                finally:
+                    f.close()
+            except IOError, e:
+                logging.error('Unable to write the profile to %s: %s',
+                              self.options.debug_profile_file, e)
+
     def initialize_scm_tool(self, client_name=None):
         """Initialize the SCM tool for the current working directory."""
         repository_info, tool = scan_usable_client(self.options,
@@ -208,7 +303,7 @@ class Command(object):
         if self.options.server:
             server_url = self.options.server
         else:
-            server_url = tool.scan_for_server(repository_info)
+            server_url = scan_for_server(tool, repository_info)
 
         if not server_url:
             print ("Unable to find a Review Board server "
@@ -285,29 +380,102 @@ class Command(object):
                         username=self.options.username,
                         password=self.options.password,
                         auth_callback=self.credentials_prompt,
-                        otp_token_callback=self.otp_token_prompt)
+                        otp_token_callback=self.otp_token_prompt,
+                        connect_timeout=self.options.connect_timeout,
+                        read_timeout=self.options.read_timeout,
+                        deadline=self.options.deadline)
 
-    def get_api(self, server_url):
+    def get_api(self, server_url, bootstrap=None):
         """Returns an RBClient instance and the associated root resource.
 
         Commands should use this method to gain access to the API,
         instead of instantianting their own client.
+
+        The names of any resources the command will fetch with
+        ``get_bootstrapped_resource`` can be passed as 'bootstrap', to
+        prefetch them.
         """
         api_client = self._make_api_client(server_url)
 
         try:
             api_root = api_client.get_root()
+        except ServerTimeoutError, e:
+            raise CommandError("Could not reach the Review Board "
+                               "server at %s: %s" % (server_url, e))
         except ServerInterfaceError, e:
             raise CommandError("Could not reach the Review Board "
                                "server at %s" % server_url)
         except APIError, e:
             raise CommandError("Unexpected API Error: %s" % e)
 
+        self.bootstrap_api(api_root, bootstrap or [])
+
         return api_client, api_root
 
+    def bootstrap_api(self, api_root, names):
+        """Prefetch resources the command will need from the server.
+
+        Only the root resource is a real dependency of resources such as
+        info and session, since they can be fetched through the root's URI
+        templates. They are therefore requested concurrently, and the
+        results are kept for ``get_bootstrapped_resource``.
+
+        The last resource is fetched on the calling thread, so that if the
+        server asks for credentials, the prompt normally comes from the
+        main thread.
+        """
+        self._bootstrap_root = api_root
+        self._bootstrap_resources = {}
+        threads = []
+
+        def fetch(name, method):
+            try:
+                self._bootstrap_resources[name] = method()
+            except Exception, e:
+                # Errors are deliberately not reported here. The resource
+                # will be fetched again when it's used, and any error will
+                # be raised from there.
+                logging.debug('Unable to prefetch the %s resource: %s',
+                              name, e)
+
+        methods = []
+
+        for name in names:
+            method = getattr(api_root, 'get_%s' % name, None)
+
+            if method is not None:
+                methods.append((name, method))
+
+        for name, method in methods[:-1]:
+            thread = threading.Thread(target=fetch, args=(name, method))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        if methods:
+            fetch(*methods[-1])
+
+        for thread in threads:
+            # Joining with a timeout keeps the main thread responsive to
+            # KeyboardInterrupt while the requests are in flight.
+            while thread.is_alive():
+                thread.join(0.1)
+
+    def get_bootstrapped_resource(self, api_root, name):
+        """Return a resource prefetched by ``bootstrap_api``.
+
+        If the resource wasn't prefetched for this root, or the prefetch
+        failed, it will be fetched now.
+        """
+        if (api_root is self._bootstrap_root and
+            name in self._bootstrap_resources):
+            return self._bootstrap_resources[name]
+
+        return getattr(api_root, 'get_%s' % name)()
+
     def get_capabilities(self, api_root):
         """Retrieve Capabilities from the server and return them."""
-        info = api_root.get_info()
+        info = self.get_bootstrapped_resource(api_root, 'info')
 
         if 'capabilities' in info:
             return Capabilities(info.capabilities)
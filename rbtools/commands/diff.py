@@ -1,5 +1,7 @@
+import sys
+
 from rbtools.commands import Command, Option
-from rbtools.utils.diffs import get_diff
+from rbtools.utils.diffs import DiffSet, get_diff
 
 
 class Diff(Command):
@@ -89,6 +91,14 @@ class Diff(Command):
                default=None,
                help="the Perforce password or ticket of the user "
                     "in the P4USER environment variable"),
+        Option("--p4-server-diff",
+               action="store_true",
+               dest="p4_server_diff",
+               config_key="P4_SERVER_DIFF",
+               default=False,
+               help="have the Perforce server diff the edited files in "
+                    "shelved changes, instead of printing both revisions "
+                    "of each and diffing them locally"),
     ]
 
     def main(self, *args):
@@ -112,5 +122,11 @@ class Diff(Command):
 
         diff = diff_info['diff']
 
-        if diff:
+        if isinstance(diff, DiffSet):
+            # The diff may be spooled to disk, so it's written out in
+            # pieces rather than as one string.
+            if diff:
+                diff.write_to(sys.stdout)
+                print
+        elif diff:
             print diff
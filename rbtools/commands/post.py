@@ -6,7 +6,7 @@ import sys
 from rbtools.api.errors import APIError
 from rbtools.commands import Command, CommandError, Option
 from rbtools.utils.console import confirm
-from rbtools.utils.diffs import get_diff
+from rbtools.utils.diffs import DiffSet, get_diff
 from rbtools.utils.match_score import Score
 from rbtools.utils.repository import get_repository_id
 from rbtools.utils.users import get_user
@@ -177,6 +177,14 @@ class Post(Command):
                default=None,
                help="the Perforce password or ticket of the user "
                     "in the P4USER environment variable"),
+        Option("--p4-server-diff",
+               action="store_true",
+               dest="p4_server_diff",
+               config_key="P4_SERVER_DIFF",
+               default=False,
+               help="have the Perforce server diff the edited files in "
+                    "shelved changes, instead of printing both revisions "
+                    "of each and diffing them locally"),
         Option("--svn-show-copies-as-adds",
                dest="svn_show_copies_as_adds",
                metavar="y/n",
@@ -392,7 +400,9 @@ class Post(Command):
         the user is prompted to select from a list of potential matches,
         sorted by the highest ranked match first.
         """
-        user = get_user(api_client, api_root, auth_required=True)
+        user = get_user(
+            api_client, api_root, auth_required=True,
+            session=self.get_bootstrapped_resource(api_root, 'session'))
         repository_id = get_repository_id(
             repository_info, api_root, self.options.repository_url)
 
@@ -599,7 +609,13 @@ class Post(Command):
         repository_info, tool = self.initialize_scm_tool(
             client_name=self.options.repository_type)
         server_url = self.get_server_url(repository_info, tool)
-        api_client, api_root = self.get_api(server_url)
+        # The session is only needed to guess the review request to update.
+        if self.options.update:
+            bootstrap = ['info', 'session']
+        else:
+            bootstrap = ['info']
+
+        api_client, api_root = self.get_api(server_url, bootstrap=bootstrap)
         self.setup_tool(tool, api_root=api_root)
 
         if self.options.diff_filename:
@@ -607,14 +623,16 @@ class Post(Command):
             base_commit_id = None
 
             if self.options.diff_filename == '-':
-                diff = sys.stdin.read()
+                diff = DiffSet(spool=True)
+                diff.append_from(sys.stdin)
             else:
+                # The diff file is read as it's uploaded, rather than
+                # being loaded into memory here.
+                diff_path = os.path.join(origcwd, self.options.diff_filename)
+                diff = DiffSet()
+
                 try:
-                    diff_path = os.path.join(origcwd,
-                                             self.options.diff_filename)
-                    fp = open(diff_path, 'r')
-                    diff = fp.read()
-                    fp.close()
+                    diff.append_file(diff_path)
                 except IOError, e:
                     raise CommandError("Unable to open diff filename: %s" % e)
         else:
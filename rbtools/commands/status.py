@@ -59,9 +59,12 @@ class Status(Command):
         repository_info, tool = self.initialize_scm_tool(
             client_name=self.options.repository_type)
         server_url = self.get_server_url(repository_info, tool)
-        api_client, api_root = self.get_api(server_url)
+        api_client, api_root = self.get_api(server_url,
+                                            bootstrap=['info', 'session'])
         self.setup_tool(tool, api_root=api_root)
-        user = get_user(api_client, api_root, auth_required=True)
+        user = get_user(
+            api_client, api_root, auth_required=True,
+            session=self.get_bootstrapped_resource(api_root, 'session'))
 
         query_args = {
             'from_user': user.username,
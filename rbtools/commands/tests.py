@@ -0,0 +1,68 @@
+"""Tests for rbtools.commands units.
+
+Any new modules created under rbtools/commands should be tested here."""
+from rbtools.commands import Command
+from rbtools.utils.testbase import RBTestBase
+
+
+class MockRoot(object):
+    """A root resource which counts the resources fetched through it."""
+    def __init__(self, fail=None):
+        self.fetched = []
+        self.fail = fail or []
+
+    def get_info(self):
+        return self._get('info')
+
+    def get_session(self):
+        return self._get('session')
+
+    def _get(self, name):
+        self.fetched.append(name)
+
+        if name in self.fail:
+            self.fail = [n for n in self.fail if n != name]
+            raise IOError('Unable to fetch %s' % name)
+
+        return '%s for %s' % (name, id(self))
+
+
+class BootstrapTests(RBTestBase):
+    def test_bootstrapped_resources_reused(self):
+        """Testing Command.get_bootstrapped_resource with prefetched
+        resources
+        """
+        command = Command()
+        root = MockRoot()
+        command.bootstrap_api(root, ['info', 'session'])
+
+        self.assertEqual(sorted(root.fetched), ['info', 'session'])
+        self.assertEqual(command.get_bootstrapped_resource(root, 'info'),
+                         'info for %s' % id(root))
+        self.assertEqual(command.get_bootstrapped_resource(root, 'session'),
+                         'session for %s' % id(root))
+        self.assertEqual(sorted(root.fetched), ['info', 'session'])
+
+    def test_bootstrapped_resource_failed(self):
+        """Testing Command.get_bootstrapped_resource after a failed prefetch
+        """
+        command = Command()
+        root = MockRoot(fail=['session'])
+        command.bootstrap_api(root, ['info', 'session'])
+
+        self.assertEqual(command.get_bootstrapped_resource(root, 'session'),
+                         'session for %s' % id(root))
+        self.assertEqual(sorted(root.fetched), ['info', 'session', 'session'])
+
+    def test_bootstrapped_resource_other_root(self):
+        """Testing Command.get_bootstrapped_resource with a different root"""
+        command = Command()
+        root = MockRoot()
+        other_root = MockRoot()
+        command.bootstrap_api(root, ['info'])
+
+        self.assertEqual(command.get_bootstrapped_resource(other_root,
+                                                           'info'),
+                         'info for %s' % id(other_root))
+        self.assertEqual(root.fetched, ['info'])
+        self.assertEqual(other_root.fetched, ['info'])
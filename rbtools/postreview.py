@@ -863,7 +863,7 @@ class ReviewBoardServer(object):
             content += "Content-Disposition: form-data; name=\"%s\"; " % key
             content += "filename=\"%s\"\r\n" % filename
             content += "\r\n"
-            content += value + "\r\n"
+            content += str(value) + "\r\n"
 
         content += "--" + BOUNDARY + "--\r\n"
         content += "\r\n"
@@ -0,0 +1,358 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from rbtools.utils.filesystem import (get_file_lock, get_file_stamp,
+                                      get_home_path, link_or_copy_file,
+                                      replace_file, write_file_atomically)
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+
+CACHE_DIR = '.rbtools-cache'
+
+REVISION_CACHE_DIR = 'revisions'
+REVISION_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+# The fraction of max_size that eviction reduces the revision cache to,
+# so that it doesn't have to be scanned again for every file added.
+REVISION_CACHE_LOW_WATER = 0.75
+
+_revision_caches = {}
+_revision_caches_lock = threading.Lock()
+
+
+def get_cache_dir():
+    """Return the directory holding RBTools' caches, creating it if needed."""
+    cache_dir = os.path.join(get_home_path(), CACHE_DIR)
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0700)
+        except OSError:
+            # Another process may have created it first.
+            if not os.path.isdir(cache_dir):
+                raise
+
+    return cache_dir
+
+
+def get_file_stamps(paths):
+    """Return the stamps for a list of files, for use with FileCache.
+
+    Files which don't exist are included, so that creating them will
+    invalidate a cache entry.
+    """
+    stamps = {}
+
+    for path in paths:
+        stamp = get_file_stamp(path)
+
+        if stamp is not None:
+            stamp = list(stamp)
+
+        stamps[path] = stamp
+
+    return stamps
+
+
+def _to_str(value):
+    """Convert unicode strings loaded from JSON back to byte strings."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_to_str(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((_to_str(key), _to_str(item))
+                    for key, item in value.iteritems())
+    else:
+        return value
+
+
+class FileCache(object):
+    """A cache of JSON-serializable values, shared between processes.
+
+    The cache is stored in a file in the RBTools cache directory. Each
+    entry may be stored along with the stamps (from ``get_file_stamps``)
+    of the files it was computed from, and is invalidated when any of
+    them change. Entries older than ``max_age`` seconds are discarded.
+
+    The file is locked while it's updated, and updates atomically
+    replace it, so several processes can use the cache at once.
+    """
+    def __init__(self, name, max_age=None):
+        try:
+            cache_dir = get_cache_dir()
+        except OSError, e:
+            # The cache will just never be written.
+            logging.debug('Unable to create the cache directory: %s', e)
+            cache_dir = os.path.join(get_home_path(), CACHE_DIR)
+
+        self.filename = os.path.join(cache_dir, '%s.json' % name)
+        self.max_age = max_age
+        self.lock = get_file_lock(self.filename)
+
+    def get(self, key, stamps=None):
+        """Return the value for key, or None if missing or stale."""
+        entry = self._load().get(key)
+
+        if entry is None or self._is_stale(entry, stamps):
+            return None
+
+        return _to_str(entry['value'])
+
+    def set(self, key, value, stamps=None):
+        """Store a value, along with the stamps it depends on."""
+        self.lock.acquire()
+
+        try:
+            entries = self._load()
+
+            for other_key, entry in entries.items():
+                if self._is_expired(entry):
+                    del entries[other_key]
+
+            entries[key] = {
+                'value': value,
+                'stamps': stamps,
+                'time': time.time(),
+            }
+
+            self._save(entries)
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        """Remove an entry from the cache."""
+        self.lock.acquire()
+
+        try:
+            entries = self._load()
+
+            if entries.pop(key, None) is not None:
+                self._save(entries)
+        finally:
+            self.lock.release()
+
+    def _is_expired(self, entry):
+        return (self.max_age is not None and
+                time.time() - entry['time'] > self.max_age)
+
+    def _is_stale(self, entry, stamps):
+        return self._is_expired(entry) or entry['stamps'] != stamps
+
+    def _load(self):
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return {}
+
+        try:
+            try:
+                entries = json.loads(f.read())
+            except ValueError, e:
+                logging.debug('Ignoring corrupt cache file %s: %s',
+                              self.filename, e)
+                return {}
+        finally:
+            f.close()
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def _save(self, entries):
+        try:
+            write_file_atomically(self.filename, json.dumps(entries))
+        except (IOError, OSError), e:
+            logging.debug('Unable to write cache file %s: %s',
+                          self.filename, e)
+
+
+class RevisionCache(object):
+    """A local store of the contents of file revisions.
+
+    Revisions whose contents never change (such as a Perforce depot path
+    at a numbered revision) can be stored under a key identifying the
+    server, path and revision, so they only have to be fetched once.
+    Cached files are hardlinked into place where possible, and copied
+    otherwise.
+
+    The least recently used revisions are removed once the cache grows
+    past ``max_size`` bytes. Files are added by renaming them into place,
+    so several processes can use the cache at once.
+    """
+    def __init__(self, dirname, max_size=REVISION_CACHE_MAX_SIZE):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._size = None
+
+    def fetch(self, key, dest, fetch_func):
+        """Write the revision for key to dest, fetching it if necessary.
+
+        If the revision isn't cached, fetch_func is called to write it to
+        dest, and it's then added to the cache. If key is None, the
+        revision is always fetched, and isn't cached.
+        """
+        if key is not None and self.get(key, dest):
+            logging.debug('Using cached revision for %s' % key)
+            return
+
+        if os.path.lexists(dest):
+            # dest may be a hardlink to a cached file.
+            os.unlink(dest)
+
+        fetch_func(dest)
+
+        if key is not None:
+            self.add(key, dest)
+
+    def get(self, key, dest):
+        """Write the revision for key to dest, if it's cached.
+
+        Returns whether the revision was found.
+        """
+        path = self._get_path(key)
+
+        if not os.path.exists(path):
+            return False
+
+        try:
+            link_or_copy_file(path, dest)
+
+            # Record the use, for evicting the least recently used files.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    def add(self, key, filename):
+        """Store the contents of filename as the revision for key."""
+        if self.max_size <= 0:
+            return
+
+        path = self._get_path(key)
+        tmp_path = None
+
+        try:
+            dirname = os.path.dirname(path)
+
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname, 0700)
+                except OSError:
+                    # Another process may have created it first.
+                    if not os.path.isdir(dirname):
+                        raise
+
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+            os.close(fd)
+            link_or_copy_file(filename, tmp_path)
+            replace_file(tmp_path, path)
+            size = os.path.getsize(path)
+        except (IOError, OSError), e:
+            logging.debug('Unable to add %s to the revision cache: %s',
+                          key, e)
+
+            if tmp_path is not None and os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+
+            return
+
+        self.lock.acquire()
+
+        try:
+            if self._size is None:
+                self._size = self._get_total_size()
+            else:
+                self._size += size
+
+            if self._size > self.max_size:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def _get_path(self, key):
+        digest = sha1(key).hexdigest()
+
+        return os.path.join(self.dirname, digest[:2], digest)
+
+    def _get_entries(self):
+        """Return (mtime, size, path) for each file in the cache."""
+        entries = []
+
+        for dirpath, dirnames, filenames in os.walk(self.dirname):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # It was evicted by another process.
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+
+        return entries
+
+    def _get_total_size(self):
+        return sum([size for mtime, size, path in self._get_entries()])
+
+    def _evict(self):
+        """Remove the least recently used files, to make room for more."""
+        lock = get_file_lock(self.dirname)
+        lock.acquire()
+
+        try:
+            entries = self._get_entries()
+            entries.sort()
+            total = sum([size for mtime, size, path in entries])
+            target = self.max_size * REVISION_CACHE_LOW_WATER
+
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+
+            self._size = total
+        finally:
+            lock.release()
+
+
+def get_revision_cache():
+    """Return the RevisionCache in the RBTools cache directory.
+
+    The same cache is returned for every call with the same home
+    directory.
+    """
+    dirname = os.path.join(get_home_path(), CACHE_DIR, REVISION_CACHE_DIR)
+    _revision_caches_lock.acquire()
+
+    try:
+        if dirname not in _revision_caches:
+            _revision_caches[dirname] = RevisionCache(dirname)
+
+        return _revision_caches[dirname]
+    finally:
+        _revision_caches_lock.release()
@@ -1,28 +1,74 @@
 import os
-import subprocess
 import sys
+import time
 
-from rbtools.utils.process import die, execute
+from rbtools.utils.process import die, execute, record_command
 
 
 GNU_DIFF_WIN32_URL = 'http://gnuwin32.sourceforge.net/packages/diffutils.htm'
 
 
+# Maps (name, PATH) to the result of find_executable.
+_executable_cache = {}
+
+
+def find_executable(name):
+    """Return the full path to an executable, or None if it can't be found.
+
+    Names without a directory are looked up in the directories in the
+    PATH environment variable. As when executing a command on Windows, a
+    name without an extension may also match a .exe file. Results are
+    cached for as long as PATH is unchanged.
+    """
+    search_path = os.environ.get('PATH', os.defpath)
+    key = (name, search_path)
+
+    try:
+        return _executable_cache[key]
+    except KeyError:
+        pass
+
+    if sys.platform == 'win32' and not os.path.splitext(name)[1]:
+        names = [name + '.exe', name]
+    else:
+        names = [name]
+
+    if os.path.dirname(name):
+        dirs = ['']
+    else:
+        dirs = search_path.split(os.pathsep)
+
+    result = None
+
+    for dirname in dirs:
+        for filename in names:
+            path = os.path.join(dirname, filename)
+
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                result = os.path.abspath(path)
+                break
+
+        if result:
+            break
+
+    _executable_cache[key] = result
+
+    return result
+
+
 def check_install(command):
     """
-    Try executing an external command and return a boolean indicating whether
-    that command is installed or not.  The 'command' argument should be
-    something that executes quickly, without hitting the network (for
-    instance, 'svn help' or 'git --version').
+    Return a boolean indicating whether an external command is installed.
+
+    The 'command' argument is the command line which would be run (for
+    instance, 'svn help' or 'git --version'). Only the executable is
+    looked up, so the command itself isn't run.
     """
-    try:
-        subprocess.Popen(command,
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-        return True
-    except OSError:
-        return False
+    start_time = time.time()
+    found = find_executable(command[0]) is not None
+    record_command(command, start_time, 0, int(not found), kind='lookup')
+
+    return found
 
 
 def check_gnu_diff():
@@ -1,10 +1,322 @@
+import os
+import threading
+
+from rbtools.utils.filesystem import SpooledBuffer
+from rbtools.utils.process import run_parallel
+
+
+# The size of the blocks read from files backing parts of a diff.
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class DiffFileSpan(object):
+    """A span of a file on disk which makes up part of a diff.
+
+    The data is only read when the diff is serialized, so large diffs
+    which are already on disk don't need to be loaded into memory.
+    """
+    def __init__(self, filename, offset=0, length=None):
+        if length is None:
+            # Opening the file here means that a missing or unreadable
+            # file is reported straight away, rather than during upload.
+            f = open(filename, 'rb')
+
+            try:
+                length = os.fstat(f.fileno()).st_size - offset
+            finally:
+                f.close()
+
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        f = open(self.filename, 'rb')
+
+        try:
+            f.seek(self.offset)
+            remaining = self.length
+
+            while remaining > 0:
+                data = f.read(min(remaining, FILE_CHUNK_SIZE))
+
+                if not data:
+                    raise IOError('%s is shorter than expected'
+                                  % self.filename)
+
+                remaining -= len(data)
+                yield data
+        finally:
+            f.close()
+
+
+class DiffBufferSpan(object):
+    """A span of a SpooledBuffer which makes up part of a diff."""
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        offset = self.offset
+        end = offset + self.length
+
+        while offset < end:
+            # The buffer may be written to between reads, so seek each time.
+            self.buffer.seek(offset)
+            data = self.buffer.read(min(end - offset, FILE_CHUNK_SIZE))
+
+            if not data:
+                raise IOError('The diff buffer is shorter than expected')
+
+            offset += len(data)
+            yield data
+
+
+class DiffFileEntry(object):
+    """The part of a diff for a single file.
+
+    The content is kept as a list of chunks, each of which is either a
+    string, a DiffFileSpan or a DiffBufferSpan, along with the total size.
+    If the entry has a buffer, added strings are spooled into it rather
+    than kept in the list.
+    """
+    def __init__(self, filename=None, buffer=None):
+        self.filename = filename
+        self.buffer = buffer
+        self.chunks = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        """Add a string to the end of the entry."""
+        if self.buffer is None:
+            self.add_chunk(data)
+            return
+
+        offset = len(self.buffer)
+        self.buffer.write(data)
+        self.size += len(data)
+
+        if self.chunks:
+            last = self.chunks[-1]
+
+            if (isinstance(last, DiffBufferSpan) and
+                last.buffer is self.buffer and
+                last.offset + last.length == offset):
+                # Consecutive strings just extend the same span.
+                last.length += len(data)
+                return
+
+        self.chunks.append(DiffBufferSpan(self.buffer, offset, len(data)))
+
+    def add_chunk(self, data):
+        """Add a string as a chunk of its own.
+
+        The string is kept in memory, even if the entry has a buffer, so
+        that it can be changed later using replace_chunk().
+        """
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def extend(self, lines):
+        """Add a sequence of strings to the end of the entry."""
+        for line in lines:
+            self.append(line)
+
+    def append_file(self, filename, offset=0, length=None):
+        """Add the contents of (part of) a file to the end of the entry."""
+        span = DiffFileSpan(filename, offset, length)
+        self.chunks.append(span)
+        self.size += len(span)
+
+    def replace_chunk(self, index, data):
+        """Replace one of the entry's chunks with a string."""
+        self.size += len(data) - len(self.chunks[index])
+        self.chunks[index] = data
+
+    def iter_chunks(self):
+        """Yield the content of the entry as a series of strings."""
+        for chunk in self.chunks:
+            if isinstance(chunk, basestring):
+                yield chunk
+            else:
+                for data in chunk:
+                    yield data
+
+
+class DiffSet(object):
+    """A diff, made up of an entry for each file it changes.
+
+    Clients can build up a DiffSet as they generate a diff, rather than
+    concatenating it into one large string. It can be written out in
+    pieces with write_to() or iter_chunks(), and behaves like the diff
+    string for len() and str().
+
+    Content added before any file has been started goes into an entry
+    with no filename, which is also used for diffs that aren't split up
+    by file.
+
+    If spool is True, the diff's content is kept in a SpooledBuffer,
+    which is moved to disk once the diff gets large.
+
+    Diffs of separate files generated in parallel can be spooled as they
+    finish with make_file(), and then added in order with add_files().
+    """
+    def __init__(self, files=None, spool=False, buffer=None):
+        if spool and buffer is None:
+            buffer = SpooledBuffer()
+
+        self.files = files or []
+        self.buffer = buffer
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum([len(entry) for entry in self.files])
+
+    def __str__(self):
+        return self.getvalue()
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def start_file(self, filename=None):
+        """Start the entry for the next file in the diff, and return it."""
+        entry = DiffFileEntry(filename, self.buffer)
+        self.files.append(entry)
+
+        return entry
+
+    def make_file(self, lines, filename=None):
+        """Return a new entry holding a file's diff, without adding it.
+
+        This may be called from several threads at once. Each file's
+        content is written to the buffer in one piece.
+        """
+        data = ''.join(lines)
+        entry = DiffFileEntry(filename, self.buffer)
+        self._lock.acquire()
+
+        try:
+            entry.append(data)
+        finally:
+            self._lock.release()
+
+        return entry
+
+    def add_files(self, entries):
+        """Add entries made with make_file() to the end of the diff."""
+        self.files.extend(entries)
+
+    def get_current_file(self):
+        """Return the entry that content is currently being added to."""
+        if not self.files:
+            return self.start_file()
+
+        return self.files[-1]
+
+    def append(self, data):
+        """Add a string to the end of the diff."""
+        self.get_current_file().append(data)
+
+    def extend(self, lines):
+        """Add a sequence of strings to the end of the diff."""
+        self.get_current_file().extend(lines)
+
+    def append_file(self, filename, offset=0, length=None):
+        """Add the contents of (part of) a file to the end of the diff."""
+        self.get_current_file().append_file(filename, offset, length)
+
+    def append_from(self, f):
+        """Add everything read from a file-like object to the diff."""
+        while True:
+            data = f.read(FILE_CHUNK_SIZE)
+
+            if not data:
+                break
+
+            self.append(data)
+
+    def get_file_sizes(self):
+        """Return a list of (filename, size) pairs for the files in the diff.
+        """
+        return [(entry.filename, len(entry)) for entry in self.files]
+
+    def filter(self, func):
+        """Return a new DiffSet with the entries for which func is true.
+
+        The chunks are shared with this DiffSet rather than copied.
+        """
+        return DiffSet([entry for entry in self.files if func(entry)],
+                       buffer=self.buffer)
+
+    def iter_chunks(self):
+        """Yield the content of the diff as a series of strings."""
+        for entry in self.files:
+            for data in entry.iter_chunks():
+                yield data
+
+    def write_to(self, f):
+        """Write the diff to a file-like object."""
+        for data in self.iter_chunks():
+            f.write(data)
+
+    def getvalue(self):
+        """Return the whole diff as a string."""
+        return ''.join(self.iter_chunks())
+
+
+def spool_diff(chunks):
+    """Return a spooled DiffSet holding a diff read in pieces.
+
+    This is used for the streamed output of a diff command, so that the
+    whole diff doesn't have to be held in memory.
+    """
+    diff = DiffSet(spool=True)
+    diff.extend(chunks)
+
+    return diff
+
+
+def generate_diffs(make_diff, revisions):
+    """Generate the diff and parent diff for a set of parsed revisions.
+
+    make_diff is called with the base and tip revisions of each diff.
+    When there's a parent base, the diff and parent diff are generated
+    at the same time, since they're independent of each other.
+
+    This returns a tuple of the diff and parent diff, which is None if
+    there's no parent base.
+    """
+    ranges = [(revisions['base'], revisions['tip'])]
+
+    if 'parent_base' in revisions:
+        ranges.append((revisions['parent_base'], revisions['base']))
+
+    results = run_parallel(lambda diff_range: make_diff(*diff_range), ranges)
+
+    if len(results) == 1:
+        results.append(None)
+
+    return tuple(results)
+
+
 def get_diff(scmtool, repository_info, revision_range=None,
              svn_changelist=None, files=[]):
     """Returns diff data.
 
     This returns a dictionary with the diff content, parent diff content
     (if any), and the base commit ID/revision the diff applies to (if
-    supported by the SCMClient).
+    supported by the SCMClient). The diff content is either a string or
+    a DiffSet.
     """
     if revision_range:
         diff_info = scmtool.diff_between_revisions(
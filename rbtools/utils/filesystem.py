@@ -1,26 +1,181 @@
+import atexit
+import logging
 import os
 import shutil
 import tempfile
+import threading
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 
 from rbtools.utils.process import die
 
 
 CONFIG_FILE = '.reviewboardrc'
 
-tempfiles = []
-tempdirs = []
 builtin = {}
 
+# The size above which a SpooledBuffer is moved from memory to disk.
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# The owners of temporary files which haven't been cleaned up yet, and
+# whether cleanup_tempfiles has been registered to run at exit.
+_tempfile_owners = set()
+_tempfiles_lock = threading.Lock()
+_cleanup_registered = False
+
+# The TempFileOwner active on each thread, set by set_tempfile_owner.
+_current_owner = threading.local()
+
+# The FileLock for each locked path, as returned by get_file_lock.
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+class TempFileOwner(object):
+    """A set of temporary files and directories which are removed together.
+
+    make_tempfile and make_tempdir record new paths in the owner that's
+    active on the current thread (see owns_tempfiles), so that a
+    long-lived process can remove the files used by each operation as
+    soon as it's finished, while other threads keep theirs.
+    """
+    def __init__(self):
+        self.files = []
+        self.dirs = []
+        self._lock = threading.Lock()
+
+    def add_file(self, path):
+        self._add(self.files, path)
+
+    def add_dir(self, path):
+        self._add(self.dirs, path)
+
+    def cleanup(self):
+        """Remove all the files and directories added so far."""
+        self._lock.acquire()
 
-def cleanup_tempfiles():
-    for tmpfile in tempfiles:
         try:
-            os.unlink(tmpfile)
-        except:
-            pass
+            files = self.files[:]
+            dirs = self.dirs[:]
+            del self.files[:]
+            del self.dirs[:]
+        finally:
+            self._lock.release()
+
+        _tempfiles_lock.acquire()
+
+        try:
+            _tempfile_owners.discard(self)
+        finally:
+            _tempfiles_lock.release()
+
+        for tmpfile in files:
+            try:
+                os.unlink(tmpfile)
+            except:
+                pass
+
+        for tmpdir in dirs:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _add(self, registry, path):
+        global _cleanup_registered
+
+        self._lock.acquire()
+
+        try:
+            registry.append(path)
+        finally:
+            self._lock.release()
+
+        _tempfiles_lock.acquire()
+
+        try:
+            _tempfile_owners.add(self)
+
+            if not _cleanup_registered:
+                atexit.register(cleanup_tempfiles)
+                _cleanup_registered = True
+        finally:
+            _tempfiles_lock.release()
+
 
-    for tmpdir in tempdirs:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+# The owner of temporary files made outside of owns_tempfiles. They're
+# only removed at exit.
+_process_owner = TempFileOwner()
+
+
+def get_tempfile_owner():
+    """Return the TempFileOwner active on the current thread."""
+    return getattr(_current_owner, 'owner', None) or _process_owner
+
+
+def set_tempfile_owner(owner):
+    """Make a TempFileOwner active on the current thread.
+
+    The previously active owner is returned, so that it can be restored.
+    """
+    previous = get_tempfile_owner()
+    _current_owner.owner = owner
+
+    return previous
+
+
+def owns_tempfiles(func):
+    """Decorate a function to remove the temporary files it makes.
+
+    The files and directories made by the function, including those
+    made on run_parallel's worker threads, are removed when it returns,
+    rather than when the process exits.
+    """
+    def _owns_tempfiles(*args, **kwargs):
+        owner = TempFileOwner()
+        previous = set_tempfile_owner(owner)
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_tempfile_owner(previous)
+            owner.cleanup()
+
+    _owns_tempfiles.__name__ = func.__name__
+    _owns_tempfiles.__doc__ = func.__doc__
+
+    return _owns_tempfiles
+
+
+def cleanup_tempfiles():
+    """Remove all temporary files and directories which are left.
+
+    Files made outside of owns_tempfiles belong to the whole process,
+    and may still be in use by other threads or API clients, so this
+    must only be called when the process is exiting. It's registered to
+    run at exit once the first path is created, and also removes any
+    files left by operations which were interrupted. Calling it again
+    is harmless.
+    """
+    _tempfiles_lock.acquire()
+
+    try:
+        owners = list(_tempfile_owners)
+    finally:
+        _tempfiles_lock.release()
+
+    for owner in owners:
+        owner.cleanup()
 
 
 def get_config_value(configs, name, default=None):
@@ -69,8 +224,8 @@ def load_config_files(homepath):
 
 def make_tempfile(content=None):
     """
-    Creates a temporary file and returns the path. The path is stored
-    in an array for later cleanup.
+    Creates a temporary file and returns the path. The path is recorded
+    in the current thread's TempFileOwner for later cleanup.
     """
     fd, tmpfile = tempfile.mkstemp()
 
@@ -78,21 +233,253 @@ def make_tempfile(content=None):
         os.write(fd, content)
 
     os.close(fd)
-    tempfiles.append(tmpfile)
+    get_tempfile_owner().add_file(tmpfile)
     return tmpfile
 
 
 def make_tempdir(parent=None):
     """Creates a temporary directory and returns the path.
 
-    The path is stored in an array for later cleanup.
+    The path is recorded in the current thread's TempFileOwner for later
+    cleanup.
     """
     tmpdir = tempfile.mkdtemp(dir=parent)
-    tempdirs.append(tmpdir)
+    get_tempfile_owner().add_dir(tmpdir)
 
     return tmpdir
 
 
+class SpooledBuffer(object):
+    """A buffer which is moved from memory to a temporary file as it grows.
+
+    Data is kept in memory until there's more than max_size bytes of it,
+    and is then written to an anonymous temporary file, so that large
+    diffs and request bodies don't all have to be held in memory.
+
+    Writes always add to the end of the buffer, whatever position it was
+    last read from.
+    """
+    def __init__(self, max_size=SPOOL_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.rolled_over = False
+        self._file = StringIO()
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        if not self.rolled_over and self.size + len(data) > self.max_size:
+            self._roll_over()
+
+        self._file.seek(self.size)
+        self._file.write(data)
+        self.size += len(data)
+
+    def seek(self, offset, whence=0):
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def getvalue(self):
+        """Return the whole contents of the buffer as a string."""
+        self._file.seek(0)
+
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+    def _roll_over(self):
+        f = tempfile.TemporaryFile(prefix='rbtools.')
+        f.write(self.getvalue())
+        self._file.close()
+        self._file = f
+        self.rolled_over = True
+
+
+class FileLock(object):
+    """A lock on a file which is shared between threads and processes.
+
+    The lock is held on a separate ``<path>.lock`` file, so the file
+    itself can be atomically replaced while the lock is held. The lock
+    is re-entrant within a thread.
+
+    If the lock file can't be created or locked (for instance, on a
+    read-only filesystem), the lock only protects against other threads
+    in this process.
+
+    Instances should be retrieved through ``get_file_lock``, since POSIX
+    record locks are held per process and would be released early if
+    the same file were locked through two different objects.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        """Acquire the lock, blocking until it's available."""
+        self._lock.acquire()
+
+        if self._depth == 0:
+            try:
+                self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT,
+                                   0600)
+                self._lock_fd(self._fd)
+            except (IOError, OSError), e:
+                logging.debug('Unable to lock %s: %s', self.lock_path, e)
+
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+
+        self._depth += 1
+
+    def release(self):
+        """Release the lock."""
+        try:
+            self._depth -= 1
+
+            if self._depth == 0 and self._fd is not None:
+                fd = self._fd
+                self._fd = None
+
+                try:
+                    self._unlock_fd(fd)
+                finally:
+                    os.close(fd)
+        finally:
+            self._lock.release()
+
+    def _lock_fd(self, fd):
+        if fcntl:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        elif msvcrt:
+            while True:
+                try:
+                    # LK_LOCK only retries for 10 seconds before failing.
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass
+
+    def _unlock_fd(self, fd):
+        if fcntl:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        elif msvcrt:
+            os.lseek(fd, 0, 0)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def get_file_lock(path):
+    """Return the FileLock for a path.
+
+    The same lock is returned for every call with the same path.
+    """
+    path = os.path.abspath(path)
+    _file_locks_lock.acquire()
+
+    try:
+        if path not in _file_locks:
+            _file_locks[path] = FileLock(path)
+
+        return _file_locks[path]
+    finally:
+        _file_locks_lock.release()
+
+
+def make_atomic_tempfile(path):
+    """Create a temporary file for atomically replacing a file.
+
+    The temporary file is created alongside ``path``, so that
+    ``replace_file`` can rename it over ``path``.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmpfile = tempfile.mkstemp(prefix='.%s.' % basename, dir=dirname)
+    os.close(fd)
+
+    return tmpfile
+
+
+def replace_file(src, dest):
+    """Rename src over dest.
+
+    This is atomic on POSIX systems, so readers of dest will either see
+    the old or the new file, never a partially written one.
+    """
+    try:
+        os.rename(src, dest)
+    except OSError:
+        if not os.path.exists(dest):
+            raise
+
+        # Windows won't rename over an existing file.
+        os.unlink(dest)
+        os.rename(src, dest)
+
+
+def link_or_copy_file(src, dest):
+    """Hardlink src to dest, or copy it where hardlinks aren't possible.
+
+    Any existing file at dest is removed first, so that it's never
+    written to in place.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    try:
+        os.link(src, dest)
+    except (AttributeError, OSError):
+        # Windows doesn't support os.link, and hardlinks can't cross
+        # filesystems.
+        shutil.copyfile(src, dest)
+
+
+def write_file_atomically(path, content, mode=0600):
+    """Atomically replace the contents of a file.
+
+    The content is written to a temporary file which then replaces
+    ``path``.
+    """
+    tmpfile = make_atomic_tempfile(path)
+
+    try:
+        f = open(tmpfile, 'wb')
+
+        try:
+            f.write(content)
+        finally:
+            f.close()
+
+        os.chmod(tmpfile, mode)
+        replace_file(tmpfile, path)
+    except:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+        raise
+
+
+def get_file_stamp(path):
+    """Return a value which changes whenever a file is modified or replaced.
+
+    None is returned if the file doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
 def walk_parents(path):
     """
     Walks up the tree to the root directory.
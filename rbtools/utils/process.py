@@ -2,16 +2,28 @@ import logging
 import os
 import subprocess
 import sys
+import threading
+import time
+
+
+# The size of the chunks read from a command's output when streaming.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# How much of the end of a streamed command's output is kept, to report
+# if the command fails.
+STREAM_ERROR_TAIL_SIZE = 4 * 1024
 
 
 def die(msg=None):
     """
     Cleanly exits the program with an error message. Erases all remaining
     temporary files.
-    """
-    from rbtools.utils.filesystem import cleanup_tempfiles
 
-    cleanup_tempfiles()
+    Temporary files are only erased on the main thread. Other threads may
+    still be using them, so when die() is called from a worker thread of
+    run_parallel, they're erased once all the workers have finished.
+    """
+    _cleanup_tempfiles_on_main_thread()
 
     if msg:
         print msg
@@ -19,6 +31,14 @@ def die(msg=None):
     sys.exit(1)
 
 
+def _cleanup_tempfiles_on_main_thread():
+    """Erase all temporary files, if this is the main thread."""
+    from rbtools.utils.filesystem import cleanup_tempfiles
+
+    if isinstance(threading.current_thread(), threading._MainThread):
+        cleanup_tempfiles()
+
+
 def execute(command,
             env=None,
             split_lines=False,
@@ -26,9 +46,16 @@ def execute(command,
             extra_ignore_errors=(),
             translate_newlines=True,
             with_errors=True,
-            none_on_ignored_error=False):
+            none_on_ignored_error=False,
+            stream=False):
     """
     Utility function to execute a command and return the output.
+
+    If 'stream' is True, an iterator over the output is returned instead,
+    yielding lines if 'split_lines' is True, or chunks otherwise. Only a
+    small amount of the output is held in memory at a time. The exit code
+    is checked once the iterator is exhausted or closed, and
+    'none_on_ignored_error' has no effect.
     """
     if isinstance(command, list):
         logging.debug('Running: ' + subprocess.list2cmdline(command))
@@ -43,6 +70,8 @@ def execute(command,
     env['LC_ALL'] = 'en_US.UTF-8'
     env['LANGUAGE'] = 'en_US.UTF-8'
 
+    start_time = time.time()
+
     if with_errors:
         errors_output = subprocess.STDOUT
     else:
@@ -65,20 +94,501 @@ def execute(command,
                              close_fds=True,
                              universal_newlines=translate_newlines,
                              env=env)
+    if stream:
+        return _StreamOutput(p, command, split_lines, ignore_errors,
+                             extra_ignore_errors, start_time)
+
     if split_lines:
         data = p.stdout.readlines()
+        output_size = sum([len(line) for line in data])
     else:
         data = p.stdout.read()
+        output_size = len(data)
 
     rc = p.wait()
+    record_command(command, start_time, output_size, rc)
+    _check_exit_code(rc, command, data, ignore_errors, extra_ignore_errors)
+
+    if rc and none_on_ignored_error:
+        return None
+
+    return data
+
 
+def _check_exit_code(rc, command, data, ignore_errors, extra_ignore_errors):
+    """Exit with an error if a command failed and errors aren't ignored."""
     if rc and not ignore_errors and rc not in extra_ignore_errors:
         die('Failed to execute command: %s\n%s' % (command, data))
     elif rc:
         logging.debug('Command exited with rc %s: %s\n%s---'
                       % (rc, command, data))
 
-    if rc and none_on_ignored_error:
-        return None
 
-    return data
+class _StreamOutput(object):
+    """An iterator over the output of a running command.
+
+    This yields lines or chunks of the output as they're read. Once all
+    of it has been read, the command's exit code is checked, and the
+    failure is reported with the end of its output (or of its stderr,
+    if that was captured separately).
+
+    The command is waited for when the output has been read, or when the
+    iterator is closed or garbage collected, so it's never left behind
+    as a zombie process, even if the output is never read.
+    """
+    def __init__(self, p, command, split_lines, ignore_errors,
+                 extra_ignore_errors, start_time):
+        self.p = p
+        self.command = command
+        self.ignore_errors = ignore_errors
+        self.extra_ignore_errors = extra_ignore_errors
+        self.start_time = start_time
+        self.output_size = 0
+        self.finished = False
+        self._tail = ''
+        self._errors_tail = ''
+        self._errors_thread = None
+
+        if split_lines:
+            self._read = p.stdout.readline
+        else:
+            self._read = lambda: p.stdout.read(STREAM_CHUNK_SIZE)
+
+        if p.stderr is not None:
+            # stderr is read as it's written, so the command can't block
+            # on it while stdout is being read.
+            self._errors_thread = threading.Thread(target=self._read_errors)
+            self._errors_thread.daemon = True
+            self._errors_thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration
+
+        try:
+            data = self._read()
+        except:
+            self._finish(check=False)
+            raise
+
+        if not data:
+            self._finish(check=True)
+            raise StopIteration
+
+        self.output_size += len(data)
+        self._tail = (self._tail + data)[-STREAM_ERROR_TAIL_SIZE:]
+
+        return data
+
+    def close(self):
+        """Stop reading the output, and wait for the command to exit.
+
+        If the command is still running, closing the pipe will make it
+        fail when writing more, which isn't an error on its part, so its
+        exit code is only checked if it had already exited.
+        """
+        if not self.finished:
+            self._finish(check=self.p.poll() is not None)
+
+    def __del__(self):
+        if not self.finished:
+            self._finish(check=False)
+
+    def _read_errors(self):
+        for chunk in iter(lambda: self.p.stderr.read(STREAM_CHUNK_SIZE), ''):
+            self._errors_tail = (self._errors_tail +
+                                 chunk)[-STREAM_ERROR_TAIL_SIZE:]
+
+    def _finish(self, check):
+        self.finished = True
+        self.p.stdout.close()
+
+        if self.p.stdin is not None:
+            self.p.stdin.close()
+
+        rc = self.p.wait()
+
+        if self._errors_thread is not None:
+            self._errors_thread.join()
+            self.p.stderr.close()
+            output = self._errors_tail
+        else:
+            output = self._tail
+
+        record_command(self.command, self.start_time, self.output_size, rc)
+
+        if check:
+            _check_exit_code(rc, self.command, output, self.ignore_errors,
+                             self.extra_ignore_errors)
+        else:
+            logging.debug('Stopped reading the output of: %s'
+                          % (self.command,))
+
+
+def get_default_max_workers():
+    """Return the default number of commands to run in parallel.
+
+    This is the number of CPUs. On Windows, commands are run one at a time,
+    since each child process inherits the pipes of every other command
+    which is running, and would keep them open.
+    """
+    if sys.platform.startswith('win'):
+        return 1
+
+    try:
+        import multiprocessing
+
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+_max_workers = None
+
+
+def set_max_workers(max_workers):
+    """Set the number of commands to run in parallel by default.
+
+    None restores the default from get_default_max_workers.
+    """
+    global _max_workers
+
+    _max_workers = max_workers
+
+
+def get_max_workers():
+    """Return the number of commands to run in parallel by default."""
+    if _max_workers is None:
+        return get_default_max_workers()
+
+    return max(_max_workers, 1)
+
+
+def run_parallel(func, items, max_workers=None):
+    """Call a function for each item, running several calls at once.
+
+    This is intended for independent steps which mostly wait on external
+    commands, such as generating a diff for each file in a change. The
+    calls are made on a pool of up to 'max_workers' threads (by default,
+    get_max_workers()), and a list of their results is returned in the
+    same order as the items.
+
+    'items' may be an iterator, such as the records being read from a
+    command, in which case the calls start before all the items are
+    known. The workers take turns reading the next item from it.
+
+    If a call raises an exception, or exits through die(), no further
+    calls are started. Once the calls already running have finished,
+    the first exception is raised again here. This includes exceptions
+    raised while reading the items.
+
+    Temporary files made by the calls belong to the caller's
+    TempFileOwner.
+    """
+    from rbtools.utils.filesystem import (get_tempfile_owner,
+                                          set_tempfile_owner)
+
+    if max_workers is None:
+        max_workers = get_max_workers()
+
+    if isinstance(items, (list, tuple)):
+        max_workers = min(max_workers, len(items))
+
+    if max_workers <= 1:
+        return [func(item) for item in items]
+
+    items = iter(items)
+    results = []
+    errors = []
+    failed = threading.Event()
+    lock = threading.Lock()
+
+    def next_item():
+        lock.acquire()
+
+        try:
+            item = items.next()
+            results.append(None)
+
+            return len(results) - 1, item
+        finally:
+            lock.release()
+
+    owner = get_tempfile_owner()
+
+    def worker():
+        set_tempfile_owner(owner)
+
+        while not failed.is_set():
+            try:
+                try:
+                    i, item = next_item()
+                except StopIteration:
+                    return
+
+                results[i] = func(item)
+            except BaseException:
+                # This includes the SystemExit raised by die().
+                errors.append(sys.exc_info())
+                failed.set()
+
+    threads = []
+
+    for i in range(max_workers):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for thread in threads:
+            # Joining with a timeout keeps the main thread responsive to
+            # KeyboardInterrupt.
+            while thread.is_alive():
+                thread.join(0.1)
+    except KeyboardInterrupt:
+        failed.set()
+        raise
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+
+        if issubclass(exc_type, SystemExit):
+            # die() doesn't clean up on worker threads, since the others
+            # could still be using the files. They've all finished now.
+            _cleanup_tempfiles_on_main_thread()
+
+        raise exc_type, exc_value, exc_traceback
+
+    return results
+
+
+# Options which take a value, for the tools whose subcommands are shown in
+# profiles. The subcommand is the first argument after these.
+_VALUE_OPTIONS = {
+    'git': ['-c', '-C', '--git-dir', '--work-tree', '--namespace'],
+    'hg': ['-R', '--repository', '--cwd', '--config'],
+    'p4': ['-b', '-c', '-C', '-d', '-H', '-L', '-p', '-P', '-Q', '-r', '-u',
+           '-x', '-z'],
+    'svn': ['--config-dir', '--config-option'],
+}
+
+# Options whose values must never be written to a profile.
+_SECRET_OPTIONS = {
+    'p4': ['-P'],
+    'svn': ['--password'],
+}
+
+
+def get_command_name(command):
+    """Return the name a command is grouped under in profiles.
+
+    This is the name of the executable, along with the subcommand for
+    tools which have them (for instance, "svn info" or "p4 print").
+    """
+    if not isinstance(command, list):
+        command = command.split()
+
+    if not command:
+        return ''
+
+    tool = os.path.basename(command[0])
+
+    if tool.lower().endswith('.exe'):
+        tool = tool[:-4]
+
+    if tool not in _VALUE_OPTIONS:
+        return tool
+
+    value_options = _VALUE_OPTIONS[tool]
+    args = iter(command[1:])
+
+    for arg in args:
+        if arg in value_options:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return '%s %s' % (tool, arg)
+
+    return tool
+
+
+def _strip_secrets(command):
+    """Return a copy of a command line with any passwords masked."""
+    if not isinstance(command, list):
+        return command
+
+    secret_options = _SECRET_OPTIONS.get(
+        get_command_name(command).split(' ')[0], [])
+    result = []
+    mask_next = False
+
+    for arg in command:
+        if mask_next:
+            arg = '********'
+            mask_next = False
+        elif arg in secret_options:
+            mask_next = True
+        elif '=' in arg and arg.split('=', 1)[0] in secret_options:
+            arg = '%s=********' % arg.split('=', 1)[0]
+
+        result.append(arg)
+
+    return result
+
+
+class CommandProfile(object):
+    """A record of the external commands run by RBTools.
+
+    Each command is stored with its arguments, the time it took, the
+    number of bytes it output and its exit code. The commands can be
+    summarized by tool and subcommand, to show where the time went.
+    """
+    def __init__(self):
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def add(self, command, start_time, elapsed, output_size, rc,
+            kind='execute'):
+        """Add a command to the profile."""
+        self.lock.acquire()
+
+        try:
+            self.commands.append({
+                'command': _strip_secrets(command),
+                'name': get_command_name(command),
+                'kind': kind,
+                'start': start_time,
+                'elapsed': elapsed,
+                'output_size': output_size,
+                'rc': rc,
+            })
+        finally:
+            self.lock.release()
+
+    def get_commands(self):
+        """Return a list of the commands recorded so far."""
+        self.lock.acquire()
+
+        try:
+            return list(self.commands)
+        finally:
+            self.lock.release()
+
+    def get_summary(self):
+        """Return the totals for each command name.
+
+        The totals are sorted with the most time-consuming first.
+        """
+        totals = {}
+
+        for info in self.get_commands():
+            name = info['name']
+
+            if info['kind'] != 'execute':
+                name = '%s (%s)' % (name, info['kind'])
+
+            total = totals.setdefault(name, {
+                'name': name,
+                'count': 0,
+                'elapsed': 0.0,
+                'output_size': 0,
+                'failures': 0,
+            })
+            total['count'] += 1
+            total['elapsed'] += info['elapsed']
+            total['output_size'] += info['output_size'] or 0
+
+            if info['rc']:
+                total['failures'] += 1
+
+        return sorted(totals.itervalues(),
+                      key=lambda total: (-total['elapsed'], total['name']))
+
+    def get_report(self, max_slowest=10):
+        """Return a report on the commands, for display to the user."""
+        summary = self.get_summary()
+        count = sum([total['count'] for total in summary])
+        elapsed = sum([total['elapsed'] for total in summary])
+
+        lines = [
+            'External commands: %d run in %.3fs' % (count, elapsed),
+            '',
+            '%7s %10s %10s %12s %7s  %s' % ('Count', 'Total (s)', 'Avg (s)',
+                                            'Output', 'Failed', 'Command'),
+        ]
+
+        for total in summary:
+            lines.append('%7d %10.3f %10.3f %12d %7d  %s'
+                         % (total['count'], total['elapsed'],
+                            total['elapsed'] / total['count'],
+                            total['output_size'], total['failures'],
+                            total['name']))
+
+        slowest = sorted(self.get_commands(), key=lambda info: -info['elapsed'])
+        slowest = slowest[:max_slowest]
+
+        if slowest:
+            lines += ['', 'Slowest commands:']
+
+            for info in slowest:
+                command = info['command']
+
+                if isinstance(command, list):
+                    command = subprocess.list2cmdline(command)
+
+                lines.append('%10.3fs  rc=%s  %s'
+                             % (info['elapsed'], info['rc'], command))
+
+        return '\n'.join(lines) + '\n'
+
+    def serialize(self):
+        """Return the profile as a dictionary which can be stored as JSON."""
+        return {
+            'commands': self.get_commands(),
+            'summary': self.get_summary(),
+        }
+
+
+_profile = None
+
+
+def start_profiling():
+    """Start recording the external commands which are run.
+
+    Returns the CommandProfile the commands are recorded in.
+    """
+    global _profile
+
+    _profile = CommandProfile()
+
+    return _profile
+
+
+def stop_profiling():
+    """Stop recording commands, and return the CommandProfile, if any."""
+    global _profile
+
+    profile = _profile
+    _profile = None
+
+    return profile
+
+
+def get_profile():
+    """Return the CommandProfile commands are being recorded in, if any."""
+    return _profile
+
+
+def record_command(command, start_time, output_size, rc, kind='execute'):
+    """Record a command which has finished, if profiling is enabled.
+
+    'start_time' is the time.time() at which the command was started.
+    """
+    profile = _profile
+
+    if profile is not None:
+        profile.add(command, start_time, time.time() - start_time,
+                    output_size, rc, kind)
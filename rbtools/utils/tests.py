@@ -2,10 +2,18 @@
 
 Any new modules created under rbtools/api should be tested here."""
 import os
+import random
 import re
 import sys
+import threading
+import time
+from StringIO import StringIO
 
-from rbtools.utils import checks, filesystem, process
+from nose import SkipTest
+
+from rbtools.utils import checks, filesystem, process, unified_diff
+from rbtools.utils.cache import RevisionCache
+from rbtools.utils.diffs import DiffSet, generate_diffs, spool_diff
 from rbtools.utils.testbase import RBTestBase
 
 
@@ -23,11 +31,516 @@ class UtilitiesTest(RBTestBase):
         self.assertEqual(os.stat(fname).st_uid, os.geteuid())
         self.assertTrue(os.access(fname, os.R_OK | os.W_OK))
 
+    def test_owns_tempfiles(self):
+        """Testing 'owns_tempfiles' removing the files an operation made"""
+        process_file = filesystem.make_tempfile()
+        made = []
+        other_thread_files = []
+        started = threading.Event()
+        finished = threading.Event()
+
+        @filesystem.owns_tempfiles
+        def operation():
+            made.append(filesystem.make_tempfile())
+            made.append(filesystem.make_tempdir())
+            made.extend(process.run_parallel(
+                lambda i: filesystem.make_tempfile(), range(4),
+                max_workers=2))
+
+            for path in made:
+                self.assertTrue(os.path.exists(path))
+
+        @filesystem.owns_tempfiles
+        def other_operation():
+            other_thread_files.append(filesystem.make_tempfile())
+            started.set()
+            finished.wait()
+
+        thread = threading.Thread(target=other_operation)
+        thread.start()
+        started.wait()
+
+        try:
+            operation()
+
+            self.assertEqual(len(made), 6)
+
+            for path in made:
+                self.assertFalse(os.path.exists(path))
+
+            # Files made by other operations, or outside of one, are left.
+            self.assertTrue(os.path.exists(other_thread_files[0]))
+            self.assertTrue(os.path.exists(process_file))
+        finally:
+            finished.set()
+            thread.join()
+
+        self.assertFalse(os.path.exists(other_thread_files[0]))
+
+        filesystem.cleanup_tempfiles()
+        self.assertFalse(os.path.exists(process_file))
+
+    def test_write_file_atomically(self):
+        """Testing 'write_file_atomically' method."""
+        dirname = self.create_tmp_dir()
+        fname = os.path.join(dirname, 'data')
+
+        filesystem.write_file_atomically(fname, 'first')
+        filesystem.write_file_atomically(fname, 'second')
+
+        self.assertEqual(open(fname, 'rb').read(), 'second')
+        self.assertEqual(os.listdir(dirname), ['data'])
+
+    def test_get_file_lock(self):
+        """Testing 'get_file_lock' method."""
+        fname = os.path.join(self.create_tmp_dir(), 'data')
+        lock = filesystem.get_file_lock(fname)
+
+        self.assertTrue(filesystem.get_file_lock(fname) is lock)
+
+        # The lock is re-entrant, and only releases the lock file once
+        # fully released.
+        lock.acquire()
+        lock.acquire()
+        self.assertTrue(os.path.exists(lock.lock_path))
+        lock.release()
+        self.assertFalse(lock._fd is None)
+        lock.release()
+        self.assertTrue(lock._fd is None)
+
     def test_execute(self):
         """Testing 'execute' method."""
         self.assertTrue(re.match('.*?%d.%d.%d' % sys.version_info[:3],
                         process.execute([sys.executable, '-V'])))
 
+    def test_execute_stream(self):
+        """Testing 'execute' method with stream=True."""
+        script = 'for i in range(3): print i'
+        lines = process.execute([sys.executable, '-c', script],
+                                split_lines=True, stream=True)
+        self.assertFalse(isinstance(lines, list))
+        self.assertEqual(list(lines), ['0\n', '1\n', '2\n'])
+
+        # The exit code is checked once the output has been read.
+        lines = process.execute([sys.executable, '-c', 'import sys; '
+                                 'print 1; sys.exit(1)'],
+                                split_lines=True, stream=True)
+        self.assertEqual(lines.next(), '1\n')
+        self.assertRaises(SystemExit, list, lines)
+
+    def test_execute_stream_errors(self):
+        """Testing 'execute' with stream=True reporting a failure"""
+        script = ('import sys; sys.stdout.write("output\\n"); '
+                  'sys.stderr.write("the reason\\n"); sys.exit(1)')
+
+        # The failure is reported with the end of the command's output,
+        # or its stderr if that's captured separately.
+        for with_errors in (True, False):
+            lines = process.execute([sys.executable, '-c', script],
+                                    split_lines=True, stream=True,
+                                    with_errors=with_errors)
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+
+            try:
+                self.assertRaises(SystemExit, list, lines)
+                message = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+
+            self.assertTrue('the reason' in message)
+
+    def test_execute_stream_close(self):
+        """Testing 'execute' with stream=True waits for closed commands"""
+        lines = process.execute([sys.executable, '-c', 'print 1'],
+                                stream=True)
+        lines.close()
+        self.assertTrue(lines.p.returncode is not None)
+
+        # Unread output doesn't leave the process behind either.
+        lines = process.execute([sys.executable, '-c', 'print 1'],
+                                stream=True)
+        p = lines.p
+        del lines
+        self.assertTrue(p.returncode is not None)
+
+    def test_execute_profile(self):
+        """Testing 'execute' method with profiling enabled."""
+        process.start_profiling()
+
+        try:
+            process.execute([sys.executable, '-c', 'print 1'])
+            list(process.execute([sys.executable, '-c', 'print 22'],
+                                 stream=True))
+            checks.check_install(['rbtools-nonexistent-command'])
+        finally:
+            profile = process.stop_profiling()
+
+        summary = profile.get_summary()
+        self.assertEqual(len(summary), 2)
+
+        totals = dict((total['name'], total) for total in summary)
+        name = os.path.basename(sys.executable)
+        self.assertEqual(totals[name]['count'], 2)
+        self.assertEqual(totals[name]['output_size'], 5)
+        self.assertEqual(totals[name]['failures'], 0)
+
+        total = totals['rbtools-nonexistent-command (lookup)']
+        self.assertEqual(total['failures'], 1)
+
+        self.assertTrue(process.get_profile() is None)
+        self.assertTrue(profile.get_report().startswith(
+            'External commands: 3 run in '))
+
+    def test_get_command_name(self):
+        """Testing 'get_command_name' method."""
+        self.assertEqual(process.get_command_name(['svn', 'info', 'foo']),
+                         'svn info')
+        self.assertEqual(
+            process.get_command_name(['p4', '-G', '-p', 'server:1666',
+                                      'print', '-q', '//depot/foo']),
+            'p4 print')
+        self.assertEqual(
+            process.get_command_name(['p4', '-b', '2', '-x', '/tmp/args',
+                                      'diff2', '-du']),
+            'p4 diff2')
+        self.assertEqual(process.get_command_name(['/usr/bin/diff', '-u']),
+                         'diff')
+
+    def test_run_parallel(self):
+        """Testing 'run_parallel' method."""
+        def square(i):
+            # Finish the later items first.
+            time.sleep(0.001 * (10 - i))
+            return i * i
+
+        self.assertEqual(process.run_parallel(square, range(10),
+                                              max_workers=4),
+                         [i * i for i in range(10)])
+        self.assertEqual(process.run_parallel(square, range(3),
+                                              max_workers=1),
+                         [0, 1, 4])
+        self.assertEqual(process.run_parallel(square, []), [])
+
+    def test_run_parallel_errors(self):
+        """Testing 'run_parallel' method with a failing call."""
+        started = []
+
+        def fail(i):
+            started.append(i)
+
+            if i == 2:
+                process.die()
+
+            time.sleep(0.01)
+
+        self.assertRaises(SystemExit, process.run_parallel, fail, range(100),
+                          max_workers=2)
+
+        # No more calls are started after one fails.
+        self.assertTrue(len(started) < 10)
+
+    def test_run_parallel_die(self):
+        """Testing 'run_parallel' with die() leaving temp files in use"""
+        filename = filesystem.make_tempfile()
+        started = threading.Event()
+        still_exists = []
+
+        def work(i):
+            if i == 0:
+                started.wait()
+                process.die()
+            else:
+                # The other call is still using the file.
+                started.set()
+                time.sleep(0.1)
+                still_exists.append(os.path.exists(filename))
+
+        self.assertRaises(SystemExit, process.run_parallel, work, range(2),
+                          max_workers=2)
+        self.assertEqual(still_exists, [True])
+
+        # The files are cleaned up once all the calls have finished.
+        self.assertFalse(os.path.exists(filename))
+
+    def test_run_parallel_iterator(self):
+        """Testing 'run_parallel' method with an iterator."""
+        def generate():
+            for i in range(10):
+                yield i
+
+            process.die()
+
+        self.assertEqual(process.run_parallel(lambda i: i * i,
+                                              iter(range(10)),
+                                              max_workers=4),
+                         [i * i for i in range(10)])
+
+        # Errors while reading the items are raised again.
+        self.assertRaises(SystemExit, process.run_parallel, lambda i: i,
+                          generate(), max_workers=4)
+
     def test_die(self):
         """Testing 'die' method."""
         self.assertRaises(SystemExit, process.die)
+
+    def test_diff_set(self):
+        """Testing building and filtering a DiffSet"""
+        dirname = self.create_tmp_dir()
+        filename = os.path.join(dirname, 'diff')
+        self._write(filename, 'xx--- b\n+++ b\n+b\nyy')
+
+        diff = DiffSet()
+        diff.append('header\n')
+        diff.start_file('a')
+        diff.extend(['--- a\n', '+++ a\n', '-a\n'])
+        diff.start_file('b')
+        diff.append_file(filename, 2, 15)
+
+        self.assertEqual(len(diff), 37)
+        self.assertEqual(diff.get_file_sizes(),
+                         [(None, 7), ('a', 15), ('b', 15)])
+        self.assertEqual(str(diff),
+                         'header\n--- a\n+++ a\n-a\n--- b\n+++ b\n+b\n')
+
+        filtered = diff.filter(lambda entry: entry.filename == 'b')
+        self.assertEqual(filtered.getvalue(), '--- b\n+++ b\n+b\n')
+
+        out = StringIO()
+        filtered.write_to(out)
+        self.assertEqual(out.getvalue(), '--- b\n+++ b\n+b\n')
+
+        entry = diff.files[1]
+        entry.replace_chunk(2, '+a\n')
+        self.assertEqual(len(entry), 15)
+        self.assertEqual(''.join(entry.iter_chunks()), '--- a\n+++ a\n+a\n')
+
+        self.assertRaises(IOError, diff.append_file,
+                          os.path.join(dirname, 'missing'))
+
+    def test_diff_set_spool(self):
+        """Testing building a DiffSet in a SpooledBuffer"""
+        diff = DiffSet(spool=True)
+        diff.buffer.max_size = 10
+        entry = diff.start_file('a')
+        entry.extend(['--- a\n', '+++ a\n'])
+        entry.add_chunk('@@ placeholder @@\n')
+        entry.append('-a\n')
+        diff.start_file('b').extend(['--- b\n', '+++ b\n'])
+
+        self.assertTrue(diff.buffer.rolled_over)
+        self.assertEqual(len(diff.buffer), 27)
+        self.assertEqual(len(entry.chunks), 3)
+
+        entry.replace_chunk(1, '@@ -1 +0,0 @@\n')
+        self.assertEqual(diff.get_file_sizes(), [('a', 29), ('b', 12)])
+        self.assertEqual(diff.getvalue(),
+                         '--- a\n+++ a\n@@ -1 +0,0 @@\n-a\n'
+                         '--- b\n+++ b\n')
+
+    def test_diff_set_make_file(self):
+        """Testing spooling a DiffSet's files in parallel"""
+        diff = DiffSet(spool=True)
+
+        def make_file(i):
+            lines = ['--- %d\n' % i, '+++ %d\n' % i]
+            time.sleep(0.001 * (10 - i))
+
+            return diff.make_file(lines, '%d' % i)
+
+        diff.add_files(process.run_parallel(make_file, range(10),
+                                            max_workers=4))
+
+        self.assertEqual(diff.get_file_sizes(),
+                         [('%d' % i, 12) for i in range(10)])
+        self.assertEqual(diff.getvalue(),
+                         ''.join(['--- %d\n+++ %d\n' % (i, i)
+                                  for i in range(10)]))
+        self.assertEqual(str(spool_diff(['a\n', 'b\n'])), 'a\nb\n')
+
+    def test_generate_diffs(self):
+        """Testing generate_diffs with and without a parent base"""
+        def make_diff(base, tip):
+            return '%s..%s' % (base, tip)
+
+        self.assertEqual(generate_diffs(make_diff, {'base': 'a', 'tip': 'b'}),
+                         ('a..b', None))
+
+        old_max_workers = process.get_max_workers()
+        process.set_max_workers(2)
+
+        try:
+            self.assertEqual(
+                generate_diffs(make_diff, {'parent_base': 'p', 'base': 'a',
+                                           'tip': 'b'}),
+                ('a..b', 'p..a'))
+        finally:
+            process.set_max_workers(old_max_workers)
+
+    def test_revision_cache(self):
+        """Testing RevisionCache fetching, reuse and eviction"""
+        dirname = self.create_tmp_dir()
+        cache = RevisionCache(os.path.join(dirname, 'revisions'),
+                              max_size=22)
+        fetched = []
+
+        def fetch(key, data):
+            def write(filename):
+                fetched.append(key)
+                self._write(filename, data)
+
+            dest = os.path.join(dirname, 'dest')
+            cache.fetch(key, dest, write)
+
+            f = open(dest, 'r')
+            result = f.read()
+            f.close()
+
+            return result
+
+        self.assertEqual(fetch('a#1', 'aaaaaaaa'), 'aaaaaaaa')
+        self.assertEqual(fetch('b#1', 'bbbbbbbb'), 'bbbbbbbb')
+        self.assertEqual(fetch('a#1', 'xxxxxxxx'), 'aaaaaaaa')
+        self.assertEqual(fetch(None, 'nnnnnnnn'), 'nnnnnnnn')
+        self.assertEqual(fetched, ['a#1', 'b#1', None])
+
+        # Make sure 'b#1' is the least recently used, then go over the
+        # maximum size.
+        os.utime(cache._get_path('b#1'), (0, 0))
+        fetch('c#1', 'cccccccc')
+        self.assertTrue(cache.get('a#1', os.path.join(dirname, 'a')))
+        self.assertFalse(cache.get('b#1', os.path.join(dirname, 'b')))
+
+    def test_spooled_buffer(self):
+        """Testing SpooledBuffer"""
+        buf = filesystem.SpooledBuffer(max_size=8)
+        buf.write('abcd')
+        self.assertFalse(buf.rolled_over)
+
+        buf.seek(1)
+        self.assertEqual(buf.read(2), 'bc')
+
+        # Writes go to the end, whatever was last read.
+        buf.write('efgh')
+        self.assertFalse(buf.rolled_over)
+        buf.write('ij')
+        self.assertTrue(buf.rolled_over)
+        self.assertEqual(len(buf), 10)
+        self.assertEqual(buf.getvalue(), 'abcdefghij')
+        buf.close()
+
+    def test_unified_diff(self):
+        """Testing 'unified_diff.diff_files' method."""
+        dirname = self.create_tmp_dir()
+        old_file = os.path.join(dirname, 'old')
+        new_file = os.path.join(dirname, 'new')
+        self._write(old_file, 'int main()\n{\n    a;\n    b;\n    c;\n'
+                              '    d;\n    e;\n}')
+        self._write(new_file, 'int main()\n{\n    a;\n    b;\n    c;\n'
+                              '    d;\n    E;\n}\n')
+
+        self.assertEqual(
+            unified_diff.diff_files(old_file, new_file, show_function=True,
+                                    old_label='a', new_label='b'),
+            [
+                '--- a\n',
+                '+++ b\n',
+                '@@ -4,5 +4,5 @@ int main()\n',
+                '     b;\n',
+                '     c;\n',
+                '     d;\n',
+                '-    e;\n',
+                '-}\n',
+                '\\ No newline at end of file\n',
+                '+    E;\n',
+                '+}\n',
+            ])
+
+        self.assertEqual(unified_diff.diff_files(old_file, old_file), [])
+        self.assertEqual(
+            unified_diff.diff_files(old_file,
+                                    os.path.join(dirname, 'missing'))[2:4],
+            ['@@ -1,8 +0,0 @@\n', '-int main()\n'])
+
+        self._write(new_file, 'int main()\0')
+        self.assertEqual(
+            unified_diff.diff_files(old_file, new_file),
+            ['Binary files %s and %s differ\n' % (old_file, new_file)])
+
+    def test_unified_diff_corpus(self):
+        """Testing 'unified_diff.diff_files' against GNU diff."""
+        if not checks.find_executable('diff'):
+            raise SkipTest('diff not found in path')
+
+        if 'GNU diffutils' not in process.execute(['diff', '--version'],
+                                                  ignore_errors=True):
+            raise SkipTest('GNU diff not found in path')
+
+        dirname = self.create_tmp_dir()
+        old_file = os.path.join(dirname, 'old')
+        new_file = os.path.join(dirname, 'new')
+        rand = random.Random(42)
+
+        def mutate(lines, choices):
+            lines = list(lines)
+
+            for i in xrange(rand.randint(0, 10)):
+                pos = rand.randint(0, len(lines))
+                op = rand.random()
+
+                if op < 0.4:
+                    del lines[pos:pos + rand.randint(1, 5)]
+                elif op < 0.8:
+                    for j in xrange(rand.randint(1, 5)):
+                        lines.insert(pos, rand.choice(choices))
+                elif lines:
+                    lines[min(pos, len(lines) - 1)] = rand.choice(choices)
+
+            return lines
+
+        for i in xrange(200):
+            # Small sets of lines make for lots of ambiguous matches, which
+            # test the choices made between equally short diffs.
+            choices = ['line %d\n' % j
+                       for j in xrange(rand.choice([2, 5, 20, 200]))]
+            choices += ['{\n', '}\n', '\n', 'function()\n', '    body\n']
+            base = [rand.choice(choices)
+                    for j in xrange(rand.choice([0, 10, 50, 300]))]
+            old_data = ''.join(mutate(base, choices))
+            new_data = ''.join(mutate(base, choices))
+
+            # Some files are missing their final newline.
+            if old_data and rand.random() < 0.2:
+                old_data = old_data[:-1]
+
+            if new_data and rand.random() < 0.2:
+                new_data = new_data[:-1]
+
+            self._write(old_file, old_data)
+            self._write(new_file, new_data)
+
+            for show_function in (False, True):
+                if show_function:
+                    flags = '-upN'
+                else:
+                    flags = '-uN'
+
+                expected = process.execute(
+                    ['diff', flags, '--label', 'a', '--label', 'b',
+                     old_file, new_file],
+                    extra_ignore_errors=(1,), translate_newlines=False)
+                result = ''.join(unified_diff.diff_files(
+                    old_file, new_file, show_function=show_function,
+                    old_label='a', new_label='b'))
+
+                self.assertEqual(result, expected,
+                                 'Diff %d (%s) differs:\n%r\n%r'
+                                 % (i, flags, old_data, new_data))
+
+    def _write(self, filename, data):
+        f = open(filename, 'wb')
+
+        try:
+            f.write(data)
+        finally:
+            f.close()
@@ -0,0 +1,825 @@
+"""A unified diff engine compatible with GNU diff.
+
+This produces the same output as ``diff -uN`` (or ``diff -upN``) from GNU
+diffutils, without starting a process for every file. The comparison
+follows GNU diff's own algorithm: the files' identical ends are trimmed,
+lines which can't match anything are discarded, the remaining lines are
+compared with Myers' O(ND) algorithm (in linear space, giving up on
+overly expensive comparisons the way GNU diff does), and the boundaries
+of the changes are shifted to the same places GNU diff would put them.
+"""
+import calendar
+import errno
+import math
+import mmap
+import os
+import re
+import time
+
+
+# GNU diff treats a file as binary if it finds a NUL byte near its start.
+BINARY_CHECK_SIZE = 32 * 1024
+
+# The size of the blocks compared when checking for identical files.
+COMPARE_BLOCK_SIZE = 1024 * 1024
+
+# The default function regex of 'diff -p'.
+FUNCTION_RE = re.compile(r'[A-Za-z$_]')
+
+NO_NEWLINE_MARKER = '\\ No newline at end of file\n'
+
+
+def diff_files(old_filename, new_filename, context=3, show_function=False,
+               old_label=None, new_label=None):
+    """Return a unified diff between two files, as a list of lines.
+
+    The result is the output of ``diff -uN old_filename new_filename``,
+    or ``diff -upN`` if 'show_function' is True. A file which doesn't
+    exist is treated as empty. The labels replace the filenames and
+    timestamps in the header lines, as with diff's --label option.
+
+    An empty list is returned if the files are the same, and a single
+    "Binary files ... differ" line if either of them is binary.
+    """
+    old_data, old_stat = _map_file(old_filename)
+
+    try:
+        new_data, new_stat = _map_file(new_filename)
+
+        try:
+            if _is_same_file(old_data, old_stat, new_data, new_stat):
+                return []
+
+            if _is_binary(old_data) or _is_binary(new_data):
+                return ['Binary files %s and %s differ\n'
+                        % (old_label or old_filename,
+                           new_label or new_filename)]
+
+            old_lines = _split_lines(old_data)
+            new_lines = _split_lines(new_data)
+        finally:
+            _unmap_file(new_data)
+    finally:
+        _unmap_file(old_data)
+
+    hunks = diff_lines(old_lines, new_lines, context=context,
+                       show_function=show_function)
+
+    if not hunks:
+        return []
+
+    return [
+        _format_header('---', old_filename, old_label, old_stat),
+        _format_header('+++', new_filename, new_label, new_stat),
+    ] + hunks
+
+
+def diff_lines(a, b, context=3, show_function=False):
+    """Return the unified diff hunks between two lists of lines.
+
+    Each line includes its newline, except possibly the last. The header
+    lines naming the files aren't included.
+    """
+    changes = _get_changes(a, b, context)
+
+    return _format_hunks(a, b, changes, context, show_function)
+
+
+def _map_file(filename):
+    """Return a file's contents, along with its stat information.
+
+    The contents are memory-mapped, unless the file is empty. A file
+    which doesn't exist is treated as empty, with no stat information.
+    """
+    try:
+        f = open(filename, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return '', None
+
+        raise
+
+    try:
+        st = os.fstat(f.fileno())
+
+        if st.st_size == 0:
+            return '', st
+
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), st
+    finally:
+        # The mapping stays valid after the file is closed.
+        f.close()
+
+
+def _unmap_file(data):
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+def _is_same_file(old_data, old_stat, new_data, new_stat):
+    """Return whether two files have the same contents."""
+    if (old_stat is not None and new_stat is not None and
+        old_stat.st_ino != 0 and
+        (old_stat.st_dev, old_stat.st_ino) ==
+        (new_stat.st_dev, new_stat.st_ino)):
+        return True
+
+    if len(old_data) != len(new_data):
+        return False
+
+    for i in xrange(0, len(old_data), COMPARE_BLOCK_SIZE):
+        if (old_data[i:i + COMPARE_BLOCK_SIZE] !=
+            new_data[i:i + COMPARE_BLOCK_SIZE]):
+            return False
+
+    return True
+
+
+def _is_binary(data):
+    return data[:BINARY_CHECK_SIZE].find('\0') != -1
+
+
+def _split_lines(data):
+    """Split data into lines, keeping their newlines.
+
+    Only '\\n' ends a line, unlike with str.splitlines. The data may be a
+    memory-mapped file, in which case each line is read from the mapping
+    in turn, without first copying the whole file into a string.
+    """
+    lines = []
+    append = lines.append
+    find = data.find
+    size = len(data)
+    pos = 0
+
+    while pos < size:
+        end = find('\n', pos)
+
+        if end == -1:
+            append(data[pos:])
+            break
+
+        end += 1
+        append(data[pos:end])
+        pos = end
+
+    return lines
+
+
+def _format_header(marker, filename, label, st):
+    """Return a header line in the format GNU diff uses."""
+    if label is not None:
+        return '%s %s\n' % (marker, label)
+
+    if st is None:
+        mtime = 0
+    else:
+        mtime = st.st_mtime
+
+    # Python 2 only provides the modification time as a float, which
+    # can't hold every nanosecond of a current timestamp, so the
+    # nanoseconds may differ from GNU diff's in the last few digits.
+    seconds = int(math.floor(mtime))
+    nanoseconds = int(round((mtime - seconds) * 1e9))
+
+    if nanoseconds >= 1000000000:
+        seconds += 1
+        nanoseconds -= 1000000000
+
+    local_time = time.localtime(seconds)
+    offset = (calendar.timegm(local_time) - seconds) // 60
+
+    if offset < 0:
+        sign = '-'
+        offset = -offset
+    else:
+        sign = '+'
+
+    return '%s %s\t%s.%09d %s%02d%02d\n' % (
+        marker, filename, time.strftime('%Y-%m-%d %H:%M:%S', local_time),
+        nanoseconds, sign, offset // 60, offset % 60)
+
+
+def _get_changes(a, b, horizon):
+    """Return the changes between two lists of lines.
+
+    Each change is a tuple of (first line in a, number of lines deleted,
+    first line in b, number of lines inserted).
+    """
+    n = len(a)
+    m = len(b)
+
+    # Only the lines between the identical prefix and suffix are compared,
+    # along with up to 'horizon' lines on either side.
+    prefix = 0
+    limit = min(n, m)
+
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+
+    start = prefix - min(prefix, horizon)
+    suffix = 0
+
+    # A suffix is only trimmed when both files do (or don't) end with a
+    # newline.
+    if _ends_with_newline(a) == _ends_with_newline(b):
+        limit = min(n, m) - start
+
+        while suffix < limit and a[n - 1 - suffix] == b[m - 1 - suffix]:
+            suffix += 1
+
+    kept = min(suffix, horizon)
+    old_lines = a[start:n - suffix + kept]
+    new_lines = b[start:m - suffix + kept]
+
+    classes = {}
+    old_equivs = [classes.setdefault(line, len(classes) + 1)
+                  for line in old_lines]
+    new_equivs = [classes.setdefault(line, len(classes) + 1)
+                  for line in new_lines]
+
+    # The changed flags have a False sentinel on each side. Line i is at
+    # index i + 1.
+    old_changed = [False] * (len(old_lines) + 2)
+    new_changed = [False] * (len(new_lines) + 2)
+
+    _find_changes(old_equivs, new_equivs, old_changed, new_changed)
+    _shift_boundaries(old_equivs, old_changed, new_changed)
+    _shift_boundaries(new_equivs, new_changed, old_changed)
+
+    changes = []
+    i0 = 0
+    i1 = 0
+
+    while i0 < len(old_lines) or i1 < len(new_lines):
+        if old_changed[i0 + 1] or new_changed[i1 + 1]:
+            line0 = i0
+            line1 = i1
+
+            while old_changed[i0 + 1]:
+                i0 += 1
+
+            while new_changed[i1 + 1]:
+                i1 += 1
+
+            changes.append((start + line0, i0 - line0,
+                            start + line1, i1 - line1))
+
+        i0 += 1
+        i1 += 1
+
+    return changes
+
+
+def _ends_with_newline(lines):
+    return not lines or lines[-1].endswith('\n')
+
+
+def _discard_confusing_lines(equivs, other_counts):
+    """Return the lines of one file which the comparison can skip.
+
+    Lines which match nothing in the other file are always changes, so
+    they're marked with 1. Lines which match very many lines are marked
+    with 2, and are only discarded in the middle of a run of discarded
+    lines.
+    """
+    end = len(equivs)
+    discards = [0] * end
+    many = 5
+    tem = (end // 64) >> 2
+
+    # MANY is 5 times the approximate square root of the number of lines.
+    while tem > 0:
+        many *= 2
+        tem >>= 2
+
+    for i in xrange(end):
+        nmatch = other_counts.get(equivs[i], 0)
+
+        if nmatch == 0:
+            discards[i] = 1
+        elif nmatch > many:
+            discards[i] = 2
+
+    i = 0
+
+    while i < end:
+        if discards[i] == 2:
+            # Cancel provisional discards not in the middle of a run.
+            discards[i] = 0
+        elif discards[i] != 0:
+            # Find the end of this run of discardable lines, counting the
+            # provisional ones.
+            provisional = 0
+            j = i
+
+            while j < end and discards[j] != 0:
+                if discards[j] == 2:
+                    provisional += 1
+
+                j += 1
+
+            # Cancel provisional discards at the end, and shrink the run.
+            while j > i and discards[j - 1] == 2:
+                j -= 1
+                discards[j] = 0
+                provisional -= 1
+
+            length = j - i
+
+            if provisional * 4 > length:
+                # If 1/4 of the run is provisional, cancel all of those.
+                while j > i:
+                    j -= 1
+
+                    if discards[j] == 2:
+                        discards[j] = 0
+            else:
+                # MINIMUM is the approximate square root of LENGTH / 4.
+                minimum = 1
+                tem = length >> 2
+
+                while True:
+                    tem >>= 2
+
+                    if tem <= 0:
+                        break
+
+                    minimum <<= 1
+
+                minimum += 1
+
+                # Cancel any subrun of MINIMUM or more provisionals within
+                # the larger run.
+                j = 0
+                consec = 0
+
+                while j < length:
+                    if discards[i + j] != 2:
+                        consec = 0
+                    else:
+                        consec += 1
+
+                        if consec == minimum:
+                            # Back up to the start of the subrun, to
+                            # cancel all of it.
+                            j -= consec
+                        elif consec > minimum:
+                            discards[i + j] = 0
+
+                    j += 1
+
+                # Scan from the beginning of the run until 3 or more
+                # nonprovisionals are found in a row, or the first
+                # nonprovisional at least 8 lines in, cancelling any
+                # provisionals up to there.
+                consec = 0
+
+                for j in xrange(length):
+                    if j >= 8 and discards[i + j] == 1:
+                        break
+
+                    if discards[i + j] == 2:
+                        consec = 0
+                        discards[i + j] = 0
+                    elif discards[i + j] == 0:
+                        consec = 0
+                    else:
+                        consec += 1
+
+                    if consec == 3:
+                        break
+
+                # Move to the last line of the run, and do the same from
+                # the end.
+                i += length - 1
+                consec = 0
+
+                for j in xrange(length):
+                    if j >= 8 and discards[i - j] == 1:
+                        break
+
+                    if discards[i - j] == 2:
+                        consec = 0
+                        discards[i - j] = 0
+                    elif discards[i - j] == 0:
+                        consec = 0
+                    else:
+                        consec += 1
+
+                    if consec == 3:
+                        break
+
+        i += 1
+
+    return discards
+
+
+def _count_equivs(equivs):
+    counts = {}
+
+    for equiv in equivs:
+        counts[equiv] = counts.get(equiv, 0) + 1
+
+    return counts
+
+
+def _find_changes(old_equivs, new_equivs, old_changed, new_changed):
+    """Mark the lines which differ between two files as changed."""
+    old_discards = _discard_confusing_lines(old_equivs,
+                                            _count_equivs(new_equivs))
+    new_discards = _discard_confusing_lines(new_equivs,
+                                            _count_equivs(old_equivs))
+
+    xvec = []
+    xindexes = []
+    yvec = []
+    yindexes = []
+
+    for i, equiv in enumerate(old_equivs):
+        if old_discards[i]:
+            old_changed[i + 1] = True
+        else:
+            xvec.append(equiv)
+            xindexes.append(i)
+
+    for i, equiv in enumerate(new_equivs):
+        if new_discards[i]:
+            new_changed[i + 1] = True
+        else:
+            yvec.append(equiv)
+            yindexes.append(i)
+
+    # Give up on finding a minimal diff after about the square root of
+    # the number of lines, but no sooner than 4096 steps.
+    diags = len(xvec) + len(yvec) + 3
+    too_expensive = 1
+
+    while diags != 0:
+        too_expensive <<= 1
+        diags >>= 2
+
+    too_expensive = max(4096, too_expensive)
+
+    # The diagonals range from -(len(yvec) + 1) to len(xvec) + 1.
+    size = len(xvec) + len(yvec) + 3
+    offset = len(yvec) + 1
+    fd = [0] * size
+    bd = [0] * size
+
+    stack = [(0, len(xvec), 0, len(yvec), False)]
+
+    while stack:
+        xoff, xlim, yoff, ylim, find_minimal = stack.pop()
+
+        # Slide down the bottom initial diagonal.
+        while xoff < xlim and yoff < ylim and xvec[xoff] == yvec[yoff]:
+            xoff += 1
+            yoff += 1
+
+        # Slide up the top initial diagonal.
+        while (xoff < xlim and yoff < ylim and
+               xvec[xlim - 1] == yvec[ylim - 1]):
+            xlim -= 1
+            ylim -= 1
+
+        if xoff == xlim:
+            for y in xrange(yoff, ylim):
+                new_changed[yindexes[y] + 1] = True
+        elif yoff == ylim:
+            for x in xrange(xoff, xlim):
+                old_changed[xindexes[x] + 1] = True
+        else:
+            xmid, ymid, lo_minimal, hi_minimal = _diag(
+                xvec, yvec, xoff, xlim, yoff, ylim, find_minimal,
+                too_expensive, fd, bd, offset)
+            stack.append((xmid, xlim, ymid, ylim, hi_minimal))
+            stack.append((xoff, xmid, yoff, ymid, lo_minimal))
+
+
+def _diag(xv, yv, xoff, xlim, yoff, ylim, find_minimal, too_expensive,
+          fd, bd, offset):
+    """Find the midpoint of the shortest edit script for a partition.
+
+    This searches forward from the start and backward from the end at
+    the same time, until the searches overlap. If that gets too
+    expensive, it settles for the furthest point reached. Returns a tuple
+    of (xmid, ymid, lo_minimal, hi_minimal), where the flags tell whether
+    each half must still be compared minimally.
+    """
+    dmin = xoff - ylim
+    dmax = xlim - yoff
+    fmid = xoff - yoff
+    bmid = xlim - ylim
+    fmin = fmid
+    fmax = fmid
+    bmin = bmid
+    bmax = bmid
+    odd = (fmid - bmid) & 1
+
+    fd[fmid + offset] = xoff
+    bd[bmid + offset] = xlim
+    c = 0
+
+    while True:
+        c += 1
+
+        # Extend the forward search by an edit step in each diagonal.
+        if fmin > dmin:
+            fmin -= 1
+            fd[fmin - 1 + offset] = -1
+        else:
+            fmin += 1
+
+        if fmax < dmax:
+            fmax += 1
+            fd[fmax + 1 + offset] = -1
+        else:
+            fmax -= 1
+
+        for d in xrange(fmax, fmin - 1, -2):
+            tlo = fd[d - 1 + offset]
+            thi = fd[d + 1 + offset]
+
+            if tlo < thi:
+                x = thi
+            else:
+                x = tlo + 1
+
+            y = x - d
+
+            while x < xlim and y < ylim and xv[x] == yv[y]:
+                x += 1
+                y += 1
+
+            fd[d + offset] = x
+
+            if odd and bmin <= d <= bmax and bd[d + offset] <= x:
+                return x, y, True, True
+
+        # Extend the backward search in the same way.
+        if bmin > dmin:
+            bmin -= 1
+            bd[bmin - 1 + offset] = xlim + ylim + 1
+        else:
+            bmin += 1
+
+        if bmax < dmax:
+            bmax += 1
+            bd[bmax + 1 + offset] = xlim + ylim + 1
+        else:
+            bmax -= 1
+
+        for d in xrange(bmax, bmin - 1, -2):
+            tlo = bd[d - 1 + offset]
+            thi = bd[d + 1 + offset]
+
+            if tlo < thi:
+                x = tlo
+            else:
+                x = thi - 1
+
+            y = x - d
+
+            while xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+                x -= 1
+                y -= 1
+
+            bd[d + offset] = x
+
+            if not odd and fmin <= d <= fmax and x <= fd[d + offset]:
+                return x, y, True, True
+
+        if find_minimal or c < too_expensive:
+            continue
+
+        # This has gone well beyond the call of duty. Give up, and use
+        # the furthest point reached by either search.
+        fxybest = -1
+        fxbest = 0
+
+        for d in xrange(fmax, fmin - 1, -2):
+            x = min(fd[d + offset], xlim)
+            y = x - d
+
+            if ylim < y:
+                x = ylim + d
+                y = ylim
+
+            if fxybest < x + y:
+                fxybest = x + y
+                fxbest = x
+
+        bxybest = xlim + ylim + 1
+        bxbest = 0
+
+        for d in xrange(bmax, bmin - 1, -2):
+            x = max(xoff, bd[d + offset])
+            y = x - d
+
+            if y < yoff:
+                x = yoff + d
+                y = yoff
+
+            if x + y < bxybest:
+                bxybest = x + y
+                bxbest = x
+
+        if (xlim + ylim) - bxybest < fxybest - (xoff + yoff):
+            return fxbest, fxybest - fxbest, True, False
+        else:
+            return bxbest, bxybest - bxbest, False, True
+
+
+def _shift_boundaries(equivs, changed, other_changed):
+    """Move runs of changes to where GNU diff would show them.
+
+    Runs are shifted back or forward over lines equal to those they
+    contain, merging them with neighboring runs where possible, and
+    otherwise lining them up with a run of changes in the other file.
+    Both lists of flags have a sentinel at each end, so line i is at
+    index i + 1.
+    """
+    i = 0
+    j = 0
+    i_end = len(equivs)
+
+    while True:
+        # Scan forward to the start of another run of changes, keeping
+        # track of the corresponding point in the other file.
+        while i < i_end and not changed[i + 1]:
+            while other_changed[j + 1]:
+                j += 1
+
+            j += 1
+            i += 1
+
+        if i == i_end:
+            break
+
+        start = i
+
+        # Find the end of this run of changes.
+        i += 1
+
+        while changed[i + 1]:
+            i += 1
+
+        while other_changed[j + 1]:
+            j += 1
+
+        while True:
+            runlength = i - start
+
+            # Move the run back, as long as the previous unchanged line
+            # matches the last changed one. This merges with previous runs.
+            while start and equivs[start - 1] == equivs[i - 1]:
+                start -= 1
+                changed[start + 1] = True
+                i -= 1
+                changed[i + 1] = False
+
+                while changed[start]:
+                    start -= 1
+
+                j -= 1
+
+                while other_changed[j + 1]:
+                    j -= 1
+
+            # The end of the run, at the last point where it corresponds
+            # to a run of changes in the other file, or i_end if there
+            # isn't one.
+            if other_changed[j]:
+                corresponding = i
+            else:
+                corresponding = i_end
+
+            # Move the run forward, as long as the first changed line
+            # matches the following unchanged one. This merges with
+            # following runs.
+            while i != i_end and equivs[start] == equivs[i]:
+                changed[start + 1] = False
+                start += 1
+                changed[i + 1] = True
+                i += 1
+
+                while changed[i + 1]:
+                    i += 1
+
+                j += 1
+
+                while other_changed[j + 1]:
+                    j += 1
+                    corresponding = i
+
+            if runlength == i - start:
+                break
+
+        # If possible, move the merged run back to line up with a run of
+        # changes in the other file.
+        while corresponding < i:
+            start -= 1
+            changed[start + 1] = True
+            i -= 1
+            changed[i + 1] = False
+
+            j -= 1
+
+            while other_changed[j + 1]:
+                j -= 1
+
+
+def _format_range(first, last):
+    """Format the line range of a hunk, as GNU diff does."""
+    first += 1
+    last += 1
+
+    if last < first:
+        return '%d,0' % last
+    elif last == first:
+        return '%d' % last
+    else:
+        return '%d,%d' % (first, last - first + 1)
+
+
+def _format_line(prefix, line):
+    if line.endswith('\n'):
+        return [prefix + line]
+    else:
+        return [prefix + line + '\n', NO_NEWLINE_MARKER]
+
+
+def _format_hunks(a, b, changes, context, show_function):
+    """Return the unified diff hunks for a list of changes."""
+    result = []
+    last_search = 0
+    last_match = None
+    i = 0
+
+    while i < len(changes):
+        # Group the changes which are close enough to share context.
+        j = i
+
+        while j + 1 < len(changes):
+            line0, deleted = changes[j][:2]
+
+            if changes[j + 1][0] - (line0 + deleted) > 2 * context:
+                break
+
+            j += 1
+
+        hunk = changes[i:j + 1]
+        i = j + 1
+
+        first0 = max(hunk[0][0] - context, 0)
+        first1 = max(hunk[0][2] - context, 0)
+        last0 = min(hunk[-1][0] + hunk[-1][1] - 1 + context, len(a) - 1)
+        last1 = min(hunk[-1][2] + hunk[-1][3] - 1 + context, len(b) - 1)
+
+        header = '@@ -%s +%s @@' % (_format_range(first0, last0),
+                                    _format_range(first1, last1))
+
+        if show_function:
+            function = None
+
+            for k in xrange(first0 - 1, last_search - 1, -1):
+                if FUNCTION_RE.match(a[k]):
+                    function = a[k]
+                    last_match = k
+                    break
+
+            last_search = first0
+
+            if function is None and last_match is not None:
+                function = a[last_match]
+
+            if function is not None:
+                function = function.split('\n', 1)[0].lstrip(' \t\v\f\r')
+                header += ' ' + function[:40].rstrip(' \t\v\f\r')
+
+        result.append(header + '\n')
+
+        x = first0
+        y = first1
+
+        for line0, deleted, line1, inserted in hunk:
+            while x < line0:
+                result += _format_line(' ', a[x])
+                x += 1
+                y += 1
+
+            for k in xrange(line0, line0 + deleted):
+                result += _format_line('-', a[k])
+
+            for k in xrange(line1, line1 + inserted):
+                result += _format_line('+', b[k])
+
+            x += deleted
+            y += inserted
+
+        while x <= last0:
+            result += _format_line(' ', a[x])
+            x += 1
+
+    return result
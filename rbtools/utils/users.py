@@ -6,14 +6,18 @@ from rbtools.api.errors import AuthorizationError
 from rbtools.commands import CommandError
 
 
-def get_user(api_client, api_root, auth_required=False):
+def get_user(api_client, api_root, auth_required=False, session=None):
     """Return the user resource for the current session
 
     None will be returned if the user is not authenticated, unless the
     'auth_required' parameter is True, in which case the user will be
     prompted to login.
+
+    An already fetched session resource may be passed as 'session' to
+    avoid requesting it again.
     """
-    session = api_root.get_session()
+    if session is None:
+        session = api_root.get_session()
 
     if not session.authenticated:
         if not auth_required: